@@ -23,6 +23,7 @@ env = environ.Env(
         {"username": "cn", "display": "displayname", "email": "mail"},
     ),
     Q_CLUISTER_SYNC=(bool, False),  # qcluster 同步模式, debug 时可以调整为 True
+    ENGINE_POOL_ENABLE=(bool, False),  # 实例连接池, 开启后 MySQL/PgSQL 实例连接在进程内复用
     # CSRF_TRUSTED_ORIGINS=subdomain.example.com,subdomain.example2.com subdomain.example.com
     CSRF_TRUSTED_ORIGINS=(list, []),
 )
@@ -180,6 +181,17 @@ Q_CLUSTER = {
     "sync": env("Q_CLUISTER_SYNC"),  # 本地调试可以修改为True，使用同步模式
 }
 
+# 实例连接池，按照实例和库名区分，进程内的线程共享
+ENGINE_CONNECTION_POOL = {
+    "enable": env("ENGINE_POOL_ENABLE"),
+    "max_size": env.int("ENGINE_POOL_MAX_SIZE", default=10),
+    "idle_timeout": env.int("ENGINE_POOL_IDLE_TIMEOUT", default=300),  # 空闲连接保留时间，单位秒
+    "wait_timeout": env.int("ENGINE_POOL_WAIT_TIMEOUT", default=10),  # 等待可用连接的时间，单位秒
+}
+
+# ssh隧道进程内共享，无引用的隧道空闲超时后关闭，单位秒
+SSH_TUNNEL_IDLE_TIMEOUT = env.int("SSH_TUNNEL_IDLE_TIMEOUT", default=600)
+
 # 缓存配置
 CACHES = {
     "default": env.cache(),
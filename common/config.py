@@ -1,16 +1,68 @@
 # -*- coding: UTF-8 -*-
 import logging
+import threading
 import traceback
+import uuid
 
 import simplejson as json
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import receiver
 from django.http import HttpResponse
 
 from common.utils.permission import superuser_required
 from sql.models import Config
-from django.db import transaction
+from sql.utils.tasks import sync_config_schedules
+from django.db import connection, transaction
 
 logger = logging.getLogger("default")
 
+# 系统配置版本号，配置变更时更新，各进程据此判断是否需要重新读取配置
+CONFIG_VERSION_KEY = "sys_config_version"
+# 进程内缓存的系统配置 (版本号, 配置)
+_cached_config = (None, {})
+# 进程内配置缓存的命中统计
+_cache_stats = {"hits": 0, "misses": 0}
+_cache_lock = threading.Lock()
+
+
+def _use_shared_cache():
+    """事务内读取的配置可能包含未提交的修改，不使用进程内缓存"""
+    return not connection.in_atomic_block
+
+
+def _config_version():
+    """获取系统配置版本号，不存在时生成"""
+    version = cache.get(CONFIG_VERSION_KEY)
+    if version is None:
+        cache.add(CONFIG_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        version = cache.get(CONFIG_VERSION_KEY)
+    return version
+
+
+def _bump_config_version():
+    """更新系统配置版本号，各进程下次读取配置时重新查询数据库"""
+    try:
+        cache.set(CONFIG_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+    except Exception as e:
+        logger.error(f"更新系统配置版本号失败：{e}")
+
+
+@receiver(post_save, sender=Config)
+@receiver(post_delete, sender=Config)
+@receiver(post_migrate)
+def invalidate_config(**kwargs):
+    """配置记录变更(包括后台管理修改)或数据库重建(flush/migrate)后使配置缓存失效"""
+    global _cached_config
+    _cached_config = (None, {})
+    _bump_config_version()
+
+
+def config_cache_stats():
+    """返回进程内配置缓存的命中统计，hits即避免的数据库查询次数"""
+    with _cache_lock:
+        return dict(_cache_stats)
+
 
 class SysConfig(object):
     def __init__(self):
@@ -18,6 +70,17 @@ class SysConfig(object):
         self.get_all_config()
 
     def get_all_config(self):
+        global _cached_config
+        try:
+            version = _config_version() if _use_shared_cache() else None
+        except Exception as e:
+            logger.warning(f"获取系统配置版本号失败，直接读取系统配置：{e}")
+            version = None
+        if version is not None and _cached_config[0] == version:
+            with _cache_lock:
+                _cache_stats["hits"] += 1
+            self.sys_config = dict(_cached_config[1])
+            return
         try:
             # 获取系统配置信息
             all_config = Config.objects.all().values("item", "value")
@@ -32,6 +95,17 @@ class SysConfig(object):
         except Exception as m:
             logger.error(f"获取系统配置信息失败:{m}{traceback.format_exc()}")
             self.sys_config = {}
+            return
+        with _cache_lock:
+            _cache_stats["misses"] += 1
+        if version is not None:
+            _cached_config = (version, dict(sys_config))
+
+    @staticmethod
+    def _changed():
+        """配置变更后更新版本号，事务提交后再次更新，避免其他进程缓存未提交前的配置"""
+        _bump_config_version()
+        transaction.on_commit(_bump_config_version)
 
     def get(self, key, default_value=None):
         value = self.sys_config.get(key, default_value)
@@ -50,6 +124,7 @@ class SysConfig(object):
         obj, created = Config.objects.update_or_create(
             item=key, defaults={"value": db_value}
         )
+        self._changed()
         if created:
             self.sys_config.update({key: value})
 
@@ -72,6 +147,7 @@ class SysConfig(object):
             result["status"] = 1
             result["msg"] = str(e)
         finally:
+            self._changed()
             self.get_all_config()
         return result
 
@@ -81,6 +157,7 @@ class SysConfig(object):
             with transaction.atomic():
                 Config.objects.all().delete()
                 self.sys_config = {}
+            self._changed()
         except Exception as m:
             logger.error(f"删除缓存失败:{m}{traceback.format_exc()}")
 
@@ -91,5 +168,7 @@ def change_config(request):
     configs = request.POST.get("configs")
     archer_config = SysConfig()
     result = archer_config.replace(configs)
+    # 根据配置添加或者删除定时任务
+    sync_config_schedules(archer_config)
     # 返回结果
     return HttpResponse(json.dumps(result), content_type="application/json")
@@ -5,7 +5,7 @@ import datetime
 from django.contrib.auth import get_user_model
 from django.test import Client, TestCase
 
-from common.config import SysConfig
+from common.config import SysConfig, config_cache_stats
 from common.utils.sendmsg import MsgSender
 from sql.engines import EngineBase, ResultSet
 from sql.models import (
@@ -14,8 +14,10 @@ from sql.models import (
     SqlWorkflowContent,
     QueryLog,
     ResourceGroup,
+    TwoFactorAuthConfig,
 )
 from common.utils.chart_dao import ChartDao
+from common.utils.global_info import invalidate_todo
 from common.auth import init_user
 
 User = get_user_model()
@@ -73,6 +75,19 @@ class ConfigOpsTests(TestCase):
         archer_config.set("other_config", "testvalue3")
         self.assertEqual(archer_config.sys_config["other_config"], "testvalue3")
 
+    @patch("common.config._use_shared_cache", return_value=True)
+    def test_config_cached(self, _use_shared_cache):
+        """配置版本号未变化时不查询数据库，配置变更后重新读取"""
+        archer_config = SysConfig()
+        archer_config.set("cached_config", "v1")
+        SysConfig()
+        hits = config_cache_stats()["hits"]
+        with self.assertNumQueries(0):
+            self.assertEqual(SysConfig().get("cached_config"), "v1")
+        self.assertEqual(config_cache_stats()["hits"], hits + 1)
+        archer_config.set("cached_config", "v2")
+        self.assertEqual(SysConfig().get("cached_config"), "v2")
+
 
 class SendMessageTest(TestCase):
     """发送消息测试"""
@@ -190,6 +205,7 @@ class GlobalInfoTest(TestCase):
     def setUp(self):
         self.u1 = User(username="test_user", display="中文显示", is_active=True)
         self.u1.save()
+        invalidate_todo()
 
     @patch("sql.utils.workflow_audit.Audit.todo")
     def testGlobalInfo(self, todo):
@@ -204,7 +220,24 @@ class GlobalInfoTest(TestCase):
         r = c.get("/", follow=True)
         todo.assert_called_once_with(self.u1)
         self.assertEqual(r.context["todo"], 3)
+        self.assertEqual(r.context["twofa_type"], "disabled")
+        # 命中缓存，不再查询待办数量
+        r = c.get("/", follow=True)
+        todo.assert_called_once_with(self.u1)
+        self.assertEqual(r.context["todo"], 3)
+        # 审核记录变更后重新查询
+        invalidate_todo()
+        todo.return_value = 4
+        r = c.get("/", follow=True)
+        self.assertEqual(r.context["todo"], 4)
+        # 2FA配置变更后重新查询
+        TwoFactorAuthConfig.objects.create(
+            username=self.u1.username, auth_type="totp", user=self.u1
+        )
+        r = c.get("/", follow=True)
+        self.assertEqual(r.context["twofa_type"], "totp")
         # 报异常
+        invalidate_todo()
         todo.side_effect = NameError("some exception")
         r = c.get("/", follow=True)
         self.assertEqual(r.context["todo"], 0)
@@ -1,29 +1,108 @@
 # -*- coding: UTF-8 -*-
+import logging
+import uuid
+
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
 from sql.utils.workflow_audit import Audit
 from archery import display_version
 from common.config import SysConfig
-from sql.models import TwoFactorAuthConfig
+from sql.models import TwoFactorAuthConfig, WorkflowAudit
+
+logger = logging.getLogger("default")
+
+# 待办版本号，审核记录变更时更新，使所有用户缓存的待办数量失效
+TODO_VERSION_KEY = "global_info_todo_version"
+# 用户页面上下文的缓存时间，用户组变更等未主动失效的场景最多延迟该时间，单位秒
+USER_CONTEXT_TIMEOUT = 300
+
+
+def _user_context_key(user_id):
+    return f"global_info:{user_id}"
+
+
+def _load_user_context(user):
+    """
+    查询用户的待办数量和2FA类型
+    :return: (上下文, 是否可以缓存)，获取待办数量异常时不缓存
+    """
+    cacheable = True
+    try:
+        todo = Audit.todo(user)
+    except Exception:
+        todo = 0
+        cacheable = False
+    twofa_type = (
+        TwoFactorAuthConfig.objects.filter(user=user)
+        .values_list("auth_type", flat=True)
+        .first()
+    )
+    return {"todo": todo, "twofa_type": twofa_type or "disabled"}, cacheable
+
+
+def user_context(user):
+    """
+    获取用户的页面上下文，缓存在Redis中，待办版本号和用户上下文一次读取
+    :return: {"todo": 待办数量, "twofa_type": 2FA类型}
+    """
+    key = _user_context_key(user.id)
+    try:
+        cached = cache.get_many([TODO_VERSION_KEY, key])
+    except Exception as e:
+        logger.warning(f"获取用户页面上下文缓存失败：{e}")
+        return _load_user_context(user)[0]
+    version = cached.get(TODO_VERSION_KEY)
+    context = cached.get(key)
+    if context and version and context.get("version") == version:
+        return context
+    context, cacheable = _load_user_context(user)
+    if not cacheable:
+        return context
+    try:
+        if version is None:
+            version = uuid.uuid4().hex
+            cache.set(TODO_VERSION_KEY, version, timeout=None)
+        context["version"] = version
+        cache.set(key, context, timeout=USER_CONTEXT_TIMEOUT)
+    except Exception as e:
+        logger.warning(f"写入用户页面上下文缓存失败：{e}")
+    return context
+
+
+@receiver(post_save, sender=WorkflowAudit)
+@receiver(post_delete, sender=WorkflowAudit)
+def invalidate_todo(**kwargs):
+    """审核记录新增或者状态变更(Audit.add/audit等)后使所有用户的待办数量失效"""
+    try:
+        cache.set(TODO_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+    except Exception as e:
+        logger.error(f"更新待办版本号失败：{e}")
+
+
+@receiver(post_save, sender=TwoFactorAuthConfig)
+@receiver(post_delete, sender=TwoFactorAuthConfig)
+def invalidate_user_context(instance, **kwargs):
+    """用户2FA配置变更后使该用户的页面上下文失效"""
+    try:
+        cache.delete(_user_context_key(instance.user_id))
+    except Exception as e:
+        logger.error(f"删除用户页面上下文缓存失败：{e}")
 
 
 def global_info(request):
     """存放用户，菜单信息等."""
     user = request.user
-    twofa_type = "disabled"
     if user and user.is_authenticated:
-        # 获取待办数量
-        try:
-            todo = Audit.todo(user)
-        except Exception:
-            todo = 0
-
-        twofa_config = TwoFactorAuthConfig.objects.filter(user=user)
-        if twofa_config:
-            twofa_type = twofa_config[0].auth_type
-        else:
-            twofa_type = "disabled"
+        context = user_context(user)
+        todo = context["todo"]
+        twofa_type = context["twofa_type"]
     else:
         todo = 0
+        twofa_type = "disabled"
 
+    # 系统配置使用进程内缓存，不会查询数据库
     watermark_enabled = SysConfig().get("watermark_enabled", False)
 
     return {
@@ -483,6 +483,7 @@ class ArchiveConfigAdmin(admin.ModelAdmin):
         "no_delete",
         "status",
         "state",
+        "priority",
         "user_display",
         "create_time",
         "resource_group",
@@ -505,6 +506,7 @@ class ArchiveConfigAdmin(admin.ModelAdmin):
         "sleep",
         "no_delete",
         "state",
+        "priority",
         "user_name",
         "user_display",
     )
@@ -0,0 +1,12 @@
+from django.apps import AppConfig
+
+
+class SqlConfig(AppConfig):
+    name = "sql"
+
+    def ready(self):
+        # 注册信号处理函数
+        import common.config  # noqa: F401
+        import common.utils.global_info  # noqa: F401
+        import sql.query_privileges  # noqa: F401
+        import sql.utils.data_masking  # noqa: F401
@@ -9,7 +9,6 @@ import logging
 import os
 import re
 import traceback
-import time
 
 import simplejson as json
 from django.conf import settings
@@ -22,12 +21,21 @@ from django.shortcuts import render
 from django.urls import reverse
 from django_q.tasks import async_task
 
+from common.config import SysConfig
 from common.utils.const import WorkflowDict
 from common.utils.extend_json_encoder import ExtendJSONEncoder
 from common.utils.timer import FuncTimer
 from sql.engines import get_engine
 from sql.notify import notify_for_audit
 from sql.plugins.pt_archiver import PtArchiver
+from sql.utils import archive_scheduler
+from sql.utils.archive_progress import (
+    ArchiveProgress,
+    BoundedOutput,
+    estimate_rows,
+    get_progress,
+)
+from sql.utils.native_archiver import NativeArchiver
 from sql.utils.resource_group import user_instances, user_groups
 from sql.models import ArchiveConfig, ArchiveLog, Instance, ResourceGroup
 from sql.utils.workflow_audit import Audit
@@ -299,24 +307,21 @@ def add_archive_task(archive_ids=None):
             state=True, status=WorkflowDict.workflow_status["audit_success"]
         )
 
-    # 添加task任务
-    for archive_info in archive_cnf_list:
-        archive_id = archive_info.id
-        async_task(
-            "sql.archiver.archive",
-            archive_id,
-            group=f'archive-{time.strftime("%Y-%m-%d %H:%M:%S ")}',
-            timeout=-1,
-            task_name=f"archive-{archive_id}",
-        )
+    # 加入调度队列，按照优先级、并发限制和时间窗口执行
+    archive_scheduler.enqueue(archive_cnf_list)
 
 
-def archive(archive_id):
+def archive(archive_id, queue_time=None):
     """
     执行数据库归档
+    :param archive_id: 归档配置id
+    :param queue_time: 进入调度队列的时间，用于统计排队耗时
     :return:
     """
     archive_info = ArchiveConfig.objects.get(id=archive_id)
+    # 使用原生归档替代pt-archiver
+    if SysConfig().get("archive_native"):
+        return NativeArchiver(archive_info, queue_time=queue_time).run()
     s_ins = archive_info.src_instance
     src_db_name = archive_info.src_db_name
     src_table_name = archive_info.src_table_name
@@ -393,9 +398,12 @@ def archive(archive_id):
     select_cnt = 0
     insert_cnt = 0
     delete_cnt = 0
+    progress = ArchiveProgress(
+        archive_id, total=estimate_rows(s_ins, src_db_name, src_table_name)
+    )
     with FuncTimer() as t:
         p = pt_archiver.execute_cmd(cmd_args)
-        stdout = ""
+        output = BoundedOutput()
         for line in iter(p.stdout.readline, ""):
             if re.match(r"^SELECT\s(\d+)$", line, re.I):
                 select_cnt = re.findall(r"^SELECT\s(\d+)$", line)
@@ -403,7 +411,13 @@ def archive(archive_id):
                 insert_cnt = re.findall(r"^INSERT\s(\d+)$", line)
             elif re.match(r"^DELETE\s(\d+)$", line, re.I):
                 delete_cnt = re.findall(r"^DELETE\s(\d+)$", line)
-            stdout += f"{line}\n"
+            else:
+                # --progress输出的进度行，格式为：TIME ELAPSED COUNT
+                match = re.match(r"^\S+T\S+\s+\d+\s+(\d+)\s*$", line)
+                if match:
+                    progress.update(int(match.group(1)))
+            output.append(f"{line}\n")
+    stdout = str(output)
     statistics = stdout
     # 获取异常信息
     stderr = p.stderr.read()
@@ -459,9 +473,12 @@ def archive(archive_id):
         statistics=statistics,
         success=success,
         error_info=error_info,
+        queue_time=queue_time,
         start_time=t.start,
         end_time=t.end,
     )
+    progress.update(select_cnt, force=True)
+    progress.finish(success, error_info)
     if not success:
         raise Exception(f"{error_info}\n{statistics}")
 
@@ -489,6 +506,7 @@ def archive_log(request):
         "delete_cnt",
         "success",
         "error_info",
+        "queue_time",
         "start_time",
         "end_time",
     )
@@ -502,6 +520,14 @@ def archive_log(request):
     )
 
 
+@permission_required("sql.menu_archive", raise_exception=True)
+def archive_progress(request):
+    """获取归档任务的实时进度"""
+    archive_id = request.GET.get("archive_id")
+    progress = get_progress(archive_id) or {}
+    return JsonResponse({"status": 0, "msg": "ok", "data": progress})
+
+
 @permission_required("sql.archive_mgt", raise_exception=True)
 def archive_switch(request):
     """开启关闭归档任务"""
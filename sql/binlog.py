@@ -12,11 +12,14 @@ from django.contrib.auth.decorators import permission_required
 from django.http import HttpResponse, JsonResponse
 from django_q.tasks import async_task
 
+from common.config import SysConfig
 from common.utils.extend_json_encoder import ExtendJSONEncoder
 from sql.engines import get_engine
 
 from sql.plugins.my2sql import My2SQL
 from sql.notify import notify_for_my2sql
+from sql.utils.binlog_index import file_index, resolve_range
+from sql.utils.binlog_parser import Binlog2SQL
 from .models import Instance
 
 logger = logging.getLogger("default")
@@ -39,11 +42,18 @@ def binlog_list(request):
     query_result = query_engine.query("information_schema", "show binary logs;")
     if not query_result.error:
         column_list = query_result.column_list
+        indexes = file_index(instance)
         rows = []
         for row in query_result.rows:
             row_info = {}
             for row_index, row_item in enumerate(row):
                 row_info[column_list[row_index]] = row_item
+            # 已索引的binlog返回时间范围和GTID范围
+            index = indexes.get(row_info.get("Log_name"))
+            if index:
+                row_info["First_time"] = index.first_time
+                row_info["Last_time"] = index.last_time
+                row_info["Gtid_set"] = index.gtid_set
             rows.append(row_info)
         result = {"status": 0, "msg": "ok", "data": rows}
     else:
@@ -131,9 +141,53 @@ def my2sql(request):
     full_columns = True if request.POST.get("full_columns") == "true" else False
     no_db_prefix = True if request.POST.get("no_db_prefix") == "true" else False
     file_per_table = True if request.POST.get("file_per_table") == "true" else False
+    # 按照binlog索引定位时间范围对应的位置，跳过范围之外的binlog
+    start_file, start_pos, end_file, end_pos = resolve_range(
+        instance, start_file, start_pos, end_file, end_pos, start_time, stop_time
+    )
 
     result = {"status": 0, "msg": "ok", "data": []}
 
+    # 开启内置解析时在进程内流式读取binlog，不再调用my2sql
+    if SysConfig().get("binlog_parser_inprocess"):
+        parser_args = {
+            "work_type": work_type,
+            "start_file": start_file,
+            "start_pos": start_pos,
+            "end_file": end_file,
+            "end_pos": end_pos,
+            "start_time": start_time,
+            "stop_time": stop_time,
+            "only_schemas": only_schemas,
+            "only_tables": only_tables,
+            "sql_type": sql_type,
+            "extra_info": extra_info,
+            "ignore_primary_key": ignore_primary_key,
+            "full_columns": full_columns,
+            "no_db_prefix": no_db_prefix,
+            "file_per_table": file_per_table,
+        }
+        try:
+            result["data"] = Binlog2SQL(instance, **parser_args).preview(num)
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            result["status"] = 1
+            result["msg"] = str(e)
+        if save_sql:
+            async_task(
+                binlog2sql_file,
+                instance=instance,
+                parser_args=parser_args,
+                user=request.user,
+                hook=notify_for_my2sql,
+                timeout=-1,
+                task_name=f"my2sql-{time.time()}",
+            )
+        return HttpResponse(
+            json.dumps(result, cls=ExtendJSONEncoder, bigint_as_string=True),
+            content_type="application/json",
+        )
+
     # 提交给my2sql进行解析
     my2sql = My2SQL()
 
@@ -252,3 +306,20 @@ def my2sql_file(args, user):
     # 使用output-dir参数执行命令保存sql
     my2sql.execute_cmd(cmd_args)
     return user, path
+
+
+def binlog2sql_file(instance, parser_args, user):
+    """
+    内置解析时异步保存binlog解析的文件，单次读取binlog，每次保存到单独的目录
+    :param instance: 实例
+    :param parser_args: Binlog2SQL的参数
+    :param user: 操作用户对象，用户消息推送
+    :return:
+    """
+    path = os.path.join(
+        settings.BASE_DIR,
+        "downloads/my2sql/",
+        f"{instance.instance_name}-{time.strftime('%Y%m%d%H%M%S')}",
+    )
+    Binlog2SQL(instance, **parser_args).save(path)
+    return user, path
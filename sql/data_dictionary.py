@@ -1,11 +1,17 @@
 # -*- coding: UTF-8 -*-
 import datetime
+import logging
 import os
+import traceback
+import uuid
+import zipfile
 from urllib.parse import quote
 
 import MySQLdb
 import simplejson as json
+from django.core.cache import cache
 from django.template import loader
+from django_q.tasks import async_task
 from archery import settings
 from sql.engines import get_engine
 from django.contrib.auth.decorators import permission_required
@@ -15,6 +21,12 @@ from common.utils.extend_json_encoder import ExtendJSONEncoder
 from sql.utils.resource_group import user_instances
 from .models import Instance
 
+logger = logging.getLogger("default")
+
+# 后台导出任务的状态，保存在缓存中
+EXPORT_TASK_KEY_PREFIX = "data_dictionary_export:"
+EXPORT_TASK_TIMEOUT = 60 * 60 * 24
+
 
 @permission_required("sql.menu_data_dictionary", raise_exception=True)
 def table_list(request):
@@ -88,9 +100,10 @@ def table_info(request):
 
 @permission_required("sql.data_dictionary_export", raise_exception=True)
 def export(request):
-    """导出数据字典"""
+    """导出数据字典，async_export=true时在后台导出，完成后通过export_download下载"""
     instance_name = request.GET.get("instance_name", "")
     db_name = request.GET.get("db_name", "")
+    async_export = request.GET.get("async_export") == "true"
     # escape
     db_name = MySQLdb.escape_string(db_name).decode("utf-8")
 
@@ -111,21 +124,33 @@ def export(request):
     else:
         return JsonResponse({"status": 1, "msg": f"仅管理员可以导出整个实例的字典信息！", "data": []})
 
+    # 后台导出，避免库表较多时请求超时
+    if async_export:
+        query_engine.close()
+        task_id = uuid.uuid4().hex
+        _set_export_task(
+            task_id, {"status": "running", "username": request.user.username}
+        )
+        async_task(
+            export_task,
+            instance.id,
+            dbs,
+            task_id,
+            request.user.username,
+            timeout=-1,
+            task_name=f"data-dictionary-export-{task_id}",
+        )
+        return JsonResponse(
+            {
+                "status": 0,
+                "msg": "数据字典正在后台导出，完成后请下载",
+                "data": {"task_id": task_id},
+            }
+        )
+
     # 获取数据，存入目录
     path = os.path.join(settings.BASE_DIR, "downloads/dictionary")
-    os.makedirs(path, exist_ok=True)
-    for db in dbs:
-        table_metas = query_engine.get_tables_metas_data(db_name=db)
-        context = {
-            "db_name": db_name,
-            "tables": table_metas,
-            "export_time": datetime.datetime.now(),
-        }
-        data = loader.render_to_string(
-            template_name="dictionaryexport.html", context=context, request=request
-        )
-        with open(f"{path}/{instance_name}_{db}.html", "w") as f:
-            f.write(data)
+    _export_dictionary(query_engine, instance_name, dbs, path)
     # 关闭连接
     query_engine.close()
     if db_name:
@@ -144,3 +169,85 @@ def export(request):
                 "data": [],
             }
         )
+
+
+@permission_required("sql.data_dictionary_export", raise_exception=True)
+def export_download(request):
+    """获取后台导出任务的状态，导出完成后下载文件，status=true时仅返回任务状态"""
+    task_id = request.GET.get("task_id", "")
+    task = cache.get(f"{EXPORT_TASK_KEY_PREFIX}{task_id}") if task_id else None
+    if not task or task.get("username") != request.user.username:
+        return JsonResponse({"status": 1, "msg": "导出任务不存在或已过期", "data": {}})
+    if task["status"] == "failed":
+        return JsonResponse({"status": 1, "msg": task.get("msg"), "data": task})
+    if task["status"] == "running" or request.GET.get("status") == "true":
+        return JsonResponse({"status": 0, "msg": "", "data": task})
+    filename = os.path.basename(task["file"])
+    response = FileResponse(open(task["file"], "rb"))
+    response["Content-Type"] = "application/octet-stream"
+    response["Content-Disposition"] = f'attachment;filename="{quote(filename)}"'
+    return response
+
+
+def export_task(instance_id, dbs, task_id, username):
+    """
+    后台导出数据字典，单个库导出为html文件，多个库打包为zip文件
+    :param instance_id: 实例id
+    :param dbs: 库名列表
+    :param task_id: 导出任务id
+    :param username: 发起导出的用户，仅该用户可以下载
+    :return:
+    """
+    task = {"status": "running", "username": username}
+    query_engine = None
+    try:
+        instance = Instance.objects.get(id=instance_id)
+        query_engine = get_engine(instance=instance)
+        # 每个任务使用单独的目录，避免并发导出相同实例、库时文件互相覆盖
+        path = os.path.join(settings.BASE_DIR, "downloads/dictionary", task_id)
+        files = _export_dictionary(query_engine, instance.instance_name, dbs, path)
+        if len(files) == 1:
+            task["file"] = files[0]
+        else:
+            task["file"] = os.path.join(path, f"{instance.instance_name}_{task_id}.zip")
+            with zipfile.ZipFile(task["file"], "w", zipfile.ZIP_DEFLATED) as zf:
+                for file in files:
+                    zf.write(file, arcname=os.path.basename(file))
+        task["status"] = "success"
+    except Exception as e:
+        logger.error(f"数据字典导出失败，错误信息：{traceback.format_exc()}")
+        task["status"] = "failed"
+        task["msg"] = f"数据字典导出失败，错误信息：{e}"
+    finally:
+        if query_engine:
+            query_engine.close()
+    _set_export_task(task_id, task)
+    return task
+
+
+def _set_export_task(task_id, task):
+    cache.set(f"{EXPORT_TASK_KEY_PREFIX}{task_id}", task, timeout=EXPORT_TASK_TIMEOUT)
+
+
+def _export_dictionary(query_engine, instance_name, dbs, path):
+    """
+    渲染数据字典并写入目录
+    :return: 生成的文件列表
+    """
+    os.makedirs(path, exist_ok=True)
+    files = []
+    for db in dbs:
+        table_metas = query_engine.get_tables_metas_data(db_name=db)
+        context = {
+            "db_name": db,
+            "tables": table_metas,
+            "export_time": datetime.datetime.now(),
+        }
+        data = loader.render_to_string(
+            template_name="dictionaryexport.html", context=context
+        )
+        file = f"{path}/{instance_name}_{db}.html"
+        with open(file, "w") as f:
+            f.write(data)
+        files.append(file)
+    return files
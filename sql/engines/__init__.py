@@ -1,5 +1,9 @@
 """engine base库, 包含一个``EngineBase`` class和一个get_engine函数"""
+from django.conf import settings
+
 from sql.engines.models import ResultSet, ReviewSet
+from sql.utils.connection_pool import get_pool
+from sql.utils.execute_progress import get_execute_progress
 from sql.utils.ssh_tunnel import SSHConnection
 
 
@@ -11,6 +15,8 @@ class EngineBase:
     def __init__(self, instance=None):
         self.conn = None
         self.thread_id = None
+        # 当前连接所属的连接池，为None时表示连接不是从连接池获取
+        self.pool = None
         if instance:
             self.instance = instance
             self.instance_name = instance.instance_name
@@ -36,6 +42,10 @@ class EngineBase:
                 self.host, self.port = self.ssh.get_ssh()
 
     def __del__(self):
+        # 未主动关闭的连接归还连接池，避免连接池泄漏
+        if getattr(self, "pool", None) and self.conn:
+            self.pool.release(self.conn)
+            self.conn = None
         if hasattr(self, "ssh"):
             del self.ssh
         if hasattr(self, "remotessh"):
@@ -72,6 +82,47 @@ class EngineBase:
     def get_connection(self, db_name=None):
         """返回一个conn实例"""
 
+    @property
+    def pool_enabled(self):
+        """是否使用连接池，隧道由进程共享，隧道重建后本地端口变化会重建连接池"""
+        return bool(
+            settings.ENGINE_CONNECTION_POOL.get("enable")
+            and getattr(self, "instance", None)
+            and self.instance.id
+        )
+
+    def get_pooled_connection(self, db_name, connect, ping=None, reset=None):
+        """
+        从进程内共享的连接池获取连接，连接池按照实例和库名区分
+        :param db_name: 库名
+        :param connect: 创建新连接的函数
+        :param ping: 连接健康检查函数
+        :param reset: 归还连接时重置会话状态的函数
+        :return:
+        """
+        pool_config = settings.ENGINE_CONNECTION_POOL
+        self.pool = get_pool(
+            key=(self.instance.id, db_name),
+            signature=(self.host, self.port, self.user, self.password),
+            creator=connect,
+            max_size=pool_config.get("max_size", 10),
+            idle_timeout=pool_config.get("idle_timeout", 300),
+            wait_timeout=pool_config.get("wait_timeout", 10),
+            ping=ping,
+            reset=reset,
+        )
+        return self.pool.acquire()
+
+    def release_connection(self):
+        """关闭连接，从连接池获取的连接归还连接池"""
+        if self.conn:
+            if self.pool:
+                self.pool.release(self.conn)
+            else:
+                self.conn.close()
+            self.conn = None
+            self.pool = None
+
     def test_connection(self):
         """测试实例链接是否正常"""
         return self.query(sql=self.test_query)
@@ -151,11 +202,71 @@ class EngineBase:
         """实际查询 返回一个ResultSet"""
         return ResultSet()
 
+    def query_stream(
+        self, db_name=None, sql="", limit_num=0, batch_size=1000, **kwargs
+    ):
+        """流式查询 返回一个ResultSet，rows为按批次返回数据的生成器
+        不支持服务端游标的engine直接查询全部数据，作为一个批次返回"""
+        result_set = self.query(db_name, sql, limit_num, **kwargs)
+        if not result_set.error:
+            rows = result_set.rows
+            result_set.rows = (batch for batch in [rows] if batch)
+        return result_set
+
+    def fetch_batches(
+        self, cursor, limit_num=0, batch_size=1000, first_rows=None, close_conn=True
+    ):
+        """按批次读取游标数据的生成器，读取完成后关闭游标和连接"""
+        fetched = 0
+        try:
+            if first_rows:
+                fetched += len(first_rows)
+                yield first_rows
+            while True:
+                size = (
+                    min(batch_size, int(limit_num) - fetched)
+                    if int(limit_num) > 0
+                    else batch_size
+                )
+                if size <= 0:
+                    break
+                rows = cursor.fetchmany(size)
+                if not rows:
+                    break
+                fetched += len(rows)
+                yield rows
+        finally:
+            cursor.close()
+            if close_conn:
+                self.close()
+
     def query_masking(self, db_name=None, sql="", resultset=None):
         """传入 sql语句, db名, 结果集,
         返回一个脱敏后的结果集"""
         return resultset
 
+    def query_masking_stream(self, db_name=None, sql="", resultset=None):
+        """流式查询结果脱敏, resultset.rows为按批次返回数据的生成器,
+        返回同样结构的结果集, 脱敏异常时在读取批次时抛出"""
+
+        def masked_batches(batches):
+            for rows in batches:
+                batch = ResultSet(
+                    full_sql=resultset.full_sql,
+                    rows=rows,
+                    column_list=resultset.column_list,
+                    column_type=resultset.column_type,
+                )
+                batch = self.query_masking(db_name, sql, batch)
+                if batch.error:
+                    raise RuntimeError(batch.error)
+                resultset.mask_rule_hit = resultset.mask_rule_hit or batch.mask_rule_hit
+                resultset.is_masked = resultset.is_masked or batch.is_masked
+                yield batch.rows
+
+        resultset.rows = masked_batches(resultset.rows)
+        return resultset
+
     def execute_check(self, db_name=None, sql=""):
         """执行语句的检查 返回一个ReviewSet"""
         return ReviewSet()
@@ -164,13 +275,27 @@ class EngineBase:
         """执行语句 返回一个ReviewSet"""
         return ReviewSet()
 
-    def get_execute_percentage(self):
-        """获取执行进度"""
+    def get_execute_percentage(self, workflow_id=None):
+        """获取工单执行进度，返回进度信息dict，没有进度信息时返回None"""
+        return get_execute_progress(workflow_id) if workflow_id else None
 
     def get_rollback(self, workflow):
         """获取工单回滚语句"""
         return list()
 
+    def get_rollback_page(self, workflow, offset=0, limit=None):
+        """分页获取工单回滚语句，返回 (总数, 当前页的回滚语句列表)"""
+        list_backup_sql = self.get_rollback(workflow)
+        return (
+            len(list_backup_sql),
+            list_backup_sql[offset : offset + limit if limit else None],
+        )
+
+    def iter_rollback(self, workflow):
+        """逐条获取工单回滚语句，yield ('源语句', 回滚语句迭代器)"""
+        for sql, rollback in self.get_rollback(workflow):
+            yield sql, [rollback]
+
     def get_variables(self, variables=None):
         """获取实例参数，返回一个 ResultSet"""
         return ResultSet()
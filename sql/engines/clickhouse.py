@@ -1,5 +1,6 @@
 # -*- coding: UTF-8 -*-
 from clickhouse_driver import connect
+from sql.utils.execute_progress import ExecuteProgress
 from sql.utils.sql_utils import get_syntax_type
 from .models import ResultSet, ReviewResult, ReviewSet
 from common.utils.timer import FuncTimer
@@ -411,11 +412,13 @@ class ClickHouseEngine(EngineBase):
         sqls = sqlparse.format(sql, strip_comments=True)
         sql_list = sqlparse.split(sqls)
 
+        progress = ExecuteProgress(workflow.id, len(sql_list))
         line = 1
+        # 复用同一个连接逐条执行，执行结束后关闭
         for statement in sql_list:
             with FuncTimer() as t:
                 result = self.execute(
-                    db_name=workflow.db_name, sql=statement, close_conn=True
+                    db_name=workflow.db_name, sql=statement, close_conn=False
                 )
             if not result.error:
                 execute_result.rows.append(
@@ -429,6 +432,7 @@ class ClickHouseEngine(EngineBase):
                         execute_time=t.cost,
                     )
                 )
+                progress.update(line)
                 line += 1
             else:
                 # 追加当前报错语句信息到执行结果中
@@ -460,6 +464,8 @@ class ClickHouseEngine(EngineBase):
                     )
                     line += 1
                 break
+        self.close()
+        progress.finish(success=not execute_result.error)
         return execute_result
 
     def execute(self, db_name=None, sql="", close_conn=True):
@@ -3,16 +3,23 @@ import logging
 import re
 import traceback
 import MySQLdb
+import MySQLdb.cursors
 import simplejson as json
 
 from common.config import SysConfig
 from sql.models import AliyunRdsConfig
+from sql.utils.parse_cache import cached_parse
 from sql.utils.sql_utils import get_syntax_type
 from . import EngineBase
 from .models import ResultSet, ReviewSet, ReviewResult
 
 logger = logging.getLogger("default")
 
+# 批量获取备份表名时每批的语句数量
+BACKUP_TABLE_BATCH = 500
+# 回滚语句每批读取的行数
+ROLLBACK_FETCH_SIZE = 1000
+
 
 class GoInceptionEngine(EngineBase):
     test_query = "INCEPTION GET VARIABLES"
@@ -168,6 +175,18 @@ class GoInceptionEngine(EngineBase):
         return result_set
 
     def query_print(self, instance, db_name=None, sql=""):
+        """
+        打印语法树，相同指纹的语句复用解析结果
+        """
+        return cached_parse(
+            "query_print",
+            instance,
+            db_name,
+            sql,
+            lambda: self._query_print(instance, db_name=db_name, sql=sql),
+        )
+
+    def _query_print(self, instance, db_name=None, sql=""):
         """
         打印语法树。
         """
@@ -184,6 +203,18 @@ class GoInceptionEngine(EngineBase):
         return print_info
 
     def query_data_masking(self, instance, db_name=None, sql=""):
+        """
+        将sql交给goInception打印语法树，获取select list，相同指纹的语句复用解析结果
+        """
+        return cached_parse(
+            "query_data_masking",
+            instance,
+            db_name,
+            sql,
+            lambda: self._query_data_masking(instance, db_name=db_name, sql=sql),
+        )
+
+    def _query_data_masking(self, instance, db_name=None, sql=""):
         """
         将sql交给goInception打印语法树，获取select list
         使用 masking 参数，可参考 https://github.com/hanchuanchuan/goInception/pull/355
@@ -210,63 +241,139 @@ class GoInceptionEngine(EngineBase):
         else:
             raise RuntimeError(f'Inception Error: print_info.get("errmsg")')
 
-    def get_rollback(self, workflow):
+    @staticmethod
+    def _backup_statements(workflow):
         """
-        获取回滚语句，并且按照执行顺序倒序展示，return ['源语句'，'回滚语句']
+        解析工单执行结果，按照执行顺序倒序返回存在备份的语句
+        return [(backup_db_name, opid_time, '源语句')]
         """
         list_execute_result = json.loads(
             workflow.sqlworkflowcontent.execute_result or "[]"
         )
         # 回滚语句倒序展示
         list_execute_result.reverse()
-        list_backup_sql = []
-        # 创建连接
-        conn = self.get_backup_connection()
-        cur = conn.cursor()
+        statements = []
         for row in list_execute_result:
-            try:
-                # 获取backup_db_name， 兼容旧数据'[[]]'格式
-                if isinstance(row, list):
-                    if row[8] == "None":
-                        continue
-                    backup_db_name = row[8]
-                    sequence = row[7]
-                    sql = row[5]
-                # 新数据
-                else:
-                    if row.get("backup_dbname") in ("None", ""):
-                        continue
-                    backup_db_name = row.get("backup_dbname")
-                    sequence = row.get("sequence")
-                    sql = row.get("sql")
-                # 获取备份表名
-                opid_time = sequence.replace("'", "")
-                sql_table = f"""select tablename
-                                from {backup_db_name}.$_$Inception_backup_information$_$
-                                where opid_time='{opid_time}';"""
-
-                cur.execute(sql_table)
-                list_tables = cur.fetchall()
-                if list_tables:
-                    # 获取备份语句
-                    table_name = list_tables[0][0]
-                    sql_back = f"""select rollback_statement
-                                   from {backup_db_name}.{table_name}
-                                   where opid_time='{opid_time}'"""
-                    cur.execute(sql_back)
-                    list_backup = cur.fetchall()
-                    # 拼接成回滚语句列表,['源语句'，'回滚语句']
-                    list_backup_sql.append(
-                        [sql, "\n".join([back_info[0] for back_info in list_backup])]
-                    )
-            except Exception as e:
-                logger.error(f"获取回滚语句报错，异常信息{traceback.format_exc()}")
-                raise Exception(e)
-        # 关闭连接
-        if conn:
-            conn.close()
+            # 获取backup_db_name， 兼容旧数据'[[]]'格式
+            if isinstance(row, list):
+                if row[8] == "None":
+                    continue
+                backup_db_name = row[8]
+                sequence = row[7]
+                sql = row[5]
+            # 新数据
+            else:
+                if row.get("backup_dbname") in ("None", "", None):
+                    continue
+                backup_db_name = row.get("backup_dbname")
+                sequence = row.get("sequence")
+                sql = row.get("sql")
+            statements.append((backup_db_name, sequence.replace("'", ""), sql))
+        return statements
+
+    @staticmethod
+    def _backup_tables(cur, statements):
+        """
+        按照备份库批量获取备份表名，避免每条语句单独查询一次
+        return {(backup_db_name, opid_time): tablename}
+        """
+        opid_times = {}
+        for backup_db_name, opid_time, _ in statements:
+            opid_times.setdefault(backup_db_name, []).append(opid_time)
+        tables = {}
+        for backup_db_name, opid_time_list in opid_times.items():
+            for i in range(0, len(opid_time_list), BACKUP_TABLE_BATCH):
+                batch = opid_time_list[i : i + BACKUP_TABLE_BATCH]
+                placeholders = ",".join(["%s"] * len(batch))
+                cur.execute(
+                    f"""select opid_time,tablename
+                        from {backup_db_name}.$_$Inception_backup_information$_$
+                        where opid_time in ({placeholders});""",
+                    batch,
+                )
+                for opid_time, table_name in cur.fetchall():
+                    tables.setdefault((backup_db_name, opid_time), table_name)
+        return tables
+
+    def _rollback_items(self, conn, workflow):
+        """获取存在备份表的语句列表，return [('源语句', backup_db_name, tablename, opid_time)]"""
+        statements = self._backup_statements(workflow)
+        cur = conn.cursor()
+        try:
+            tables = self._backup_tables(cur, statements)
+        finally:
+            cur.close()
+        return [
+            (sql, backup_db_name, tables[(backup_db_name, opid_time)], opid_time)
+            for backup_db_name, opid_time, sql in statements
+            if (backup_db_name, opid_time) in tables
+        ]
+
+    @staticmethod
+    def _iter_rollback_statement(conn, backup_db_name, table_name, opid_time):
+        """使用服务端游标分批读取单条语句的回滚语句，避免大事务的回滚语句一次性加载到内存"""
+        cur = conn.cursor(MySQLdb.cursors.SSCursor)
+        try:
+            cur.execute(
+                f"""select rollback_statement
+                    from {backup_db_name}.{table_name}
+                    where opid_time=%s""",
+                (opid_time,),
+            )
+            while True:
+                rows = cur.fetchmany(ROLLBACK_FETCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row[0]
+        finally:
+            cur.close()
+
+    def get_rollback(self, workflow):
+        """
+        获取回滚语句，并且按照执行顺序倒序展示，return ['源语句'，'回滚语句']
+        """
+        _, list_backup_sql = self.get_rollback_page(workflow)
         return list_backup_sql
 
+    def get_rollback_page(self, workflow, offset=0, limit=None):
+        """
+        分页获取回滚语句，按照执行顺序倒序，仅读取当前页语句的备份数据
+        return (语句总数, [['源语句'，'回滚语句']])
+        """
+        conn = self.get_backup_connection()
+        try:
+            items = self._rollback_items(conn, workflow)
+            page = items[offset : offset + limit if limit else None]
+            # 拼接成回滚语句列表,['源语句'，'回滚语句']
+            list_backup_sql = [
+                [sql, "\n".join(self._iter_rollback_statement(conn, *backup))]
+                for sql, *backup in page
+            ]
+        except Exception as e:
+            logger.error(f"获取回滚语句报错，异常信息{traceback.format_exc()}")
+            raise Exception(e)
+        finally:
+            conn.close()
+        return len(items), list_backup_sql
+
+    def iter_rollback(self, workflow):
+        """
+        逐条语句流式获取回滚语句，用于导出大工单的回滚语句
+        yield ('源语句', 回滚语句迭代器)，需要在获取下一条语句前读取完当前的回滚语句
+        """
+        conn = self.get_backup_connection()
+        try:
+            for sql, *backup in self._rollback_items(conn, workflow):
+                rollback = self._iter_rollback_statement(conn, *backup)
+                yield sql, rollback
+                rollback.close()
+        except Exception as e:
+            logger.error(f"获取回滚语句报错，异常信息{traceback.format_exc()}")
+            raise Exception(e)
+        finally:
+            conn.close()
+
     def get_variables(self, variables=None):
         """获取实例参数"""
         if variables:
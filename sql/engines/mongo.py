@@ -13,8 +13,9 @@ from bson import json_util
 from pymongo.errors import OperationFailure
 from dateutil.parser import parse
 from bson.objectid import ObjectId
-from datetime import datetime
+from datetime import datetime, timezone
 
+from sql.utils.parse_cache import LRUCache
 from . import EngineBase
 from .models import ResultSet, ReviewSet, ReviewResult
 
@@ -23,6 +24,233 @@ logger = logging.getLogger("default")
 # mongo客户端安装在本机的位置
 mongo = "mongo"
 
+# 上线单支持的命令列表
+SUPPORT_METHODS = frozenset(
+    [
+        "explain",
+        "bulkWrite",
+        "convertToCapped",
+        "createIndex",
+        "createIndexes",
+        "deleteOne",
+        "deleteMany",
+        "drop",
+        "dropIndex",
+        "dropIndexes",
+        "ensureIndex",
+        "insert",
+        "insertOne",
+        "insertMany",
+        "remove",
+        "replaceOne",
+        "renameCollection",
+        "update",
+        "updateOne",
+        "updateMany",
+        "createCollection",
+    ]
+)
+# 需要有表存在为前提的操作
+EXIST_PREMISE_METHODS = frozenset(
+    [
+        "convertToCapped",
+        "deleteOne",
+        "deleteMany",
+        "drop",
+        "dropIndex",
+        "dropIndexes",
+        "remove",
+        "replaceOne",
+        "renameCollection",
+        "update",
+        "updateOne",
+        "updateMany",
+    ]
+)
+# 影响全表的操作，审核结果需要返回文档总数
+AFFECTED_ALL_ROW_METHODS = frozenset(
+    ["drop", "dropIndex", "dropIndexes", "createIndex", "createIndexes", "ensureIndex"]
+)
+CHECK_SQL_PATTERN = re.compile(
+    r"""^db\.createCollection\(([\s\S]*)\)$|^db\.([\w\.-]+)\.(?:[A-Za-z]+)(?:\([\s\S]*\)$)|^db\.getCollection\((?:\s*)(?:'|")([\w\.-]+)('|")(\s*)\)\.([A-Za-z]+)(\([\s\S]*\)$)"""
+)
+ADJACENT_BRACE_PATTERN = re.compile(r"}(?:\s*){")
+BACKGROUND_PATTERN = re.compile(
+    r"""(['"])(?:(?!\1)background)\1(?:\s*):(?:\s*)true|background\s*:\s*true|(['"])(?:(?!\1)background)\1(?:\s*):(?:\s*)(['"])(?:(?!\2)true)\2""",
+    re.M,
+)
+RENAME_TARGET_PATTERN = re.compile(r"""renameCollection\(\s*['"]([\w\.-]+)['"]""")
+
+
+class CheckCatalog(object):
+    """
+    execute_check期间的文档信息缓存，每次审核只获取一次文档列表，文档总数按需获取一次
+    审核过程中按照createCollection、drop、renameCollection语句模拟文档的变化
+    """
+
+    def __init__(self, engine, db_name):
+        self.engine = engine
+        self.db_name = db_name
+        self.collections = set(engine.get_all_tables(db_name).rows)
+        self.counts = {}
+
+    def exists(self, name):
+        return name in self.collections
+
+    def count(self, name):
+        if name not in self.counts:
+            self.counts[name] = (
+                self.engine.get_table_conut(name, self.db_name)
+                if self.exists(name)
+                else 0
+            )
+        return self.counts[name]
+
+    def apply(self, method, name, sql):
+        """模拟语句执行后的文档变化，后续语句基于变化后的文档列表审核"""
+        if method == "createCollection":
+            self.collections.add(name)
+            self.counts[name] = 0
+        elif method == "drop":
+            self.collections.discard(name)
+            self.counts[name] = 0
+        elif method == "renameCollection":
+            m = RENAME_TARGET_PATTERN.search(sql)
+            if m:
+                self.collections.discard(name)
+                self.collections.add(m.group(1))
+                if name in self.counts:
+                    self.counts[m.group(1)] = self.counts.pop(name)
+
+
+# 查询时每批次从服务端获取的文档数
+QUERY_BATCH_SIZE = 1000
+# 表字段采样结果的缓存时间，单位秒
+COLUMNS_CACHE_TIMEOUT = 60 * 5
+_columns_cache = LRUCache(1024)
+
+
+class _Literal(str):
+    """在str(dict)中按原样显示的值，如ObjectId('...')"""
+
+    def __repr__(self):
+        return str(self)
+
+
+def _format_object_id(value):
+    return _Literal(f"ObjectId('{value}')")
+
+
+def _format_datetime(value):
+    """pymongo返回UTC时间，转换为本地时间显示，精确到毫秒"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    local = value.astimezone().replace(tzinfo=None)
+    return _Literal(local.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3])
+
+
+# 按照类型转换查询结果中的BSON值
+VALUE_FORMATTERS = {
+    ObjectId: _format_object_id,
+    datetime: _format_datetime,
+}
+# 扩展JSON格式的值，如{"$oid": "..."}、{"$date": 1594000000000}
+EXTENDED_JSON_FORMATTERS = {
+    "$oid": _format_object_id,
+    "$date": lambda v: _format_datetime(
+        datetime.fromtimestamp(v / 1000, tz=timezone.utc)
+    )
+    if isinstance(v, int)
+    else v,
+}
+
+
+def display_value(value):
+    """将BSON值转换为前端显示的值，嵌套的文档和数组递归转换"""
+    formatter = VALUE_FORMATTERS.get(type(value))
+    if formatter:
+        return formatter(value)
+    if isinstance(value, dict):
+        if len(value) == 1:
+            key = next(iter(value))
+            if key in EXTENDED_JSON_FORMATTERS:
+                return EXTENDED_JSON_FORMATTERS[key](value[key])
+        return {k: display_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [display_value(v) for v in value]
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    # 其他BSON类型使用扩展JSON格式，如Decimal128、Binary
+    try:
+        return display_value(json_util.default(value))
+    except TypeError:
+        return value
+
+
+class QueryPlan(object):
+    """
+    解析后的查询计划，直接调用pymongo执行
+    :param query_dict: parse_query_sentence的解析结果
+    :param limit_num: 最大返回行数
+    """
+
+    def __init__(self, query_dict, limit_num):
+        de = JsonDecoder()
+        self.collection = query_dict["collection"]
+        self.method = query_dict.get("method")
+        self.condition = None
+        self.projection = None
+        self.sort = None
+        self.skip = None
+        self.count = "count" in query_dict
+        self.explain = "explain" in query_dict
+        if "condition" in query_dict:
+            if self.method == "aggregate":
+                self.condition = query_dict["condition"]
+                # 给aggregate查询加limit行数限制，防止返回结果过多导致archery挂掉
+                self.condition.append({"$limit": limit_num})
+            elif self.method == "find":
+                self.condition = de.decode(query_dict["condition"])
+        if query_dict.get("projection"):
+            self.projection = de.decode(query_dict["projection"])
+        if query_dict.get("sort"):
+            self.sort = list(de.decode(query_dict["sort"]).items())
+        self.limit = limit_num
+        # 语句中指定了limit时，执行计划同样按照limit执行
+        self.explicit_limit = bool(query_dict.get("limit"))
+        if query_dict.get("limit"):
+            query_limit = int(query_dict["limit"])
+            self.limit = min(limit_num, query_limit) if query_limit else limit_num
+        if query_dict.get("skip"):
+            self.skip = int(query_dict["skip"])
+
+    @property
+    def batch_size(self):
+        return min(self.limit, QUERY_BATCH_SIZE) if self.limit else QUERY_BATCH_SIZE
+
+    def execute(self, collection):
+        if self.method == "index_information":
+            return collection.index_information()
+        if self.method == "aggregate":
+            return collection.aggregate(self.condition, batchSize=self.batch_size)
+        if self.method != "find":
+            raise Exception(f"不支持的查询方法：{self.method}")
+        # count返回符合条件的总数，不受limit和skip影响
+        if self.count:
+            return collection.count_documents(self.condition or {})
+        cursor = collection.find(
+            self.condition, self.projection, batch_size=self.batch_size
+        )
+        if self.sort:
+            cursor = cursor.sort(self.sort)
+        if self.limit and (self.explicit_limit or not self.explain):
+            cursor = cursor.limit(self.limit)
+        if self.skip:
+            cursor = cursor.skip(self.skip)
+        if self.explain:
+            return cursor.explain()
+        return cursor
+
 
 # 自定义异常
 class mongo_error(Exception):
@@ -484,6 +712,8 @@ class MongoEngine(EngineBase):
             raise Exception("提交的语句请以分号结尾")
         # 以；切分语句，逐句执行
         sp_sql = sql.split(";")
+        # 每次审核只加载一次文档信息
+        catalog = CheckCatalog(self, db_name)
         # 执行语句
         for check_sql in sp_sql:
             alert = ""  # 警告信息
@@ -491,54 +721,10 @@ class MongoEngine(EngineBase):
                 check_sql = check_sql.strip()
                 # check_sql = f'''{check_sql}'''
                 # check_sql = check_sql.replace('\n', '') #处理成一行
-                # 支持的命令列表
-                supportMethodList = [
-                    "explain",
-                    "bulkWrite",
-                    "convertToCapped",
-                    "createIndex",
-                    "createIndexes",
-                    "deleteOne",
-                    "deleteMany",
-                    "drop",
-                    "dropIndex",
-                    "dropIndexes",
-                    "ensureIndex",
-                    "insert",
-                    "insertOne",
-                    "insertMany",
-                    "remove",
-                    "replaceOne",
-                    "renameCollection",
-                    "update",
-                    "updateOne",
-                    "updateMany",
-                    "createCollection",
-                    "renameCollection",
-                ]
-                # 需要有表存在为前提的操作
-                is_exist_premise_method = [
-                    "convertToCapped",
-                    "deleteOne",
-                    "deleteMany",
-                    "drop",
-                    "dropIndex",
-                    "dropIndexes",
-                    "remove",
-                    "replaceOne",
-                    "renameCollection",
-                    "update",
-                    "updateOne",
-                    "updateMany",
-                    "renameCollection",
-                ]
-                pattern = re.compile(
-                    r"""^db\.createCollection\(([\s\S]*)\)$|^db\.([\w\.-]+)\.(?:[A-Za-z]+)(?:\([\s\S]*\)$)|^db\.getCollection\((?:\s*)(?:'|")([\w\.-]+)('|")(\s*)\)\.([A-Za-z]+)(\([\s\S]*\)$)"""
-                )
-                m = pattern.match(check_sql)
+                m = CHECK_SQL_PATTERN.match(check_sql)
                 if (
                     m is not None
-                    and (re.search(re.compile(r"}(?:\s*){"), check_sql) is None)
+                    and ADJACENT_BRACE_PATTERN.search(check_sql) is None
                     and check_sql.count("{") == check_sql.count("}")
                     and check_sql.count("(") == check_sql.count(")")
                 ):
@@ -547,8 +733,10 @@ class MongoEngine(EngineBase):
                         m.group(1) or m.group(2) or m.group(3)
                     ).strip()  # 通过正则的组拿到表名
                     table_name = table_name.replace('"', "").replace("'", "")
-                    table_names = self.get_all_tables(db_name).rows
-                    is_in = table_name in table_names  # 检查表是否存在
+                    # db.createCollection("name", {options})只取第一个参数作为表名
+                    if m.group(1):
+                        table_name = table_name.split(",")[0].strip()
+                    is_in = catalog.exists(table_name)  # 检查表是否存在
                     if not is_in:
                         alert = f"\n提示:{table_name}文档不存在!"
                     if sql_str:
@@ -574,7 +762,7 @@ class MongoEngine(EngineBase):
                             methodStr = (
                                 sql_str.split(".")[-1].split("(")[0].strip()
                             )  # 最后一个.和括号(之间的字符串作为方法
-                        if methodStr in is_exist_premise_method and not is_in:
+                        if methodStr in EXIST_PREMISE_METHODS and not is_in:
                             check_result.error = "文档不存在"
                             result = ReviewResult(
                                 id=line,
@@ -585,17 +773,13 @@ class MongoEngine(EngineBase):
                             )
                             check_result.rows += [result]
                             continue
-                        if methodStr in supportMethodList:  # 检查方法是否支持
+                        if methodStr in SUPPORT_METHODS:  # 检查方法是否支持
                             if (
                                 methodStr == "createIndex"
                                 or methodStr == "createIndexes"
                                 or methodStr == "ensureIndex"
                             ):  # 判断是否创建索引，如果大于500万，提醒不能在高峰期创建
-                                p_back = re.compile(
-                                    r"""(['"])(?:(?!\1)background)\1(?:\s*):(?:\s*)true|background\s*:\s*true|(['"])(?:(?!\1)background)\1(?:\s*):(?:\s*)(['"])(?:(?!\2)true)\2""",
-                                    re.M,
-                                )
-                                m_back = re.search(p_back, check_sql)
+                                m_back = BACKGROUND_PATTERN.search(check_sql)
                                 if m_back is None:
                                     count = 5555555
                                     check_result.warning = "创建索引请加background:true"
@@ -610,9 +794,7 @@ class MongoEngine(EngineBase):
                                 elif not is_in:
                                     count = 0
                                 else:
-                                    count = self.get_table_conut(
-                                        table_name, db_name
-                                    )  # 获得表的总条数
+                                    count = catalog.count(table_name)  # 获得表的总条数
                                     if count >= 5000000:
                                         check_result.warning = (
                                             alert + "大于500万条，请在业务低谷期创建索引"
@@ -628,20 +810,10 @@ class MongoEngine(EngineBase):
                                         )
                             if count < 5000000:
                                 # 检测通过
-                                affected_all_row_method = [
-                                    "drop",
-                                    "dropIndex",
-                                    "dropIndexes",
-                                    "createIndex",
-                                    "createIndexes",
-                                    "ensureIndex",
-                                ]
-                                if methodStr not in affected_all_row_method:
+                                if methodStr not in AFFECTED_ALL_ROW_METHODS:
                                     count = 0
                                 else:
-                                    count = self.get_table_conut(
-                                        table_name, db_name
-                                    )  # 获得表的总条数
+                                    count = catalog.count(table_name)  # 获得表的总条数
                                 result = ReviewResult(
                                     id=line,
                                     errlevel=0,
@@ -651,6 +823,7 @@ class MongoEngine(EngineBase):
                                     sql=check_sql,
                                     execute_time=0,
                                 )
+                            catalog.apply(methodStr, table_name, check_sql)
                         else:
                             result = ReviewResult(
                                 id=line,
@@ -916,68 +1089,25 @@ class MongoEngine(EngineBase):
         """执行查询"""
 
         result_set = ResultSet(full_sql=sql)
-        find_cmd = ""
 
         # 提取命令中()中的内容
         query_dict = self.parse_query_sentence(sql)
-        # 创建一个解析对象
-        de = JsonDecoder()
-
-        collection_name = query_dict["collection"]
-        if "method" in query_dict and query_dict["method"]:
-            method = query_dict["method"]
-            find_cmd = "collection." + method
-            if method == "index_information":
-                find_cmd += "()"
-        if "condition" in query_dict:
-            if method == "aggregate":
-                condition = query_dict["condition"]
-                # 给aggregate查询加limit行数限制，防止返回结果过多导致archery挂掉
-                condition.append({"$limit": limit_num})
-            if method == "find":
-                condition = de.decode(query_dict["condition"])
-            find_cmd += "(condition)"
-        if "projection" in query_dict and query_dict["projection"]:
-            projection = de.decode(query_dict["projection"])
-            find_cmd = find_cmd[:-1] + ",projection)"
-        if "sort" in query_dict and query_dict["sort"]:
-            sorting = []
-            for k, v in de.decode(query_dict["sort"]).items():
-                sorting.append((k, v))
-            find_cmd += ".sort(sorting)"
-        if (
-            method == "find"
-            and "limit" not in query_dict
-            and "explain" not in query_dict
-        ):
-            find_cmd += ".limit(limit_num)"
-        if "limit" in query_dict and query_dict["limit"]:
-            query_limit = int(query_dict["limit"])
-            limit = min(limit_num, query_limit) if query_limit else limit_num
-            find_cmd += f".limit({limit})"
-        if "skip" in query_dict and query_dict["skip"]:
-            query_skip = int(query_dict["skip"])
-            find_cmd += f".skip({query_skip})"
-        if "count" in query_dict:
-            find_cmd += ".count()"
-        if "explain" in query_dict:
-            find_cmd += ".explain()"
-
         try:
+            plan = QueryPlan(query_dict, limit_num)
+            method = plan.method
             conn = self.get_connection()
             db = conn[db_name]
-            collection = db[collection_name]
+            collection = db[plan.collection]
 
             # 执行语句
-            logger.debug(find_cmd)
-            cursor = eval(find_cmd)
+            cursor = plan.execute(collection)
 
             columns = []
             rows = []
-            if "count" in query_dict:
+            if plan.count:
                 columns.append("count")
                 rows.append({"count": cursor})
-            elif "explain" in query_dict:  # 生成执行计划数据
+            elif plan.explain:  # 生成执行计划数据
                 columns.append("explain")
                 cursor = json.loads(json_util.dumps(cursor))  # bson转换成json
                 for k, v in cursor.items():
@@ -992,7 +1122,11 @@ class MongoEngine(EngineBase):
                 columns.insert(0, "mongodballdata")
                 for ro in cursor:
                     json_col = json.dumps(
-                        ro, ensure_ascii=False, indent=2, separators=(",", ":")
+                        ro,
+                        ensure_ascii=False,
+                        indent=2,
+                        separators=(",", ":"),
+                        default=json_util.default,
                     )
                     row.insert(0, json_col)
                     for k, v in ro.items():
@@ -1004,9 +1138,9 @@ class MongoEngine(EngineBase):
                 rows = tuple(rows)
                 result_set.rows = rows
             else:
-                cursor = json.loads(json_util.dumps(cursor))
-                cols = projection if "projection" in dir() else None
-                rows, columns = self.parse_tuple(cursor, db_name, collection_name, cols)
+                rows, columns = self.parse_tuple(
+                    list(cursor), db_name, plan.collection, plan.projection
+                )
                 result_set.rows = rows
             result_set.column_list = columns
             result_set.affected_rows = len(rows)
@@ -1025,51 +1159,46 @@ class MongoEngine(EngineBase):
                 self.close()
         return result_set
 
+    def get_collection_columns(self, db_name, tb_name):
+        """采样获取表字段，结果在进程内缓存COLUMNS_CACHE_TIMEOUT秒，避免每次查询都进行采样"""
+        key = (self.instance.id, self.host, self.port, db_name, tb_name)
+        deadline, columns = _columns_cache.get(key, (0, None))
+        if columns is None or deadline < time.monotonic():
+            columns = self.get_all_columns_by_tb(db_name=db_name, tb_name=tb_name).rows
+            _columns_cache.set(key, (time.monotonic() + COLUMNS_CACHE_TIMEOUT, columns))
+        return list(columns)
+
     def parse_tuple(self, cursor, db_name, tb_name, projection=None):
         """前端bootstrap-table显示，需要转化mongo查询结果为tuple((),())的格式"""
         columns = []
         rows = []
-        row = []
         if projection:
             for k in projection.keys():
                 columns.append(k)
         else:
-            result = self.get_all_columns_by_tb(db_name=db_name, tb_name=tb_name)
-            columns = result.rows
+            columns = self.get_collection_columns(db_name, tb_name)
         columns.insert(0, "mongodballdata")  # 隐藏JSON结果列
         columns = self.fill_query_columns(cursor, columns)
 
         for ro in cursor:
-            json_col = json.dumps(
-                ro, ensure_ascii=False, indent=2, separators=(",", ":")
-            )
-            row.insert(0, json_col)
+            row = [
+                json.dumps(
+                    ro,
+                    ensure_ascii=False,
+                    indent=2,
+                    separators=(",", ":"),
+                    default=json_util.default,
+                )
+            ]
             for key in columns[1:]:
                 if key in ro:
                     value = ro[key]
                     if isinstance(value, list):
                         value = "(array) %d Elements" % len(value)
-                    re_oid = re.compile(r"{\'\$oid\': \'[0-9a-f]{24}\'}")
-                    re_date = re.compile(r"{\'\$date\': [0-9]{13}}")
-                    # 转换$oid
-                    ff = re.findall(re_oid, str(value))
-                    for ii in ff:
-                        value = str(value).replace(
-                            ii, "ObjectId(" + ii.split(":")[1].strip()[:-1] + ")"
-                        )
-                    # 转换时间戳$date
-                    dd = re.findall(re_date, str(value))
-                    for d in dd:
-                        t = int(d.split(":")[1].strip()[:-1])
-                        e = datetime.fromtimestamp(t / 1000)
-                        value = str(value).replace(
-                            d, e.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-                        )
-                    row.append(str(value))
+                    row.append(str(display_value(value)))
                 else:
                     row.append("(N/A)")
             rows.append(tuple(row))
-            row.clear()
         return tuple(rows), columns
 
     @staticmethod
@@ -13,7 +13,12 @@ from sql.engines.goinception import GoInceptionEngine
 from sql.utils.sql_utils import get_syntax_type, remove_comments
 from . import EngineBase
 from .models import ResultSet, ReviewResult, ReviewSet
-from sql.utils.data_masking import data_masking
+from sql.utils.data_masking import (
+    data_masking,
+    get_hit_columns,
+    masking_rules,
+    mask_rows,
+)
 from common.config import SysConfig
 
 logger = logging.getLogger("default")
@@ -60,35 +65,59 @@ class MysqlEngine(EngineBase):
         self.inc_engine = GoInceptionEngine()
 
     def get_connection(self, db_name=None):
-        # https://stackoverflow.com/questions/19256155/python-mysqldb-returning-x01-for-bit-values
-        conversions = MySQLdb.converters.conversions
-        conversions[FIELD_TYPE.BIT] = lambda data: data == b"\x01"
         if self.conn:
             self.thread_id = self.conn.thread_id()
             return self.conn
-        if db_name:
-            self.conn = MySQLdb.connect(
-                host=self.host,
-                port=self.port,
-                user=self.user,
-                passwd=self.password,
-                db=db_name,
-                charset=self.instance.charset or "utf8mb4",
-                conv=conversions,
-                connect_timeout=10,
+        if self.pool_enabled:
+            self.conn = self.get_pooled_connection(
+                db_name,
+                connect=lambda: self._connect(db_name),
+                ping=lambda conn: conn.ping(),
+                reset=lambda conn: self._reset_session(conn, db_name),
             )
         else:
-            self.conn = MySQLdb.connect(
+            self.conn = self._connect(db_name)
+        self.thread_id = self.conn.thread_id()
+        return self.conn
+
+    def _connect(self, db_name=None):
+        # https://stackoverflow.com/questions/19256155/python-mysqldb-returning-x01-for-bit-values
+        conversions = MySQLdb.converters.conversions
+        conversions[FIELD_TYPE.BIT] = lambda data: data == b"\x01"
+        if db_name:
+            return MySQLdb.connect(
                 host=self.host,
                 port=self.port,
                 user=self.user,
                 passwd=self.password,
+                db=db_name,
                 charset=self.instance.charset or "utf8mb4",
                 conv=conversions,
                 connect_timeout=10,
             )
-        self.thread_id = self.conn.thread_id()
-        return self.conn
+        return MySQLdb.connect(
+            host=self.host,
+            port=self.port,
+            user=self.user,
+            passwd=self.password,
+            charset=self.instance.charset or "utf8mb4",
+            conv=conversions,
+            connect_timeout=10,
+        )
+
+    @staticmethod
+    def _reset_session(conn, db_name=None):
+        """连接归还连接池前重置会话状态：未提交事务、autocommit、超时时间、当前库"""
+        conn.rollback()
+        conn.autocommit(False)
+        cursor = conn.cursor()
+        try:
+            cursor.execute("set session max_execution_time=0;")
+        except MySQLdb.OperationalError:
+            pass
+        cursor.close()
+        if db_name:
+            conn.select_db(db_name)
 
     @property
     def name(self):
@@ -260,6 +289,15 @@ class MysqlEngine(EngineBase):
         tbs = self.query(
             sql=sql_tbs, cursorclass=MySQLdb.cursors.DictCursor, close_conn=False
         ).rows
+        # 一次获取库内全部字段并按表分组，避免逐表查询INFORMATION_SCHEMA.COLUMNS
+        sql_cols = f"""SELECT * FROM INFORMATION_SCHEMA.COLUMNS
+                        WHERE TABLE_SCHEMA='{db_name}' ORDER BY TABLE_NAME, ORDINAL_POSITION;"""
+        cols = self.query(
+            sql=sql_cols, cursorclass=MySQLdb.cursors.DictCursor, close_conn=False
+        ).rows
+        tb_cols = {}
+        for col in cols:
+            tb_cols.setdefault(col["TABLE_NAME"], []).append(col)
         table_metas = []
         for tb in tbs:
             _meta = dict()
@@ -274,11 +312,7 @@ class MysqlEngine(EngineBase):
             ]
             _meta["ENGINE_KEYS"] = engine_keys
             _meta["TABLE_INFO"] = tb
-            sql_cols = f"""SELECT * FROM INFORMATION_SCHEMA.COLUMNS 
-                            WHERE TABLE_SCHEMA='{tb['TABLE_SCHEMA']}' AND TABLE_NAME='{tb['TABLE_NAME']}';"""
-            _meta["COLUMNS"] = self.query(
-                sql=sql_cols, cursorclass=MySQLdb.cursors.DictCursor, close_conn=False
-            ).rows
+            _meta["COLUMNS"] = tb_cols.get(tb["TABLE_NAME"], [])
             table_metas.append(_meta)
         return table_metas
 
@@ -361,6 +395,36 @@ class MysqlEngine(EngineBase):
                 self.close()
         return result_set
 
+    def query_stream(
+        self, db_name=None, sql="", limit_num=0, batch_size=1000, **kwargs
+    ):
+        """使用服务端游标流式查询，返回 ResultSet，rows为按批次返回数据的生成器"""
+        result_set = ResultSet(full_sql=sql)
+        max_execution_time = kwargs.get("max_execution_time", 0)
+        try:
+            conn = self.get_connection(db_name=db_name)
+            conn.autocommit(True)
+            cursor = conn.cursor()
+            try:
+                cursor.execute(f"set session max_execution_time={max_execution_time};")
+            except MySQLdb.OperationalError:
+                pass
+            cursor.close()
+            cursor = conn.cursor(MySQLdb.cursors.SSCursor)
+            cursor.execute(sql)
+            fields = cursor.description
+            result_set.column_list = [i[0] for i in fields] if fields else []
+            result_set.column_type = (
+                [column_types_map.get(i[1], "") for i in fields] if fields else []
+            )
+        except Exception as e:
+            logger.warning(f"MySQL语句执行报错，语句：{sql}，错误信息{traceback.format_exc()}")
+            result_set.error = str(e)
+            self.close()
+            return result_set
+        result_set.rows = self.fetch_batches(cursor, limit_num, batch_size)
+        return result_set
+
     def query_check(self, db_name=None, sql=""):
         # 查询语句的检查、注释去除、切分
         result = {"msg": "", "bad_query": False, "filtered_sql": sql, "has_star": False}
@@ -439,6 +503,20 @@ class MysqlEngine(EngineBase):
             mask_result = resultset
         return mask_result
 
+    def query_masking_stream(self, db_name=None, sql="", resultset=None):
+        """流式查询结果脱敏，语法解析只执行一次，之后按批次脱敏"""
+        if not re.match(r"^select", sql, re.I):
+            return resultset
+        hit_columns = get_hit_columns(self.instance, db_name, sql)
+        resultset.mask_rule_hit = True if hit_columns else False
+        if hit_columns:
+            rules = masking_rules()
+            resultset.rows = (
+                mask_rows(rows, hit_columns, rules) for rows in resultset.rows
+            )
+            resultset.is_masked = True
+        return resultset
+
     def execute_check(self, db_name=None, sql=""):
         """上线单执行前的检查, 返回Review set"""
         # 进行Inception检查，获取检测结果
@@ -527,6 +605,16 @@ class MysqlEngine(EngineBase):
         inception_engine = GoInceptionEngine()
         return inception_engine.get_rollback(workflow)
 
+    def get_rollback_page(self, workflow, offset=0, limit=None):
+        """通过inception分页获取回滚语句列表"""
+        inception_engine = GoInceptionEngine()
+        return inception_engine.get_rollback_page(workflow, offset, limit)
+
+    def iter_rollback(self, workflow):
+        """通过inception逐条获取回滚语句"""
+        inception_engine = GoInceptionEngine()
+        return inception_engine.iter_rollback(workflow)
+
     def get_variables(self, variables=None):
         """获取实例参数"""
         if variables:
@@ -729,6 +817,4 @@ class MysqlEngine(EngineBase):
         return self.query("information_schema", sql)
 
     def close(self):
-        if self.conn:
-            self.conn.close()
-            self.conn = None
+        self.release_connection()
@@ -1,5 +1,6 @@
 # -*- coding: UTF-8 -*-
 # https://stackoverflow.com/questions/7942520/relationship-between-catalog-schema-user-and-database-instance
+import bisect
 import logging
 import traceback
 import re
@@ -22,6 +23,11 @@ from sql.utils.data_masking import simple_column_mask
 
 logger = logging.getLogger("default")
 
+# 备份时每次从v$logmnr_contents获取的行数
+BACKUP_FETCH_SIZE = 1000
+# 回滚语句每批次写入备份库的行数
+BACKUP_INSERT_BATCH = 500
+
 
 class OracleEngine(EngineBase):
     test_query = "SELECT 1 FROM DUAL"
@@ -345,6 +351,11 @@ class OracleEngine(EngineBase):
 
         # 获得表名称去重
         col_list = cols_df.drop_duplicates("TABLE_NAME").to_dict("records")
+        # 一次按表名分组，避免逐表过滤DataFrame
+        tb_cols = {
+            table_name: group.to_dict("records")
+            for table_name, group in cols_df.groupby("TABLE_NAME", sort=False)
+        }
         for cl in col_list:
             _meta = dict()
             engine_keys = [
@@ -360,11 +371,7 @@ class OracleEngine(EngineBase):
                 "TABLE_NAME": cl["TABLE_NAME"],
                 "TABLE_COMMENTS": cl["TABLE_COMMENTS"],
             }
-            table_name = cl["TABLE_NAME"]
-            # 查询DataFrame中满足表名的记录，并转为list
-            _meta["COLUMNS"] = cols_df.query("TABLE_NAME == @table_name").to_dict(
-                "records"
-            )
+            _meta["COLUMNS"] = tb_cols.get(cl["TABLE_NAME"], [])
 
             table_metas.append(_meta)
         return table_metas
@@ -1052,6 +1059,8 @@ class OracleEngine(EngineBase):
             cursor.execute(f"select sysdate from dual")
             rows = cursor.fetchone()
             begin_time = rows[0]
+            # 每条语句执行后的SCN，用于备份时将回滚语句对应到执行的语句
+            statement_scns = [] if workflow.is_backup else None
             # 逐条执行切分语句，追加到执行结果中
             for sqlitem in sqlitemList:
                 statement = sqlitem.statement
@@ -1066,7 +1075,9 @@ class OracleEngine(EngineBase):
                     and owner='{workflow.db_name}'
                                         """
                     cursor.execute(back_obj_sql)
-                    metdata_back_flag = self.metdata_backup(workflow, cursor, statement)
+                    metdata_back_flag = self.metdata_backup(
+                        workflow, cursor, statement, statement_id=line
+                    )
 
                 with FuncTimer() as t:
                     if statement != "":
@@ -1120,6 +1131,8 @@ class OracleEngine(EngineBase):
                         execute_time=t.cost,
                     )
                 )
+                if statement_scns is not None:
+                    statement_scns = self._current_scn(cursor, statement_scns, line)
                 line += 1
         except Exception as e:
             logger.warning(
@@ -1166,6 +1179,7 @@ class OracleEngine(EngineBase):
                         cursor=cursor,
                         begin_time=begin_time,
                         end_time=end_time,
+                        statement_scns=statement_scns,
                     )
                 except Exception as e:
                     logger.error(
@@ -1175,35 +1189,80 @@ class OracleEngine(EngineBase):
                 self.close()
         return execute_result
 
-    def backup(self, workflow, cursor, begin_time, end_time):
+    @staticmethod
+    def _current_scn(cursor, statement_scns, line):
+        """
+        记录语句执行后的SCN，需要有select on v$database权限
+        获取失败时返回None，回滚语句不再对应到语句
+        """
+        try:
+            cursor.execute("select current_scn from v$database")
+            statement_scns.append((int(cursor.fetchone()[0]), line))
+            return statement_scns
+        except Exception as e:
+            logger.warning(f"获取Oracle SCN失败，回滚语句将不对应到执行语句，错误信息{e}")
+            return None
+
+    @staticmethod
+    def _init_backup_table(backup_cursor):
+        """
+        初始化备份库和备份表，table存放备份SQL，记录使用workflow.id关联上线工单，statement_id关联执行的语句
+        """
+        backup_cursor.execute(f"""create database if not exists ora_backup;""")
+        backup_cursor.execute(f"use ora_backup;")
+        backup_cursor.execute(
+            f"""CREATE TABLE if not exists `sql_rollback` (
+                                   `id` bigint(20) NOT NULL AUTO_INCREMENT,
+                                   `redo_sql` mediumtext,
+                                   `undo_sql` mediumtext,
+                                   `workflow_id` bigint(20) NOT NULL,
+                                   `statement_id` int NOT NULL DEFAULT 0,
+                                    PRIMARY KEY (`id`),
+                                    key `idx_sql_rollback_01` (`workflow_id`),
+                                    key `idx_sql_rollback_02` (`workflow_id`, `statement_id`)
+                                 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;"""
+        )
+        # 兼容旧版本创建的备份表
+        backup_cursor.execute(
+            """select count(*) from information_schema.COLUMNS
+               where TABLE_SCHEMA='ora_backup' and TABLE_NAME='sql_rollback' and COLUMN_NAME='statement_id';"""
+        )
+        if not backup_cursor.fetchone()[0]:
+            backup_cursor.execute(
+                """alter table sql_rollback
+                   add column `statement_id` int NOT NULL DEFAULT 0 after `workflow_id`,
+                   add key `idx_sql_rollback_02` (`workflow_id`, `statement_id`);"""
+            )
+
+    @staticmethod
+    def _insert_rollback(backup_cursor, rows):
+        backup_cursor.executemany(
+            """insert into sql_rollback(redo_sql,undo_sql,workflow_id,statement_id)
+               values(%s,%s,%s,%s)""",
+            rows,
+        )
+
+    def backup(self, workflow, cursor, begin_time, end_time, statement_scns=None):
         """
         :param workflow: 工单对象，作为备份记录与工单的关联列
         :param cursor: 执行SQL的当前会话游标
         :param begin_time: 执行SQL开始时间
         :param end_time: 执行SQL结束时间
+        :param statement_scns: 每条语句执行后的SCN，[(scn, 语句序号)]，为空时回滚语句不对应到语句
         :return:
         """
         # add Jan.song 2020402
         # 生成回滚SQL,执行用户需要有grant select any transaction to 权限，需要有grant execute on dbms_logmnr to权限
         # 数据库需开启最小化附加日志alter database add supplemental log data;
         # 需为归档模式;开启附件日志会增加redo日志量,一般不会有多大影响，需评估归档磁盘空间，redo磁盘IO性能
+        conn = None
         try:
-            # 备份存放数据库和MySQL备份库统一，需新建备份用database和table，table存放备份SQL，记录使用workflow.id关联上线工单
             workflow_id = workflow.id
             conn = self.get_backup_connection()
             backup_cursor = conn.cursor()
-            backup_cursor.execute(f"""create database if not exists ora_backup;""")
-            backup_cursor.execute(f"use ora_backup;")
-            backup_cursor.execute(
-                f"""CREATE TABLE if not exists `sql_rollback` (
-                                       `id` bigint(20) NOT NULL AUTO_INCREMENT,
-                                       `redo_sql` mediumtext,
-                                       `undo_sql` mediumtext,
-                                       `workflow_id` bigint(20) NOT NULL,
-                                        PRIMARY KEY (`id`),
-                                        key `idx_sql_rollback_01` (`workflow_id`)
-                                     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;"""
-            )
+            self._init_backup_table(backup_cursor)
+            scns = [scn for scn, _ in statement_scns or []]
+            lines = [line for _, line in statement_scns or []]
             # 使用logminer抓取回滚SQL
             logmnr_start_sql = f"""begin
                                         dbms_logmnr.start_logmnr(
@@ -1211,33 +1270,59 @@ class OracleEngine(EngineBase):
                                         endtime=>to_date('{end_time}','yyyy/mm/dd hh24:mi:ss'),
                                         options=>dbms_logmnr.dict_from_online_catalog + dbms_logmnr.continuous_mine);
                                     end;"""
-            undo_sql = f"""select 
-                           xmlagg(xmlparse(content sql_redo wellformed)  order by  scn,rs_id,ssn,rownum).getclobval() ,
-                           xmlagg(xmlparse(content sql_undo wellformed)  order by  scn,rs_id,ssn,rownum).getclobval() 
+            # 超过4000字节的语句会拆分为多行，按照(scn,rs_id,ssn)分组拼接，倒序写入，回滚时按照id顺序执行
+            undo_sql = f"""select scn, rs_id, ssn, sql_redo, sql_undo from (
+                           select scn, rs_id, ssn, sql_redo, sql_undo, rownum rn
                            from v$logmnr_contents
                            where  SEG_OWNER not in ('SYS')
                            and session# = (select sid from v$mystat where rownum = 1)
-                           and serial# = (select serial# from v$session s where s.sid = (select sid from v$mystat where rownum = 1 ))  
-                           group by  scn,rs_id,ssn  order by scn desc"""
+                           and serial# = (select serial# from v$session s where s.sid = (select sid from v$mystat where rownum = 1 )))
+                           order by scn desc, rs_id desc, ssn desc, rn"""
             logmnr_end_sql = f"""begin
                                     dbms_logmnr.end_logmnr;
                                  end;"""
             cursor.execute(logmnr_start_sql)
-            cursor.execute(undo_sql)
-            rows = cursor.fetchall()
-            cursor.execute(logmnr_end_sql)
-            if len(rows) > 0:
-                for row in rows:
-                    redo_sql = f"{row[0]}"
-                    redo_sql = redo_sql.replace("'", "\\'")
-                    if row[1] is None:
-                        undo_sql = f" "
-                    else:
-                        undo_sql = f"{row[1]}"
-                    undo_sql = undo_sql.replace("'", "\\'")
-                    # 回滚SQL入库
-                    sql = f"""insert into sql_rollback(redo_sql,undo_sql,workflow_id) values('{redo_sql}','{undo_sql}',{workflow_id});"""
-                    backup_cursor.execute(sql)
+            try:
+                cursor.arraysize = BACKUP_FETCH_SIZE
+                cursor.execute(undo_sql)
+                batch = []
+                group_key = None
+                redo_parts, undo_parts = [], []
+
+                def add_group():
+                    scn = int(group_key[0])
+                    index = bisect.bisect_left(scns, scn)
+                    statement_id = lines[index] if index < len(lines) else 0
+                    batch.append(
+                        (
+                            "".join(redo_parts),
+                            "".join(undo_parts) or " ",
+                            workflow_id,
+                            statement_id,
+                        )
+                    )
+
+                while True:
+                    rows = cursor.fetchmany(BACKUP_FETCH_SIZE)
+                    if not rows:
+                        break
+                    for scn, rs_id, ssn, redo, undo in rows:
+                        key = (scn, rs_id, ssn)
+                        if group_key is not None and key != group_key:
+                            add_group()
+                            redo_parts, undo_parts = [], []
+                            if len(batch) >= BACKUP_INSERT_BATCH:
+                                self._insert_rollback(backup_cursor, batch)
+                                batch = []
+                        group_key = key
+                        redo_parts.append(redo or "")
+                        undo_parts.append(undo or "")
+                if group_key is not None:
+                    add_group()
+                if batch:
+                    self._insert_rollback(backup_cursor, batch)
+            finally:
+                cursor.execute(logmnr_end_sql)
         except Exception as e:
             logger.warning(f"备份失败，错误信息{traceback.format_exc()}")
             return False
@@ -1247,41 +1332,31 @@ class OracleEngine(EngineBase):
                 conn.close()
         return True
 
-    def metdata_backup(self, workflow, cursor, redo_sql):
+    def metdata_backup(self, workflow, cursor, redo_sql, statement_id=0):
         """
         :param workflow: 工单对象，作为备份记录与工单的关联列
         :param cursor: 执行SQL的当前会话游标，保存metadata
         :param redo_sql: 执行的SQL
+        :param statement_id: 执行语句的序号
         :return:
         """
+        conn = None
         try:
-            # 备份存放数据库和MySQL备份库统一，需新建备份用database和table，table存放备份SQL，记录使用workflow.id关联上线工单
             workflow_id = workflow.id
             conn = self.get_backup_connection()
             backup_cursor = conn.cursor()
-            backup_cursor.execute(f"""create database if not exists ora_backup;""")
-            backup_cursor.execute(f"use ora_backup;")
-            backup_cursor.execute(
-                f"""CREATE TABLE if not exists `sql_rollback` (
-                                       `id` bigint(20) NOT NULL AUTO_INCREMENT,
-                                       `redo_sql` mediumtext,
-                                       `undo_sql` mediumtext,
-                                       `workflow_id` bigint(20) NOT NULL,
-                                        PRIMARY KEY (`id`),
-                                        key `idx_sql_rollback_01` (`workflow_id`)
-                                     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;"""
-            )
-            rows = cursor.fetchall()
-            if len(rows) > 0:
-                for row in rows:
-                    if row[0] is None:
-                        undo_sql = f" "
-                    else:
-                        undo_sql = f"{row[0]}"
-                    undo_sql = undo_sql.replace("'", "\\'")
-                    # 回滚SQL入库
-                    sql = f"""insert into sql_rollback(redo_sql,undo_sql,workflow_id) values('{redo_sql}','{undo_sql}',{workflow_id});"""
-                    backup_cursor.execute(sql)
+            self._init_backup_table(backup_cursor)
+            rows = [
+                (
+                    redo_sql,
+                    " " if row[0] is None else f"{row[0]}",
+                    workflow_id,
+                    statement_id,
+                )
+                for row in cursor.fetchall()
+            ]
+            if rows:
+                self._insert_rollback(backup_cursor, rows)
         except Exception as e:
             logger.warning(f"备份失败，错误信息{traceback.format_exc()}")
             return False
@@ -1304,7 +1379,9 @@ class OracleEngine(EngineBase):
             # 创建连接
             conn = self.get_backup_connection()
             cur = conn.cursor()
-            sql = f"""select redo_sql,undo_sql from sql_rollback where workflow_id = {workflow.id} order by id;"""
+            # 按照语句倒序回滚，同一条语句内按照写入顺序(已按SCN倒序)
+            sql = f"""select redo_sql,undo_sql from sql_rollback where workflow_id = {workflow.id}
+                      order by statement_id desc, id;"""
             cur.execute(f"use ora_backup;")
             cur.execute(sql)
             list_tables = cur.fetchall()
@@ -1321,6 +1398,37 @@ class OracleEngine(EngineBase):
             conn.close()
         return list_backup_sql
 
+    def get_rollback_page(self, workflow, offset=0, limit=None):
+        """
+        分页获取回滚语句，return (总数, [['源语句'，'回滚语句']])
+        按照执行语句倒序分页，后执行的语句先回滚，使用(workflow_id, statement_id)索引
+        """
+        conn = None
+        try:
+            conn = self.get_backup_connection()
+            cur = conn.cursor()
+            cur.execute(f"use ora_backup;")
+            cur.execute(
+                "select count(*) from sql_rollback where workflow_id = %s;",
+                (workflow.id,),
+            )
+            total = cur.fetchone()[0]
+            sql = """select redo_sql,undo_sql from sql_rollback where workflow_id = %s
+                     order by statement_id desc, id"""
+            args = [workflow.id]
+            if limit:
+                sql += " limit %s offset %s"
+                args += [limit, offset]
+            cur.execute(sql, args)
+            list_backup_sql = [[row[0], row[1]] for row in cur.fetchall()]
+        except Exception as e:
+            logger.error(f"获取回滚语句报错，异常信息{traceback.format_exc()}")
+            raise Exception(e)
+        finally:
+            if conn:
+                conn.close()
+        return total, list_backup_sql
+
     def sqltuningadvisor(self, db_name=None, sql="", close_conn=True, **kwargs):
         """
         add by Jan.song 20200421
@@ -6,6 +6,7 @@
 @time: 2019/03/29
 """
 import re
+import uuid
 import psycopg2
 import logging
 import traceback
@@ -13,6 +14,7 @@ import sqlparse
 
 from common.config import SysConfig
 from common.utils.timer import FuncTimer
+from sql.utils.execute_progress import ExecuteProgress
 from sql.utils.sql_utils import get_syntax_type
 from . import EngineBase
 from .models import ResultSet, ReviewSet, ReviewResult
@@ -30,7 +32,19 @@ class PgSQLEngine(EngineBase):
         db_name = db_name or self.db_name or "postgres"
         if self.conn:
             return self.conn
-        self.conn = psycopg2.connect(
+        if self.pool_enabled:
+            self.conn = self.get_pooled_connection(
+                db_name,
+                connect=lambda: self._connect(db_name),
+                ping=self._ping,
+                reset=self._reset_session,
+            )
+        else:
+            self.conn = self._connect(db_name)
+        return self.conn
+
+    def _connect(self, db_name):
+        return psycopg2.connect(
             host=self.host,
             port=self.port,
             user=self.user,
@@ -38,7 +52,25 @@ class PgSQLEngine(EngineBase):
             dbname=db_name,
             connect_timeout=10,
         )
-        return self.conn
+
+    @staticmethod
+    def _ping(conn):
+        """连接健康检查"""
+        if conn.closed:
+            raise psycopg2.InterfaceError("connection already closed")
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1;")
+        cursor.close()
+        conn.rollback()
+
+    @staticmethod
+    def _reset_session(conn):
+        """连接归还连接池前重置会话状态：未提交事务、statement_timeout、search_path等"""
+        conn.rollback()
+        cursor = conn.cursor()
+        cursor.execute("RESET ALL;")
+        cursor.close()
+        conn.commit()
 
     @property
     def name(self):
@@ -197,6 +229,43 @@ class PgSQLEngine(EngineBase):
                 self.close()
         return result_set
 
+    def query_stream(
+        self, db_name=None, sql="", limit_num=0, batch_size=1000, **kwargs
+    ):
+        """使用服务端命名游标流式查询，返回 ResultSet，rows为按批次返回数据的生成器"""
+        schema_name = kwargs.get("schema_name")
+        result_set = ResultSet(full_sql=sql)
+        try:
+            conn = self.get_connection(db_name=db_name)
+            max_execution_time = kwargs.get("max_execution_time", 0)
+            cursor = conn.cursor()
+            try:
+                cursor.execute(f"SET statement_timeout TO {max_execution_time};")
+            except:
+                pass
+            if schema_name:
+                cursor.execute(f"SET search_path TO {schema_name};")
+            cursor.close()
+            # 命名游标的字段信息在第一次获取数据后才可用
+            cursor = conn.cursor(name=f"archery_stream_{uuid.uuid4().hex}")
+            cursor.itersize = batch_size
+            cursor.execute(sql)
+            first_size = (
+                min(batch_size, int(limit_num)) if int(limit_num) > 0 else batch_size
+            )
+            first_rows = cursor.fetchmany(first_size)
+            fields = cursor.description
+            result_set.column_list = [i[0] for i in fields] if fields else []
+        except Exception as e:
+            logger.warning(f"PgSQL命令执行报错，语句：{sql}， 错误信息：{traceback.format_exc()}")
+            result_set.error = str(e)
+            self.close()
+            return result_set
+        result_set.rows = self.fetch_batches(
+            cursor, limit_num, batch_size, first_rows=first_rows
+        )
+        return result_set
+
     def filter_sql(self, sql="", limit_num=0):
         # 对查询sql增加limit限制，# TODO limit改写待优化
         sql_lower = sql.lower().rstrip(";").strip()
@@ -269,15 +338,34 @@ class PgSQLEngine(EngineBase):
                 check_result.error_count += 1
         return check_result
 
+    @staticmethod
+    def _execute_batch_size():
+        """获取DML分批提交的批次大小，配置错误时逐条提交"""
+        value = SysConfig().get("execute_batch_size")
+        try:
+            return max(1, int(value or 1))
+        except (TypeError, ValueError):
+            logger.warning(f"execute_batch_size配置错误：{value}，逐条提交")
+            return 1
+
     def execute_workflow(self, workflow, close_conn=True):
-        """执行上线单，返回Review set"""
+        """
+        执行上线单，返回Review set
+        复用同一个连接逐条执行，连续的DML语句按照execute_batch_size分批提交，其他语句单独提交
+        批次内语句执行失败时整个批次回滚，执行结果中标记已回滚的语句
+        """
         sql = workflow.sqlworkflowcontent.sql_content
         execute_result = ReviewSet(full_sql=sql)
         # 删除注释语句，切分语句，将切换CURRENT_SCHEMA语句增加到切分结果中
         sql = sqlparse.format(sql, strip_comments=True)
         split_sql = sqlparse.split(sql)
+        batch_size = self._execute_batch_size()
+        progress = ExecuteProgress(workflow.id, len(split_sql))
         line = 1
+        # 当前批次内已执行但未提交的语句数
+        pending = 0
         statement = None
+        conn = None
         db_name = workflow.db_name
         try:
             conn = self.get_connection(db_name=db_name)
@@ -285,9 +373,18 @@ class PgSQLEngine(EngineBase):
             # 逐条执行切分语句，追加到执行结果中
             for statement in split_sql:
                 statement = statement.rstrip(";")
+                batch = batch_size > 1 and get_syntax_type(statement) == "DML"
+                # 非DML语句执行前先提交当前批次
+                if pending and not batch:
+                    conn.commit()
+                    pending = 0
                 with FuncTimer() as t:
                     cursor.execute(statement)
-                    conn.commit()
+                    committed = (
+                        not batch or pending + 1 >= batch_size or line == len(split_sql)
+                    )
+                    if committed:
+                        conn.commit()
                 execute_result.rows.append(
                     ReviewResult(
                         id=line,
@@ -299,12 +396,26 @@ class PgSQLEngine(EngineBase):
                         execute_time=t.cost,
                     )
                 )
+                pending = 0 if committed else pending + 1
+                progress.update(line)
                 line += 1
+            progress.finish(success=True)
         except Exception as e:
             logger.warning(
                 f"PGSQL命令执行报错，语句：{statement or sql}， 错误信息：{traceback.format_exc()}"
             )
             execute_result.error = str(e)
+            try:
+                if conn:
+                    conn.rollback()
+            except Exception:
+                pass
+            # 当前批次内执行成功的语句已随批次回滚
+            for row in execute_result.rows[-pending:] if pending else []:
+                row.errlevel = 2
+                row.stagestatus = "Execute Rollback"
+                row.errormessage = "同批次语句执行失败，已回滚"
+                row.affected_rows = 0
             # 追加当前报错语句信息到执行结果中
             execute_result.rows.append(
                 ReviewResult(
@@ -332,12 +443,11 @@ class PgSQLEngine(EngineBase):
                     )
                 )
                 line += 1
+            progress.finish(success=False)
         finally:
             if close_conn:
                 self.close()
         return execute_result
 
     def close(self):
-        if self.conn:
-            self.conn.close()
-            self.conn = None
+        self.release_connection()
@@ -4,8 +4,9 @@ from datetime import timedelta, datetime
 from unittest.mock import patch, Mock, ANY
 
 import sqlparse
+from bson.objectid import ObjectId
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.test import TestCase, override_settings
 
 from common.config import SysConfig
 from sql.engines import EngineBase
@@ -20,6 +21,8 @@ from sql.engines.mongo import MongoEngine
 from sql.engines.clickhouse import ClickHouseEngine
 from sql.engines.odps import ODPSEngine
 from sql.models import Instance, SqlWorkflow, SqlWorkflowContent
+from sql.utils.connection_pool import close_pools
+from sql.utils.parse_cache import bump_schema_version
 
 User = get_user_model()
 
@@ -285,6 +288,19 @@ class TestMysql(TestCase):
         new_engine.get_connection()
         connect.assert_called_once()
 
+    @override_settings(ENGINE_CONNECTION_POOL={"enable": True})
+    @patch("MySQLdb.connect")
+    def test_get_connection_from_pool(self, connect):
+        for _ in range(2):
+            new_engine = MysqlEngine(instance=self.ins1)
+            new_engine.get_connection(db_name="some_db")
+            new_engine.close()
+        connect.assert_called_once()
+        connect.return_value.close.assert_not_called()
+        connect.return_value.rollback.assert_called()
+        connect.return_value.select_db.assert_called_with("some_db")
+        close_pools()
+
     @patch("MySQLdb.connect")
     def testQuery(self, connect):
         cur = Mock()
@@ -302,6 +318,30 @@ class TestMysql(TestCase):
         connect.return_value.close.assert_called_once()
         self.assertIsInstance(query_result, ResultSet)
 
+    @patch("MySQLdb.connect")
+    def test_query_stream(self, connect):
+        cur = Mock()
+        connect.return_value.cursor = cur
+        cur.return_value.fetchmany.side_effect = [
+            (("v1", "v2"), ("v3", "v4")),
+            (("v5", "v6"),),
+        ]
+        cur.return_value.description = (
+            ("k1", "some_other_des"),
+            ("k2", "some_other_des"),
+        )
+        new_engine = MysqlEngine(instance=self.ins1)
+        query_result = new_engine.query_stream(
+            sql="some_str", limit_num=3, batch_size=2
+        )
+        self.assertEqual(query_result.column_list, ["k1", "k2"])
+        connect.return_value.close.assert_not_called()
+        batches = list(query_result.rows)
+        self.assertEqual(batches, [(("v1", "v2"), ("v3", "v4")), (("v5", "v6"),)])
+        cur.assert_called_with(MySQLdb.cursors.SSCursor)
+        self.assertEqual(cur.return_value.fetchmany.call_args_list[1][0][0], 1)
+        connect.return_value.close.assert_called_once()
+
     @patch.object(MysqlEngine, "query")
     def testAllDb(self, mock_query):
         db_result = ResultSet()
@@ -321,6 +361,27 @@ class TestMysql(TestCase):
         mock_query.assert_called_once_with(db_name="some_db", sql=ANY)
         self.assertEqual(tables.rows, ["tb_1", "tb_2"])
 
+    @patch.object(MysqlEngine, "query")
+    def test_get_tables_metas_data(self, mock_query):
+        """一次查询获取库内全部字段，按表分组"""
+        mock_query.side_effect = [
+            ResultSet(rows=({"TABLE_NAME": "tb_1"}, {"TABLE_NAME": "tb_2"})),
+            ResultSet(
+                rows=(
+                    {"TABLE_NAME": "tb_1", "COLUMN_NAME": "id"},
+                    {"TABLE_NAME": "tb_1", "COLUMN_NAME": "name"},
+                    {"TABLE_NAME": "tb_2", "COLUMN_NAME": "id"},
+                )
+            ),
+        ]
+        new_engine = MysqlEngine(instance=self.ins1)
+        table_metas = new_engine.get_tables_metas_data("some_db")
+        self.assertEqual(mock_query.call_count, 2)
+        self.assertEqual(
+            [[c["COLUMN_NAME"] for c in t["COLUMNS"]] for t in table_metas],
+            [["id", "name"], ["id"]],
+        )
+
     @patch.object(MysqlEngine, "query")
     def testAllColumns(self, mock_query):
         db_result = ResultSet()
@@ -1099,6 +1160,60 @@ class TestPgSQL(TestCase):
                 execute_result.rows[0].__dict__.keys(), row.__dict__.keys()
             )
 
+    @patch("sql.engines.pgsql.PgSQLEngine.get_connection")
+    def test_execute_workflow_batch(self, _conn):
+        """连续DML分批提交，批次内语句失败时整个批次回滚"""
+        self.sys_config.set("execute_batch_size", "2")
+        self.addCleanup(self.sys_config.set, "execute_batch_size", "")
+        sql = "create table t(id int);insert into t values(1);insert into t values(2);insert into t values(3);insert into t values('x');update t set id=1;"
+        wf = SqlWorkflow.objects.create(
+            workflow_name="some_name",
+            group_id=1,
+            group_name="g1",
+            engineer_display="",
+            audit_auth_groups="some_group",
+            create_time=datetime.now() - timedelta(days=1),
+            status="workflow_executing",
+            is_backup=False,
+            instance=self.ins,
+            db_name="some_db",
+            syntax_type=2,
+        )
+        SqlWorkflowContent.objects.create(workflow=wf, sql_content=sql)
+        cursor = _conn.return_value.cursor.return_value
+        cursor.execute.side_effect = [None, None, None, None, RuntimeError("bad")]
+        new_engine = PgSQLEngine(instance=self.ins)
+        execute_result = new_engine.execute_workflow(workflow=wf)
+        # DDL单独提交，前两条insert作为一个批次提交，第三条insert随失败的批次回滚
+        self.assertEqual(_conn.return_value.commit.call_count, 2)
+        _conn.return_value.rollback.assert_called_once()
+        self.assertEqual(
+            [row.stagestatus for row in execute_result.rows],
+            [
+                "Execute Successfully",
+                "Execute Successfully",
+                "Execute Successfully",
+                "Execute Rollback",
+                "Execute Failed",
+                "Audit completed",
+            ],
+        )
+        self.assertEqual(execute_result.error, "bad")
+        progress = new_engine.get_execute_percentage(workflow_id=wf.id)
+        self.assertEqual(progress["state"], "failed")
+        self.assertEqual(progress["total"], 6)
+        self.assertEqual(progress["executed"], 4)
+
+    def test_execute_batch_size(self):
+        """批次大小配置错误时逐条提交"""
+        self.addCleanup(self.sys_config.set, "execute_batch_size", "")
+        self.sys_config.set("execute_batch_size", "abc")
+        self.assertEqual(PgSQLEngine._execute_batch_size(), 1)
+        self.sys_config.set("execute_batch_size", "-5")
+        self.assertEqual(PgSQLEngine._execute_batch_size(), 1)
+        self.sys_config.set("execute_batch_size", "100")
+        self.assertEqual(PgSQLEngine._execute_batch_size(), 100)
+
 
 class TestModel(TestCase):
     def setUp(self):
@@ -1168,6 +1283,47 @@ class TestGoInception(TestCase):
         new_engine.get_connection()
         _connect.assert_called_once()
 
+    @patch("sql.engines.goinception.GoInceptionEngine._query_data_masking")
+    def test_query_data_masking_cached(self, _query_data_masking):
+        """相同指纹的语句复用解析结果，DDL工单执行后重新解析"""
+        _query_data_masking.return_value = [{"index": 0, "field": "phone"}]
+        new_engine = GoInceptionEngine()
+        bump_schema_version(self.ins.id)
+        for sql in [
+            "select phone from users where id=1",
+            "select phone from users where id=2",
+        ]:
+            r = new_engine.query_data_masking(
+                instance=self.ins, db_name="some_db", sql=sql
+            )
+            self.assertEqual(r, [{"index": 0, "field": "phone"}])
+        _query_data_masking.assert_called_once()
+        # 不同的库需要重新解析
+        new_engine.query_data_masking(
+            instance=self.ins, db_name="other_db", sql="select phone from users"
+        )
+        self.assertEqual(_query_data_masking.call_count, 2)
+        # 表结构变更后需要重新解析
+        bump_schema_version(self.ins.id)
+        new_engine.query_data_masking(
+            instance=self.ins,
+            db_name="some_db",
+            sql="select phone from users where id=3",
+        )
+        self.assertEqual(_query_data_masking.call_count, 3)
+
+    @patch("sql.engines.goinception.GoInceptionEngine._query_print")
+    def test_query_print_error_not_cached(self, _query_print):
+        """解析异常时不缓存"""
+        _query_print.side_effect = RuntimeError("语法错误")
+        new_engine = GoInceptionEngine()
+        for _ in range(2):
+            with self.assertRaises(RuntimeError):
+                new_engine.query_print(
+                    instance=self.ins, db_name="some_db", sql="select * fro users"
+                )
+        self.assertEqual(_query_print.call_count, 2)
+
     @patch("sql.engines.goinception.GoInceptionEngine.query")
     def test_execute_check_normal_sql(self, _query):
         sql = "update user set id=100"
@@ -1344,6 +1500,29 @@ class TestGoInception(TestCase):
         new_engine.set_variable("inception_osc_on", "on")
         _query.assert_called_once_with(sql="inception set inception_osc_on=on;")
 
+    @patch("sql.engines.goinception.GoInceptionEngine.get_backup_connection")
+    def test_get_rollback_page(self, _conn):
+        self.wf.sqlworkflowcontent.execute_result = json.dumps(
+            [
+                {"sql": "sql_1", "backup_dbname": "bak_db", "sequence": "'1_0_1'"},
+                {"sql": "sql_2", "backup_dbname": "None", "sequence": "'1_0_2'"},
+                {"sql": "sql_3", "backup_dbname": "bak_db", "sequence": "'1_0_3'"},
+            ]
+        )
+        cursor = _conn.return_value.cursor.return_value
+        cursor.fetchall.return_value = [("1_0_1", "tb1"), ("1_0_3", "tb1")]
+        cursor.fetchmany.side_effect = [[("rollback_3_1",), ("rollback_3_2",)], []]
+        new_engine = GoInceptionEngine()
+        total, rows = new_engine.get_rollback_page(self.wf, offset=0, limit=1)
+        # 备份表名一次批量获取，仅读取当前页语句的回滚语句
+        self.assertEqual(total, 2)
+        self.assertEqual(rows, [["sql_3", "rollback_3_1\nrollback_3_2"]])
+        table_sql, table_args = cursor.execute.call_args_list[0][0]
+        self.assertIn("opid_time in (%s,%s)", table_sql)
+        self.assertEqual(table_args, ["1_0_3", "1_0_1"])
+        self.assertEqual(cursor.execute.call_args_list[1][0][1], ("1_0_3",))
+        self.assertEqual(cursor.execute.call_count, 2)
+
 
 class TestOracle(TestCase):
     """Oracle 测试"""
@@ -1753,6 +1932,61 @@ class TestOracle(TestCase):
                 execute_result.rows[0].__dict__.keys(), row.__dict__.keys()
             )
 
+    @patch("sql.engines.oracle.OracleEngine.get_backup_connection")
+    def test_backup(self, _backup_conn):
+        backup_cursor = _backup_conn.return_value.cursor.return_value
+        backup_cursor.fetchone.return_value = (1,)
+        cursor = Mock()
+        # 按照scn倒序返回，超长的语句拆分为多行
+        cursor.fetchmany.side_effect = [
+            [
+                (12, "0x1", 1, "insert 2", "delete 2"),
+                (11, "0x1", 2, "update 1", "update undo 1"),
+            ],
+            [(11, "0x1", 2, " part2", " undo part2")],
+            [],
+        ]
+        new_engine = OracleEngine(instance=self.ins)
+        result = new_engine.backup(
+            self.wf,
+            cursor=cursor,
+            begin_time="2023-01-01 00:00:00",
+            end_time="2023-01-01 00:00:10",
+            statement_scns=[(11, 1), (12, 2)],
+        )
+        self.assertTrue(result)
+        backup_cursor.executemany.assert_called_once_with(
+            ANY,
+            [
+                ("insert 2", "delete 2", self.wf.id, 2),
+                ("update 1 part2", "update undo 1 undo part2", self.wf.id, 1),
+            ],
+        )
+
+    @patch("sql.engines.oracle.OracleEngine.get_backup_connection")
+    def test_get_rollback_order(self, _backup_conn):
+        self.wf.sqlworkflowcontent.execute_result = "[]"
+        cursor = _backup_conn.return_value.cursor.return_value
+        cursor.fetchall.return_value = [("insert 2", "delete 2")]
+        new_engine = OracleEngine(instance=self.ins)
+        rows = new_engine.get_rollback(self.wf)
+        self.assertEqual(rows, [["insert 2", "delete 2"]])
+        # 后执行的语句先回滚
+        self.assertIn("order by statement_id desc, id", cursor.execute.call_args[0][0])
+
+    @patch("sql.engines.oracle.OracleEngine.get_backup_connection")
+    def test_get_rollback_page(self, _backup_conn):
+        cursor = _backup_conn.return_value.cursor.return_value
+        cursor.fetchone.return_value = (2,)
+        cursor.fetchall.return_value = [("insert 2", "delete 2")]
+        new_engine = OracleEngine(instance=self.ins)
+        total, rows = new_engine.get_rollback_page(self.wf, offset=0, limit=1)
+        self.assertEqual((total, rows), (2, [["insert 2", "delete 2"]]))
+        # 后执行的语句先回滚
+        sql, args = cursor.execute.call_args[0]
+        self.assertIn("order by statement_id desc, id", sql)
+        self.assertEqual(args, [self.wf.id, 1, 0])
+
     @patch("cx_Oracle.connect.cursor.execute")
     @patch("cx_Oracle.connect.cursor")
     @patch("cx_Oracle.connect")
@@ -1844,6 +2078,45 @@ class MongoTest(TestCase):
         test_sql = """db.job.find().count()"""
         self.assertIsInstance(self.engine.query("some_db", test_sql), ResultSet)
 
+    @patch("sql.engines.mongo.MongoEngine.get_all_columns_by_tb")
+    @patch("sql.engines.mongo.MongoEngine.get_connection")
+    def test_query_find(self, mock_get_connection, mock_get_all_columns_by_tb):
+        test_sql = """db.job.find({"name": "a"}).sort({"_id": -1}).limit(10)"""
+        mock_get_all_columns_by_tb.return_value.rows = ["_id", "name"]
+        collection = mock_get_connection.return_value["some_db"]["job"]
+        cursor = collection.find.return_value
+        cursor.sort.return_value = cursor
+        cursor.limit.return_value = cursor
+        cursor.__iter__.return_value = iter(
+            [
+                {
+                    "_id": ObjectId("5f10162029684728e70045ab"),
+                    "name": "a",
+                    "info": {"uid": ObjectId("5f10162029684728e70045ac")},
+                    "tags": [1, 2],
+                }
+            ]
+        )
+        result = self.engine.query("some_db", test_sql, limit_num=100)
+        collection.find.assert_called_once_with({"name": "a"}, None, batch_size=10)
+        cursor.sort.assert_called_once_with([("_id", -1)])
+        cursor.limit.assert_called_once_with(10)
+        self.assertEqual(
+            result.column_list, ["mongodballdata", "_id", "name", "info", "tags"]
+        )
+        self.assertEqual(
+            result.rows[0][1:],
+            (
+                "ObjectId('5f10162029684728e70045ab')",
+                "a",
+                "{'uid': ObjectId('5f10162029684728e70045ac')}",
+                "(array) 2 Elements",
+            ),
+        )
+        # 字段采样结果使用缓存
+        self.engine.query("some_db", test_sql, limit_num=100)
+        mock_get_all_columns_by_tb.assert_called_once()
+
     @patch("sql.engines.mongo.MongoEngine.get_all_tables")
     def test_query_check(self, mock_get_all_tables):
         test_sql = """db.job.find().count()"""
@@ -1909,7 +2182,7 @@ class MongoTest(TestCase):
     @patch("sql.engines.mongo.MongoEngine.get_all_tables")
     def test_execute_check(self, mock_get_all_tables, mock_get_table_conut):
         sql = """db.job.createIndex({"skuId":1},{background:true});"""
-        mock_get_all_tables.return_value.rows = "job"
+        mock_get_all_tables.return_value.rows = ["job"]
         mock_get_table_conut.return_value = 1000
         row = ReviewResult(
             id=1,
@@ -1925,6 +2198,27 @@ class MongoTest(TestCase):
             check_result.rows[0].__dict__["errormessage"], row.__dict__["errormessage"]
         )
 
+    @patch("sql.engines.mongo.MongoEngine.get_table_conut")
+    @patch("sql.engines.mongo.MongoEngine.get_all_tables")
+    def test_execute_check_catalog(self, mock_get_all_tables, mock_get_table_conut):
+        sql = """db.job.createIndex({"skuId":1},{background:true});
+db.job.drop();
+db.createCollection("job", {capped: true, size: 1024});
+db.job.renameCollection("job_bak");
+db.job_bak.insert({"skuId":1});
+db.job.remove({"skuId":1});"""
+        mock_get_all_tables.return_value.rows = ["job"]
+        mock_get_table_conut.return_value = 1000
+        check_result = self.engine.execute_check("some_db", sql)
+        # 文档列表和文档总数各只获取一次
+        mock_get_all_tables.assert_called_once_with("some_db")
+        mock_get_table_conut.assert_called_once_with("job", "some_db")
+        self.assertEqual(
+            [row.errlevel for row in check_result.rows], [0, 0, 0, 0, 0, 2]
+        )
+        self.assertEqual(check_result.rows[1].affected_rows, 1000)
+        self.assertEqual(check_result.rows[-1].stagestatus, "文档不存在")
+
     @patch("sql.engines.mongo.MongoEngine.exec_cmd")
     @patch("sql.engines.mongo.MongoEngine.get_master")
     def test_execute(self, mock_get_master, mock_exec_cmd):
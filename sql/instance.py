@@ -8,12 +8,12 @@ import simplejson as json
 from django.conf import settings
 from django.contrib.auth.decorators import permission_required
 from django.http import HttpResponse
-from django.views.decorators.cache import cache_page
 
 from common.utils.extend_json_encoder import ExtendJSONEncoder
 from common.utils.convert import Convert
 from sql.engines import get_engine
 from sql.plugins.schemasync import SchemaSync
+from sql.utils.resource_cache import InstanceResourceCache
 from .models import Instance, ParamTemplate, ParamHistory
 
 
@@ -295,7 +295,6 @@ def schemasync(request):
     return HttpResponse(json.dumps(result), content_type="application/json")
 
 
-@cache_page(60 * 5, key_prefix="insRes")
 def instance_resource(request):
     """
     获取实例内的资源信息，database、schema、table、column
@@ -325,6 +324,16 @@ def instance_resource(request):
         schema_name = MySQLdb.escape_string(schema_name).decode("utf-8")
         tb_name = MySQLdb.escape_string(tb_name).decode("utf-8")
 
+        # 优先从实例资源缓存中获取
+        resource_cache = InstanceResourceCache(instance)
+        cache_field = InstanceResourceCache.field(
+            resource_type, db_name, schema_name, tb_name
+        )
+        rows = resource_cache.get(cache_field)
+        if rows is not None:
+            result["data"] = rows
+            return HttpResponse(json.dumps(result), content_type="application/json")
+
         query_engine = get_engine(instance=instance)
         if resource_type == "database":
             resource = query_engine.get_all_databases()
@@ -349,6 +358,10 @@ def instance_resource(request):
             result["msg"] = resource.error
         else:
             result["data"] = resource.rows
+            resource_cache.set(cache_field, resource.rows)
+            # 刷新表列表时，按照表的变更时间清理变更过的表的字段缓存
+            if resource_type == "table":
+                resource_cache.refresh_table_versions(query_engine, db_name)
     return HttpResponse(json.dumps(result), content_type="application/json")
 
 
@@ -10,11 +10,11 @@ import MySQLdb
 import simplejson as json
 from django.contrib.auth.decorators import permission_required
 from django.http import JsonResponse, HttpResponse
-from django_redis import get_redis_connection
 
 from common.utils.extend_json_encoder import ExtendJSONEncoder
 from sql.engines import get_engine
 from sql.models import Instance, InstanceDatabase, Users
+from sql.utils.resource_cache import InstanceResourceCache
 from sql.utils.resource_group import user_instances
 
 __author__ = "hhyo"
@@ -129,10 +129,8 @@ def create(request):
             owner_display=owner_display,
             remark=remark,
         )
-        # 清空实例资源缓存
-        r = get_redis_connection("default")
-        for key in r.scan_iter(match="*insRes*", count=2000):
-            r.delete(key)
+        # 清理实例的库列表缓存
+        InstanceResourceCache(instance).invalidate(db_name)
     return JsonResponse({"status": 0, "msg": "", "data": []})
 
 
@@ -0,0 +1,26 @@
+# -*- coding: UTF-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+
+from sql.models import Instance
+from sql.utils.slowlog_ingest import ingest_digest, ingest_file
+
+
+class Command(BaseCommand):
+    help = "采集MySQL慢日志文件或者performance_schema语句统计，写入慢日志明细，支持断点续传"
+
+    def add_arguments(self, parser):
+        parser.add_argument("instance_name", help="实例名称")
+        parser.add_argument("--file", help="慢日志文件路径，不指定时采集performance_schema语句统计")
+
+    def handle(self, *args, **options):
+        try:
+            instance = Instance.objects.get(
+                instance_name=options["instance_name"], db_type="mysql"
+            )
+        except Instance.DoesNotExist:
+            raise CommandError(f"实例{options['instance_name']}不存在")
+        if options["file"]:
+            saved = ingest_file(instance, options["file"])
+        else:
+            saved = ingest_digest(instance)
+        self.stdout.write(f"采集完成，写入慢日志明细{saved}行")
@@ -0,0 +1,43 @@
+# -*- coding: UTF-8 -*-
+import time
+
+from django.core.management.base import BaseCommand
+
+from sql.utils.data_masking import Masker, mask_rows
+
+
+class Command(BaseCommand):
+    help = "结果集脱敏性能测试，生成指定行数、列数的结果集，输出每秒脱敏的行数"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=10000, help="结果集行数")
+        parser.add_argument("--columns", type=int, default=50, help="结果集列数")
+        parser.add_argument("--masked", type=int, default=5, help="需要脱敏的列数")
+        parser.add_argument("--repeat", type=int, default=5, help="重复次数，取最快的一次")
+
+    def handle(self, *args, **options):
+        rows, columns = options["rows"], options["columns"]
+        masked = min(options["masked"], columns)
+        step = max(columns // masked, 1) if masked else columns
+        masked_index = set(range(0, columns, step)[:masked])
+        result = [
+            tuple(
+                f"1{i:010d}" if j in masked_index else f"v{i}_{j}"
+                for j in range(columns)
+            )
+            for i in range(rows)
+        ]
+        # 手机号脱敏规则，不依赖数据库中配置的规则
+        rules = {1: Masker("(.{3})(.*)(.{4})", 2)}
+        hit_columns = [{"index": j, "rule_type": 1} for j in sorted(masked_index)]
+        elapsed = []
+        for _ in range(max(options["repeat"], 1)):
+            start = time.perf_counter()
+            mask_rows(result, hit_columns, rules)
+            elapsed.append(time.perf_counter() - start)
+        best = min(elapsed)
+        self.stdout.write(
+            f"{rows}行x{columns}列，脱敏{len(masked_index)}列："
+            f"最快{best:.3f}s，平均{sum(elapsed) / len(elapsed):.3f}s，"
+            f"{rows / best:.0f}行/s"
+        )
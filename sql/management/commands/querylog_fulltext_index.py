@@ -0,0 +1,23 @@
+# -*- coding: UTF-8 -*-
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from sql.utils.keyset_pagination import (
+    has_fulltext_index,
+    invalidate_fulltext_index,
+)
+
+
+class Command(BaseCommand):
+    help = "为查询历史的SQL语句创建ngram全文索引，创建后查询历史的搜索使用全文检索"
+
+    def handle(self, *args, **options):
+        if has_fulltext_index("query_log", "sqllog"):
+            self.stdout.write("全文索引已存在")
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "alter table query_log add fulltext index idx_sqllog_fulltext(sqllog) with parser ngram;"
+            )
+        invalidate_fulltext_index("query_log", "sqllog")
+        self.stdout.write("全文索引创建完成")
@@ -2,6 +2,7 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 from mirage import fields
+from django.utils import timezone
 from django.utils.translation import gettext as _
 from mirage.crypto import Crypto
 
@@ -277,6 +278,14 @@ class SqlWorkflow(models.Model):
     class Meta:
         managed = True
         db_table = "sql_workflow"
+        # 工单列表按照(create_time, id)倒序分页，索引和常用筛选项组合
+        index_together = [
+            ("create_time", "id"),
+            ("engineer", "create_time", "id"),
+            ("group_id", "create_time", "id"),
+            ("status", "create_time", "id"),
+            ("instance", "create_time", "id"),
+        ]
         verbose_name = "SQL工单"
         verbose_name_plural = "SQL工单"
 
@@ -537,12 +546,19 @@ class QueryLog(models.Model):
         default=False,
     )
     alias = models.CharField("语句标识", max_length=64, default="", blank=True)
-    create_time = models.DateTimeField("操作时间", auto_now_add=True)
+    # 异步写入时保留请求时记录的时间，不使用auto_now_add
+    create_time = models.DateTimeField("操作时间", default=timezone.now)
     sys_time = models.DateTimeField(auto_now=True)
 
     class Meta:
         managed = True
         db_table = "query_log"
+        # 查询历史按照(create_time, id)倒序分页，索引和常用筛选项组合
+        index_together = [
+            ("create_time", "id"),
+            ("username", "create_time", "id"),
+            ("instance_name", "create_time", "id"),
+        ]
         verbose_name = "查询日志"
         verbose_name_plural = "查询日志"
 
@@ -720,6 +736,7 @@ class ArchiveConfig(models.Model):
         "审核状态", choices=workflow_status_choices, blank=True, default=1
     )
     state = models.BooleanField("是否启用归档", default=True)
+    priority = models.IntegerField("归档优先级，数值越大越先执行", default=0)
     user_name = models.CharField("申请人", max_length=30, blank=True, default="")
     user_display = models.CharField("申请人中文名", max_length=50, blank=True, default="")
     create_time = models.DateTimeField("创建时间", auto_now_add=True)
@@ -754,6 +771,8 @@ class ArchiveLog(models.Model):
     statistics = models.TextField("归档统计日志")
     success = models.BooleanField("是否归档成功")
     error_info = models.TextField("错误信息")
+    checkpoint = models.TextField("归档断点", default="", blank=True)
+    queue_time = models.DateTimeField("入队时间", blank=True, null=True)
     start_time = models.DateTimeField("开始时间")
     end_time = models.DateTimeField("结束时间")
     sys_time = models.DateTimeField("系统时间修改", auto_now=True)
@@ -1176,6 +1195,98 @@ class SlowQueryHistory(models.Model):
         verbose_name_plural = "慢日志明细"
 
 
+class SlowQueryRollup(models.Model):
+    """
+    慢日志预聚合，按照小时、天汇总慢日志明细，由定时任务增量维护
+    """
+
+    granularity = models.CharField(
+        "聚合粒度", max_length=8, choices=(("hour", "小时"), ("day", "天"))
+    )
+    bucket = models.DateTimeField("统计时间")
+    hostname = models.CharField("实例地址", max_length=64)
+    db_name = models.CharField("数据库", max_length=64, default="", blank=True)
+    checksum = models.ForeignKey(
+        SlowQuery,
+        db_constraint=False,
+        to_field="checksum",
+        db_column="checksum",
+        on_delete=models.DO_NOTHING,
+    )
+    ts_cnt = models.FloatField("执行次数", default=0)
+    ts_max = models.DateTimeField("最后执行时间", null=True)
+    query_time_sum = models.FloatField("执行总时长", default=0)
+    query_time_pct_95 = models.FloatField("95%执行时长", default=0)
+    rows_examined_sum = models.FloatField("扫描总行数", default=0)
+    rows_sent_sum = models.FloatField("返回总行数", default=0)
+
+    class Meta:
+        managed = True
+        db_table = "mysql_slow_query_review_rollup"
+        unique_together = ("granularity", "bucket", "hostname", "db_name", "checksum")
+        index_together = ("granularity", "hostname", "bucket")
+        verbose_name = "慢日志预聚合"
+        verbose_name_plural = "慢日志预聚合"
+
+
+class SlowLogCheckpoint(models.Model):
+    """
+    慢日志采集断点，慢日志文件记录文件inode和读取位置，performance_schema记录上次采集的累计值
+    """
+
+    instance = models.ForeignKey(Instance, on_delete=models.CASCADE)
+    source = models.CharField("采集来源，慢日志文件路径或者digest", max_length=255)
+    position = models.TextField("采集断点", default="", blank=True)
+    update_time = models.DateTimeField("更新时间", auto_now=True)
+
+    class Meta:
+        managed = True
+        db_table = "slow_log_checkpoint"
+        unique_together = ("instance", "source")
+        verbose_name = "慢日志采集断点"
+        verbose_name_plural = "慢日志采集断点"
+
+
+class BinlogIndex(models.Model):
+    """
+    binlog文件索引，记录每个文件的时间范围、GTID范围和已索引的位置
+    """
+
+    instance = models.ForeignKey(Instance, on_delete=models.CASCADE)
+    log_file = models.CharField("binlog文件", max_length=255)
+    file_size = models.BigIntegerField("文件大小", default=0)
+    indexed_pos = models.BigIntegerField("已索引的位置", default=0)
+    first_time = models.DateTimeField("第一个事件时间", null=True, blank=True)
+    last_time = models.DateTimeField("最后一个事件时间", null=True, blank=True)
+    gtid_set = models.TextField("GTID范围", default="", blank=True)
+    update_time = models.DateTimeField("更新时间", auto_now=True)
+
+    class Meta:
+        managed = True
+        db_table = "binlog_index"
+        unique_together = ("instance", "log_file")
+        verbose_name = "binlog索引"
+        verbose_name_plural = "binlog索引"
+
+
+class BinlogPosition(models.Model):
+    """
+    binlog稀疏位置索引，按照固定的时间间隔记录事务结束的时间和位置
+    """
+
+    instance = models.ForeignKey(Instance, on_delete=models.CASCADE)
+    log_file = models.CharField("binlog文件", max_length=255)
+    log_pos = models.BigIntegerField("位置")
+    event_time = models.DateTimeField("事件时间")
+
+    class Meta:
+        managed = True
+        db_table = "binlog_position"
+        index_together = ("instance", "event_time")
+        verbose_name = "binlog位置索引"
+        verbose_name_plural = "binlog位置索引"
+
+
 class AuditEntry(models.Model):
     """
     登录审计日志
@@ -7,14 +7,21 @@ import traceback
 
 import simplejson as json
 from django.contrib.auth.decorators import permission_required
-from django.db import connection, close_old_connections
-from django.db.models import Q
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from common.config import SysConfig
 from common.utils.extend_json_encoder import ExtendJSONEncoder, ExtendJSONEncoderFTime
 from common.utils.timer import FuncTimer
 from sql.query_privileges import query_priv_check
+from sql.utils import query_log_writer
+from sql.utils.keyset_pagination import paginate, text_search
 from sql.utils.resource_group import user_instances
+from sql.utils.result_cache import (
+    cacheable,
+    get_cached_result,
+    result_cache_enabled,
+    result_cache_key,
+    set_cached_result,
+)
 from sql.utils.tasks import add_kill_conn_schedule, del_schedule
 from .models import QueryLog, Instance
 from sql.engines import get_engine
@@ -35,6 +42,8 @@ def query(request):
     tb_name = request.POST.get("tb_name")
     limit_num = int(request.POST.get("limit_num", 0))
     schema_name = request.POST.get("schema_name", None)
+    # 流式返回查询结果，适用于结果集较大的查询
+    stream = request.POST.get("stream") == "true"
     user = request.user
 
     result = {"status": 0, "msg": "ok", "data": {}}
@@ -85,6 +94,38 @@ def query(request):
         # 对查询sql增加limit限制或者改写语句
         sql_content = query_engine.filter_sql(sql=sql_content, limit_num=limit_num)
 
+        # 查询结果缓存，命中时直接返回已脱敏的结果集
+        cache_key = None
+        if (
+            not stream
+            and result_cache_enabled(config, instance)
+            and cacheable(sql_content)
+        ):
+            cache_key = result_cache_key(
+                instance,
+                db_name,
+                sql_content,
+                limit_num,
+                schema_name=schema_name,
+                tb_name=tb_name,
+                data_masking=bool(config.get("data_masking")),
+            )
+            query_result = get_cached_result(cache_key) if cache_key else None
+            if query_result is not None:
+                query_result.query_time = 0
+                result["data"] = query_result.__dict__
+                result["data"]["is_cached"] = True
+                _save_query_log(
+                    user,
+                    instance,
+                    db_name,
+                    sql_content,
+                    limit_num,
+                    priv_check,
+                    query_result,
+                )
+                return _query_response(result)
+
         # 先获取查询连接，用于后面查询复用连接以及终止会话
         query_engine.get_connection(db_name=db_name)
         thread_id = query_engine.thread_id
@@ -96,6 +137,21 @@ def query(request):
                 seconds=max_execution_time
             )
             add_kill_conn_schedule(schedule_name, run_date, instance.id, thread_id)
+        if stream:
+            return _query_stream(
+                query_engine,
+                config,
+                user,
+                instance,
+                db_name,
+                sql_content,
+                limit_num,
+                priv_check,
+                schedule_name=schedule_name if thread_id else None,
+                schema_name=schema_name,
+                tb_name=tb_name,
+                max_execution_time=max_execution_time * 1000,
+            )
         with FuncTimer() as t:
             # 获取主从延迟信息
             seconds_behind_master = query_engine.seconds_behind_master
@@ -112,6 +168,8 @@ def query(request):
         if thread_id:
             del_schedule(schedule_name)
 
+        # 可以缓存的结果集，脱敏异常后放行的结果不缓存
+        cache_result = None
         # 查询异常
         if query_result.error:
             result["status"] = 1
@@ -140,6 +198,7 @@ def query(request):
                 # 正常脱敏
                 else:
                     result["data"] = masking_result.__dict__
+                    cache_result = masking_result
             except Exception as msg:
                 logger.error(traceback.format_exc())
                 # 抛出未定义异常，并且开启query_check，直接返回异常，禁止执行
@@ -154,36 +213,38 @@ def query(request):
         # 无需脱敏的语句
         else:
             result["data"] = query_result.__dict__
+            cache_result = query_result
+
+        if cache_key and cache_result is not None:
+            set_cached_result(
+                cache_key,
+                cache_result,
+                timeout=int(config.get("query_result_cache_ttl", 60)),
+                max_size=int(config.get("query_result_cache_max_size", 1024)),
+            )
 
         # 仅将成功的查询语句记录存入数据库
         if not query_result.error:
             result["data"]["seconds_behind_master"] = seconds_behind_master
-            if int(limit_num) == 0:
-                limit_num = int(query_result.affected_rows)
-            else:
-                limit_num = min(int(limit_num), int(query_result.affected_rows))
-            query_log = QueryLog(
-                username=user.username,
-                user_display=user.display,
-                db_name=db_name,
-                instance_name=instance.instance_name,
-                sqllog=sql_content,
-                effect_row=limit_num,
-                cost_time=query_result.query_time,
-                priv_check=priv_check,
-                hit_rule=query_result.mask_rule_hit,
-                masking=query_result.is_masked,
+            _save_query_log(
+                user,
+                instance,
+                db_name,
+                sql_content,
+                limit_num,
+                priv_check,
+                query_result,
             )
-            # 防止查询超时
-            if connection.connection and not connection.is_usable():
-                close_old_connections()
-            query_log.save()
     except Exception as e:
         logger.error(f"查询异常报错，查询语句：{sql_content}\n，错误信息：{traceback.format_exc()}")
         result["status"] = 1
         result["msg"] = f"查询异常报错，错误信息：{e}"
         return HttpResponse(json.dumps(result), content_type="application/json")
-    # 返回查询结果
+    return _query_response(result)
+
+
+def _query_response(result):
+    """返回查询结果"""
     try:
         return HttpResponse(
             json.dumps(
@@ -202,6 +263,128 @@ def query(request):
         )
 
 
+def _query_stream(
+    query_engine,
+    config,
+    user,
+    instance,
+    db_name,
+    sql_content,
+    limit_num,
+    priv_check,
+    schedule_name=None,
+    **kwargs,
+):
+    """
+    流式返回查询结果，使用服务端游标按批次获取、脱敏并输出数据，内存占用与结果集大小无关
+    返回NDJSON格式：首行为结果集信息，之后每行为一个批次的数据{"rows": []}，末行为汇总信息{"summary": {}}
+    """
+    batch_size = int(config.get("query_stream_batch_size", 1000))
+    start = time.time()
+    # 获取主从延迟信息
+    seconds_behind_master = query_engine.seconds_behind_master
+    query_result = query_engine.query_stream(
+        db_name, sql_content, limit_num, batch_size=batch_size, **kwargs
+    )
+    if query_result.error:
+        if schedule_name:
+            del_schedule(schedule_name)
+        result = {"status": 1, "msg": query_result.error, "data": {}}
+        return HttpResponse(json.dumps(result), content_type="application/json")
+    # 数据脱敏，语法解析在输出数据前完成，解析失败时按照query_check配置处理
+    if config.get("data_masking"):
+        try:
+            query_result = query_engine.query_masking_stream(
+                db_name, sql_content, query_result
+            )
+        except Exception as msg:
+            logger.error(traceback.format_exc())
+            if config.get("query_check"):
+                query_engine.close()
+                if schedule_name:
+                    del_schedule(schedule_name)
+                result = {"status": 1, "msg": f"数据脱敏异常：{msg}", "data": {}}
+                return HttpResponse(json.dumps(result), content_type="application/json")
+            logger.warning(f"数据脱敏异常，按照配置放行，查询语句：{sql_content}，错误信息：{msg}")
+
+    def dumps(data):
+        return (
+            json.dumps(
+                data,
+                use_decimal=False,
+                cls=ExtendJSONEncoderFTime,
+                bigint_as_string=True,
+            )
+            + "\n"
+        )
+
+    def stream():
+        yield dumps(
+            {
+                "status": 0,
+                "msg": "ok",
+                "data": {
+                    "full_sql": query_result.full_sql,
+                    "column_list": query_result.column_list,
+                    "column_type": query_result.column_type,
+                    "seconds_behind_master": seconds_behind_master,
+                },
+            }
+        )
+        try:
+            for rows in query_result.rows:
+                query_result.affected_rows += len(rows)
+                yield dumps({"rows": rows})
+        except Exception as e:
+            logger.error(f"流式查询异常，查询语句：{sql_content}\n，错误信息：{traceback.format_exc()}")
+            yield dumps({"status": 1, "msg": f"查询异常报错，错误信息：{e}"})
+            return
+        finally:
+            if schedule_name:
+                del_schedule(schedule_name)
+        query_result.query_time = round(time.time() - start, 6)
+        yield dumps(
+            {
+                "summary": {
+                    "affected_rows": query_result.affected_rows,
+                    "query_time": query_result.query_time,
+                    "mask_rule_hit": query_result.mask_rule_hit,
+                    "is_masked": query_result.is_masked,
+                }
+            }
+        )
+        _save_query_log(
+            user, instance, db_name, sql_content, limit_num, priv_check, query_result
+        )
+
+    return StreamingHttpResponse(stream(), content_type="application/x-ndjson")
+
+
+def _save_query_log(
+    user, instance, db_name, sql_content, limit_num, priv_check, query_result
+):
+    """记录查询日志，仅记录成功的查询语句"""
+    if int(limit_num) == 0:
+        limit_num = int(query_result.affected_rows)
+    else:
+        limit_num = min(int(limit_num), int(query_result.affected_rows))
+    # 开启query_log_async时异步批量写入
+    query_log_writer.write(
+        dict(
+            username=user.username,
+            user_display=user.display,
+            db_name=db_name,
+            instance_name=instance.instance_name,
+            sqllog=sql_content,
+            effect_row=limit_num,
+            cost_time=query_result.query_time,
+            priv_check=priv_check,
+            hit_rule=query_result.mask_rule_hit,
+            masking=query_result.is_masked,
+        )
+    )
+
+
 @permission_required("sql.menu_sqlquery", raise_exception=True)
 def querylog(request):
     return _querylog(request)
@@ -223,8 +406,8 @@ def _querylog(request):
 
     limit = int(request.GET.get("limit", 0))
     offset = int(request.GET.get("offset", 0))
-    limit = offset + limit
-    limit = limit if limit else None
+    # 上一页返回的游标，翻到下一页时传入，使用keyset分页
+    cursor = request.GET.get("cursor")
     star = True if request.GET.get("star") == "true" else False
     query_log_id = request.GET.get("query_log_id")
     search = request.GET.get("search", "")
@@ -253,15 +436,15 @@ def _querylog(request):
     # 过滤组合筛选项
     sql_log = QueryLog.objects.filter(**filter_dict)
 
-    # 过滤搜索信息
-    sql_log = sql_log.filter(
-        Q(sqllog__icontains=search)
-        | Q(user_display__icontains=search)
-        | Q(alias__icontains=search)
-    )
+    # 过滤搜索信息，语句存在全文索引时全文检索语句，同时模糊匹配用户和别名
+    if search:
+        sql_log = sql_log.filter(
+            text_search(
+                QueryLog, "sqllog", search, like_columns=("user_display", "alias")
+            )
+        )
 
-    sql_log_count = sql_log.count()
-    sql_log_list = sql_log.order_by("-id")[offset:limit].values(
+    sql_log_list = sql_log.values(
         "id",
         "instance_name",
         "db_name",
@@ -273,9 +456,9 @@ def _querylog(request):
         "alias",
         "create_time",
     )
-    # QuerySet 序列化
-    rows = [row for row in sql_log_list]
-    result = {"total": sql_log_count, "rows": rows}
+    # 按照(create_time, id)倒序分页，数据量较大时总数为估算值
+    sql_log_count, rows, next_cursor, _ = paginate(sql_log_list, offset, limit, cursor)
+    result = {"total": sql_log_count, "rows": rows, "next_cursor": next_cursor}
     # 返回查询结果
     return HttpResponse(
         json.dumps(result, cls=ExtendJSONEncoder, bigint_as_string=True),
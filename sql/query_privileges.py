@@ -9,11 +9,15 @@ import logging
 import datetime
 import re
 import traceback
+import uuid
 
 import simplejson as json
 from django.contrib.auth.decorators import permission_required
+from django.core.cache import cache
 from django.db import transaction
 from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.http import HttpResponse, HttpResponseRedirect
 from django.shortcuts import render
 from django.urls import reverse
@@ -33,6 +37,9 @@ logger = logging.getLogger("default")
 
 __author__ = "hhyo"
 
+# 用户查询权限快照的缓存时间，单位秒
+QUERY_PRIV_CACHE_TIMEOUT = 60
+
 
 # TODO 权限校验内的语法解析和判断独立到每个engine内
 def query_priv_check(user, instance, db_name, sql_content, limit_num):
@@ -71,11 +78,18 @@ def query_priv_check(user, instance, db_name, sql_content, limit_num):
                 return result
             # 其他权限校验
             table_ref = _table_ref(sql_content, instance, db_name)
-            # 循环验证权限，可能存在性能问题，但一次查询涉及的库表数量有限
+            # 一次获取用户权限快照，循环验证权限时不再查询数据库
+            privileges = _user_privileges(user)
             for table in table_ref:
                 # 既无库权限也无表权限则鉴权失败
-                if not _db_priv(user, instance, table["schema"]) and not _tb_priv(
-                    user, instance, table["schema"], table["name"]
+                if not _db_priv(
+                    user, instance, table["schema"], privileges=privileges
+                ) and not _tb_priv(
+                    user,
+                    instance,
+                    table["schema"],
+                    table["name"],
+                    privileges=privileges,
                 ):
                     # 没有库表查询权限时的staus为2
                     result["status"] = 2
@@ -86,7 +100,11 @@ def query_priv_check(user, instance, db_name, sql_content, limit_num):
             # 获取查询涉及库/表权限的最小limit限制，和前端传参作对比，取最小值
             for table in table_ref:
                 priv_limit = _priv_limit(
-                    user, instance, db_name=table["schema"], tb_name=table["name"]
+                    user,
+                    instance,
+                    db_name=table["schema"],
+                    tb_name=table["name"],
+                    privileges=privileges,
                 )
                 limit_num = min(priv_limit, limit_num) if limit_num else priv_limit
             result["data"]["limit_num"] = limit_num
@@ -112,16 +130,19 @@ def query_priv_check(user, instance, db_name, sql_content, limit_num):
         dbs = list(set(dbs))
         # 排序
         dbs.sort()
+        privileges = _user_privileges(user)
         # 校验库权限，无库权限直接返回
         for db_name in dbs:
-            if not _db_priv(user, instance, db_name):
+            if not _db_priv(user, instance, db_name, privileges=privileges):
                 # 没有库表查询权限时的staus为2
                 result["status"] = 2
                 result["msg"] = f"你无{db_name}数据库的查询权限！请先到查询权限管理进行申请"
                 return result
         # 有所有库权限则获取最小limit值
         for db_name in dbs:
-            priv_limit = _priv_limit(user, instance, db_name=db_name)
+            priv_limit = _priv_limit(
+                user, instance, db_name=db_name, privileges=privileges
+            )
             limit_num = min(priv_limit, limit_num) if limit_num else priv_limit
         result["data"]["limit_num"] = limit_num
     return result
@@ -488,70 +509,135 @@ def _table_ref(sql_content, instance, db_name):
     return engine.get_table_ref(json.loads(query_tree), db_name=db_name)
 
 
-def _db_priv(user, instance, db_name):
+def _db_priv(user, instance, db_name, privileges=None):
     """
     检测用户是否拥有指定库权限
     :param user: 用户对象
     :param instance: 实例对象
     :param db_name: 库名
+    :param privileges: 用户权限快照，为空时自动获取
     :return: 权限存在则返回对应权限的limit_num，否则返回False
     TODO 返回统一为 int 类型, 不存在返回0 (虽然其实在python中 0==False)
     """
-    # 获取用户库权限
-    user_privileges = QueryPrivileges.objects.filter(
-        user_name=user.username,
-        instance=instance,
-        db_name=str(db_name),
-        valid_date__gte=datetime.datetime.now(),
-        is_deleted=0,
-        priv_type=1,
-    )
     if user.is_superuser:
         return int(SysConfig().get("admin_query_limit", 5000))
-    else:
-        if user_privileges.exists():
-            return user_privileges.first().limit_num
-    return False
+    # 从用户权限快照中获取库权限
+    return _lookup_priv(user, (instance.id, str(db_name)), privileges)
 
 
-def _tb_priv(user, instance, db_name, tb_name):
+def _tb_priv(user, instance, db_name, tb_name, privileges=None):
     """
     检测用户是否拥有指定表权限
     :param user: 用户对象
     :param instance: 实例对象
     :param db_name: 库名
     :param tb_name: 表名
+    :param privileges: 用户权限快照，为空时自动获取
     :return: 权限存在则返回对应权限的limit_num，否则返回False
     """
-    # 获取用户表权限
+    if user.is_superuser:
+        return int(SysConfig().get("admin_query_limit", 5000))
+    # 从用户权限快照中获取表权限
+    return _lookup_priv(user, (instance.id, str(db_name), str(tb_name)), privileges)
+
+
+def _user_privileges(user):
+    """
+    获取用户有效查询权限的快照，一次查询获取用户全部权限，缓存一段时间
+    库权限的key为(instance_id, db_name)，表权限的key为(instance_id, db_name, table_name)
+    value为[(valid_date, limit_num)]，权限变更时更新用户的权限版本号使快照失效
+    :param user: 用户对象
+    :return:
+    """
+    version_key = f"query_privileges_version:{user.username}"
+    try:
+        version = cache.get(version_key)
+        if version is None:
+            cache.add(version_key, uuid.uuid4().hex, timeout=None)
+            version = cache.get(version_key)
+        snapshot_key = f"query_privileges:{user.username}:{version}"
+        snapshot = cache.get(snapshot_key)
+    except Exception as e:
+        logger.warning(f"读取用户查询权限缓存失败，直接查询权限信息：{e}")
+        snapshot_key = snapshot = None
+    if snapshot is not None:
+        return snapshot
+    snapshot = {}
     user_privileges = QueryPrivileges.objects.filter(
         user_name=user.username,
-        instance=instance,
-        db_name=str(db_name),
-        table_name=str(tb_name),
-        valid_date__gte=datetime.datetime.now(),
+        valid_date__gte=datetime.date.today(),
         is_deleted=0,
-        priv_type=2,
+    ).values_list(
+        "instance_id", "db_name", "table_name", "priv_type", "valid_date", "limit_num"
     )
-    if user.is_superuser:
-        return int(SysConfig().get("admin_query_limit", 5000))
-    else:
-        if user_privileges.exists():
-            return user_privileges.first().limit_num
-    return False
+    for (
+        instance_id,
+        db_name,
+        table_name,
+        priv_type,
+        valid_date,
+        limit_num,
+    ) in user_privileges:
+        # 元数据库使用不区分大小写的排序规则，快照中的库表名同样忽略大小写
+        if priv_type == 1:
+            key = (instance_id, db_name.lower())
+        else:
+            key = (instance_id, db_name.lower(), table_name.lower())
+        snapshot.setdefault(key, []).append((valid_date, limit_num))
+    if snapshot_key:
+        try:
+            cache.set(snapshot_key, snapshot, timeout=QUERY_PRIV_CACHE_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"写入用户查询权限缓存失败：{e}")
+    return snapshot
+
+
+def _lookup_priv(user, key, privileges=None):
+    """
+    从用户权限快照中获取库/表权限，存在多条有效权限时取最小limit_num
+    :return: 权限存在则返回limit_num，否则返回False
+    """
+    if privileges is None:
+        privileges = _user_privileges(user)
+    key = tuple(i.lower() if isinstance(i, str) else i for i in key)
+    today = datetime.date.today()
+    limits = [
+        limit_num
+        for valid_date, limit_num in privileges.get(key, [])
+        if valid_date >= today
+    ]
+    return min(limits) if limits else False
+
+
+def _invalidate_user_privileges(user_name):
+    """用户查询权限变更后更新权限版本号，使权限快照失效"""
+    try:
+        cache.set(
+            f"query_privileges_version:{user_name}", uuid.uuid4().hex, timeout=None
+        )
+    except Exception as e:
+        logger.error(f"更新用户查询权限版本号失败：{e}")
+
+
+@receiver(post_save, sender=QueryPrivileges)
+@receiver(post_delete, sender=QueryPrivileges)
+def invalidate_query_privileges(instance, **kwargs):
+    """权限记录变更(包括后台管理修改)后使用户的权限快照失效"""
+    _invalidate_user_privileges(instance.user_name)
 
 
-def _priv_limit(user, instance, db_name, tb_name=None):
+def _priv_limit(user, instance, db_name, tb_name=None, privileges=None):
     """
     获取用户拥有的查询权限的最小limit限制，用于返回结果集限制
     :param db_name:
     :param tb_name: 可为空，为空时返回库权限
+    :param privileges: 用户权限快照，为空时自动获取
     :return:
     """
     # 获取库表权限limit值
-    db_limit_num = _db_priv(user, instance, db_name)
+    db_limit_num = _db_priv(user, instance, db_name, privileges=privileges)
     if tb_name:
-        tb_limit_num = _tb_priv(user, instance, db_name, tb_name)
+        tb_limit_num = _tb_priv(user, instance, db_name, tb_name, privileges=privileges)
     else:
         tb_limit_num = None
     # 返回最小值
@@ -611,3 +697,5 @@ def _query_apply_audit_call_back(apply_id, workflow_status):
                 for table_name in apply_queryset.table_list.split(",")
             ]
         QueryPrivileges.objects.bulk_create(insert_list)
+        # bulk_create不会触发信号，需要主动使权限快照失效
+        _invalidate_user_privileges(apply_queryset.user_name)
@@ -9,8 +9,10 @@ from django.http import HttpResponse
 from django.views.decorators.cache import cache_page
 from pyecharts.charts import Line
 from pyecharts import options as opts
+from common.config import SysConfig
 from common.utils.chart_dao import ChartDao
 
+from sql.utils import slowquery_rollup
 from sql.utils.resource_group import user_instances
 from common.utils.extend_json_encoder import ExtendJSONEncoder
 from .models import Instance, SlowQuery, SlowQueryHistory, AliyunRdsConfig
@@ -56,6 +58,24 @@ def slowquery_review(request):
         end_time = datetime.datetime.strptime(
             end_time, "%Y-%m-%d"
         ) + datetime.timedelta(days=1)
+        # 开启预聚合时读取预聚合数据，仅实时聚合水位之后的明细
+        if SysConfig().get("slowquery_rollup"):
+            slow_sql_count, sql_slow_log = slowquery_rollup.review(
+                instance_info.host + ":" + str(instance_info.port),
+                datetime.datetime.strptime(start_time, "%Y-%m-%d"),
+                end_time,
+                db_name=db_name,
+                search=search,
+                sort_name=sortName,
+                sort_order=sortOrder,
+                offset=offset,
+                limit=limit - offset,
+            )
+            result = {"total": slow_sql_count, "rows": sql_slow_log}
+            return HttpResponse(
+                json.dumps(result, cls=ExtendJSONEncoder, bigint_as_string=True),
+                content_type="application/json",
+            )
         filter_kwargs = {"slowqueryhistory__db_max": db_name} if db_name else {}
         # 获取慢查数据
         slowsql_obj = (
@@ -205,11 +225,17 @@ def report(request):
     """返回慢SQL历史趋势"""
     checksum = request.GET.get("checksum")
     checksum = MySQLdb.escape_string(checksum).decode("utf-8")
-    cnt_data = ChartDao().slow_query_review_history_by_cnt(checksum)
-    pct_data = ChartDao().slow_query_review_history_by_pct_95_time(checksum)
-    cnt_x_data = [row[1] for row in cnt_data["rows"]]
-    cnt_y_data = [int(row[0]) for row in cnt_data["rows"]]
-    pct_y_data = [str(row[0]) for row in pct_data["rows"]]
+    if SysConfig().get("slowquery_rollup"):
+        history = slowquery_rollup.history_by_day(checksum)
+        cnt_x_data = [row[0] for row in history]
+        cnt_y_data = [int(row[1]) for row in history]
+        pct_y_data = [str(round(row[2], 6)) for row in history]
+    else:
+        cnt_data = ChartDao().slow_query_review_history_by_cnt(checksum)
+        pct_data = ChartDao().slow_query_review_history_by_pct_95_time(checksum)
+        cnt_x_data = [row[1] for row in cnt_data["rows"]]
+        cnt_y_data = [int(row[0]) for row in cnt_data["rows"]]
+        pct_y_data = [str(row[0]) for row in pct_data["rows"]]
     line = Line(init_opts=opts.InitOpts(width="800", height="380px"))
     line.add_xaxis(cnt_x_data)
     line.add_yaxis(
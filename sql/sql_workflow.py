@@ -1,14 +1,24 @@
 # -*- coding: UTF-8 -*-
 import datetime
+import gzip
 import logging
+import os
 import traceback
+import uuid
 
 import simplejson as json
 from django.contrib.auth.decorators import permission_required
 from django.core.exceptions import PermissionDenied
+from django.conf import settings
+from django.core.cache import cache
 from django.db import transaction
 from django.db.models import Q
-from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
+from django.http import (
+    FileResponse,
+    HttpResponse,
+    HttpResponseRedirect,
+    JsonResponse,
+)
 from django.shortcuts import render, get_object_or_404
 from django.urls import reverse
 from django.utils import timezone
@@ -19,6 +29,7 @@ from common.utils.extend_json_encoder import ExtendJSONEncoder
 from sql.engines.models import ReviewResult, ReviewSet
 from sql.notify import notify_for_audit, notify_for_execute
 from sql.models import ResourceGroup
+from sql.utils.keyset_pagination import paginate
 from sql.utils.resource_group import user_groups, user_instances
 from sql.utils.tasks import add_sql_schedule, del_schedule
 from sql.utils.sql_review import (
@@ -37,6 +48,10 @@ from sql.engines import get_engine
 
 logger = logging.getLogger("default")
 
+# 回滚语句后台导出任务的状态，保存在缓存中
+ROLLBACK_EXPORT_KEY_PREFIX = "rollback_export:"
+ROLLBACK_EXPORT_TASK_TIMEOUT = 60 * 60 * 24
+
 
 @permission_required("sql.menu_sqlworkflow", raise_exception=True)
 def sql_workflow_list(request):
@@ -61,8 +76,8 @@ def _sql_workflow_list(request):
     end_date = request.POST.get("end_date")
     limit = int(request.POST.get("limit", 0))
     offset = int(request.POST.get("offset", 0))
-    limit = offset + limit
-    limit = limit if limit else None
+    # 上一页返回的游标，翻到下一页时传入，使用keyset分页
+    cursor = request.POST.get("cursor")
     search = request.POST.get("search")
     user = request.user
 
@@ -107,8 +122,7 @@ def _sql_workflow_list(request):
             Q(engineer_display__icontains=search) | Q(workflow_name__icontains=search)
         )
 
-    count = workflow.count()
-    workflow_list = workflow.order_by("-create_time")[offset:limit].values(
+    workflow_list = workflow.values(
         "id",
         "workflow_name",
         "engineer_display",
@@ -120,10 +134,9 @@ def _sql_workflow_list(request):
         "group_name",
         "syntax_type",
     )
-
-    # QuerySet 序列化
-    rows = [row for row in workflow_list]
-    result = {"total": count, "rows": rows}
+    # 按照(create_time, id)倒序分页，数据量较大时总数为估算值
+    count, rows, next_cursor, _ = paginate(workflow_list, offset, limit, cursor)
+    result = {"total": count, "rows": rows, "next_cursor": next_cursor}
     # 返回查询结果
     return HttpResponse(
         json.dumps(result, cls=ExtendJSONEncoder, bigint_as_string=True),
@@ -185,17 +198,122 @@ def backup_sql(request):
         raise PermissionDenied
     workflow = get_object_or_404(SqlWorkflow, pk=workflow_id)
 
+    # 传入limit时分页获取，仅读取当前页语句的备份数据
+    limit = int(request.GET.get("limit", 0))
+    offset = int(request.GET.get("offset", 0))
+
     try:
         query_engine = get_engine(instance=workflow.instance)
-        list_backup_sql = query_engine.get_rollback(workflow=workflow)
+        if limit:
+            total, list_backup_sql = query_engine.get_rollback_page(
+                workflow=workflow, offset=offset, limit=limit
+            )
+        else:
+            list_backup_sql = query_engine.get_rollback(workflow=workflow)
+            total = len(list_backup_sql)
     except Exception as msg:
         logger.error(traceback.format_exc())
-        return JsonResponse({"status": 1, "msg": f"{msg}", "rows": []})
+        return JsonResponse({"status": 1, "msg": f"{msg}", "total": 0, "rows": []})
 
-    result = {"status": 0, "msg": "", "rows": list_backup_sql}
+    result = {"status": 0, "msg": "", "total": total, "rows": list_backup_sql}
     return HttpResponse(json.dumps(result), content_type="application/json")
 
 
+def execute_progress(request):
+    """获取工单执行进度"""
+    workflow_id = request.GET.get("workflow_id")
+    if not can_view(request.user, workflow_id):
+        raise PermissionDenied
+    workflow = get_object_or_404(SqlWorkflow, pk=workflow_id)
+    query_engine = get_engine(instance=workflow.instance)
+    progress = query_engine.get_execute_percentage(workflow_id=workflow.id)
+    return JsonResponse({"status": 0, "msg": "", "data": progress or {}})
+
+
+def rollback_export(request):
+    """后台导出回滚语句为gzip文件，完成后通过rollback_export_download下载"""
+    workflow_id = request.POST.get("workflow_id")
+    if not can_rollback(request.user, workflow_id):
+        raise PermissionDenied
+    workflow = get_object_or_404(SqlWorkflow, pk=workflow_id)
+    task_id = uuid.uuid4().hex
+    _set_rollback_export_task(
+        task_id,
+        {
+            "status": "running",
+            "username": request.user.username,
+            "workflow_id": workflow.id,
+        },
+    )
+    async_task(
+        rollback_export_task,
+        workflow.id,
+        task_id,
+        request.user.username,
+        timeout=-1,
+        task_name=f"rollback-export-{task_id}",
+    )
+    return JsonResponse(
+        {"status": 0, "msg": "回滚语句正在后台导出，完成后请下载", "data": {"task_id": task_id}}
+    )
+
+
+def rollback_export_download(request):
+    """获取回滚语句导出任务的状态，导出完成后下载文件，status=true时仅返回任务状态"""
+    task_id = request.GET.get("task_id", "")
+    task = cache.get(f"{ROLLBACK_EXPORT_KEY_PREFIX}{task_id}") if task_id else None
+    if not task or task.get("username") != request.user.username:
+        return JsonResponse({"status": 1, "msg": "导出任务不存在或已过期", "data": {}})
+    if not can_rollback(request.user, task["workflow_id"]):
+        raise PermissionDenied
+    if task["status"] == "failed":
+        return JsonResponse({"status": 1, "msg": task.get("msg"), "data": task})
+    if task["status"] == "running" or request.GET.get("status") == "true":
+        return JsonResponse({"status": 0, "msg": "", "data": task})
+    filename = os.path.basename(task["file"])
+    response = FileResponse(open(task["file"], "rb"))
+    response["Content-Type"] = "application/octet-stream"
+    response["Content-Disposition"] = f'attachment;filename="{filename}"'
+    return response
+
+
+def rollback_export_task(workflow_id, task_id, username):
+    """
+    后台导出回滚语句，逐条语句流式写入gzip文件，避免大工单的回滚语句一次性加载到内存
+    :param workflow_id: 工单id
+    :param task_id: 导出任务id
+    :param username: 发起导出的用户，仅该用户可以下载
+    :return:
+    """
+    task = {"status": "running", "username": username, "workflow_id": workflow_id}
+    try:
+        workflow = SqlWorkflow.objects.get(id=workflow_id)
+        query_engine = get_engine(instance=workflow.instance)
+        path = os.path.join(settings.BASE_DIR, "downloads/rollback")
+        os.makedirs(path, exist_ok=True)
+        task["file"] = os.path.join(path, f"rollback_{workflow_id}_{task_id}.sql.gz")
+        with gzip.open(task["file"], "wt", encoding="utf-8") as f:
+            for sql, rollback in query_engine.iter_rollback(workflow=workflow):
+                f.write(f"/*{sql}*/\n")
+                for statement in rollback:
+                    f.write(f"{statement}\n")
+        task["status"] = "success"
+    except Exception as e:
+        logger.error(f"回滚语句导出失败，错误信息：{traceback.format_exc()}")
+        task["status"] = "failed"
+        task["msg"] = f"回滚语句导出失败，错误信息：{e}"
+    _set_rollback_export_task(task_id, task)
+    return task
+
+
+def _set_rollback_export_task(task_id, task):
+    cache.set(
+        f"{ROLLBACK_EXPORT_KEY_PREFIX}{task_id}",
+        task,
+        timeout=ROLLBACK_EXPORT_TASK_TIMEOUT,
+    )
+
+
 @permission_required("sql.sql_review", raise_exception=True)
 def alter_run_date(request):
     """
@@ -1,12 +1,19 @@
+import gzip
 import json
+import os
 import re
+import time
 from datetime import timedelta, datetime, date
-from unittest.mock import MagicMock, patch, ANY
+from unittest.mock import MagicMock, PropertyMock, patch, ANY
 from django.conf import settings
 from django.contrib.auth.models import Group
+from django.core.cache import cache
 from django.contrib.auth.models import Permission
 from django.test import Client, TestCase, TransactionTestCase
+from django_q.models import Schedule
+from django_redis import get_redis_connection
 
+import sql.data_dictionary
 import sql.query_privileges
 from common.config import SysConfig
 from common.utils.const import WorkflowDict
@@ -14,6 +21,9 @@ from sql.archiver import add_archive_task, archive
 from sql.binlog import my2sql_file
 from sql.engines.models import ResultSet, ReviewSet, ReviewResult
 from sql.notify import notify_for_audit, notify_for_execute, notify_for_my2sql
+from sql.utils import archive_scheduler, slowquery_rollup
+from sql.utils.native_archiver import NativeArchiver
+from sql.utils.archive_progress import ArchiveProgress, BoundedOutput, get_progress
 from sql.utils.execute_sql import execute_callback
 from sql.query import kill_query_conn
 from sql.models import (
@@ -30,6 +40,10 @@ from sql.models import (
     WorkflowLog,
     WorkflowAuditSetting,
     ArchiveConfig,
+    ArchiveLog,
+    SlowQuery,
+    SlowQueryHistory,
+    SlowQueryRollup,
 )
 
 User = Users
@@ -572,6 +586,63 @@ class TestQueryPrivilegesCheck(TestCase):
         )
         self.assertTrue(r)
 
+    def test_user_privileges_snapshot(self):
+        """
+        测试用户权限快照，一次查询获取全部权限，权限变更后快照失效
+        :return:
+        """
+        db_priv = QueryPrivileges.objects.create(
+            user_name=self.user.username,
+            instance=self.slave,
+            db_name=self.db_name,
+            valid_date=date.today() + timedelta(days=1),
+            limit_num=10,
+            priv_type=1,
+        )
+        QueryPrivileges.objects.create(
+            user_name=self.user.username,
+            instance=self.slave,
+            db_name=self.db_name,
+            table_name="table_name",
+            valid_date=date.today() + timedelta(days=1),
+            limit_num=20,
+            priv_type=2,
+        )
+        # 过期的权限不生效
+        QueryPrivileges.objects.create(
+            user_name=self.user.username,
+            instance=self.slave,
+            db_name="expired_db",
+            valid_date=date.today() - timedelta(days=1),
+            limit_num=10,
+            priv_type=1,
+        )
+        with self.assertNumQueries(1):
+            privileges = sql.query_privileges._user_privileges(self.user)
+        with self.assertNumQueries(0):
+            sql.query_privileges._user_privileges(self.user)
+            r = sql.query_privileges._db_priv(
+                self.user, self.slave, self.db_name, privileges=privileges
+            )
+            self.assertEqual(r, 10)
+            r = sql.query_privileges._tb_priv(
+                self.user,
+                self.slave,
+                self.db_name,
+                "table_name",
+                privileges=privileges,
+            )
+            self.assertEqual(r, 20)
+            r = sql.query_privileges._db_priv(
+                self.user, self.slave, "expired_db", privileges=privileges
+            )
+            self.assertFalse(r)
+        # 变更权限后快照失效
+        db_priv.limit_num = 5
+        db_priv.save(update_fields=["limit_num"])
+        r = sql.query_privileges._db_priv(self.user, self.slave, self.db_name)
+        self.assertEqual(r, 5)
+
     @patch("sql.query_privileges._db_priv")
     def test_priv_limit_from_db(self, __db_priv):
         """
@@ -1261,6 +1332,109 @@ class TestQuery(TransactionTestCase):
         self.assertEqual(r_json["data"]["rows"], ["value"])
         self.assertEqual(r_json["data"]["column_list"], ["some"])
 
+    @patch("sql.query.user_instances")
+    @patch("sql.query.get_engine")
+    @patch("sql.query.query_priv_check")
+    def test_query_result_cache(self, _priv_check, _get_engine, _user_instances):
+        """开启查询结果缓存后，相同的查询直接返回缓存结果并记录查询日志"""
+        archer_config = SysConfig()
+        archer_config.set("query_result_cache", True)
+        c = Client()
+        c.force_login(self.u2)
+        some_sql = (
+            f"select some from t where id={datetime.now().timestamp()} limit 100;"
+        )
+        q_result = ResultSet(full_sql=some_sql, rows=[["value"]])
+        q_result.column_list = ["some"]
+        q_result.affected_rows = 1
+        _get_engine.return_value.query_check.return_value = {
+            "msg": "",
+            "bad_query": False,
+            "filtered_sql": some_sql,
+            "has_star": False,
+        }
+        _get_engine.return_value.filter_sql.return_value = some_sql
+        _get_engine.return_value.query.return_value = q_result
+        _get_engine.return_value.seconds_behind_master = 100
+        _get_engine.return_value.thread_id = None
+        _priv_check.return_value = {
+            "status": 0,
+            "data": {"limit_num": 100, "priv_check": True},
+        }
+        _user_instances.return_value.get.return_value = self.slave1
+        data = {
+            "instance_name": self.slave1.instance_name,
+            "sql_content": some_sql,
+            "db_name": "some_db",
+            "limit_num": 100,
+        }
+        r1 = c.post("/query/", data=data).json()
+        r2 = c.post("/query/", data=data).json()
+        _get_engine.return_value.query.assert_called_once()
+        self.assertEqual(r2["data"]["rows"], r1["data"]["rows"])
+        self.assertTrue(r2["data"]["is_cached"])
+        self.assertEqual(QueryLog.objects.filter(sqllog=some_sql).count(), 2)
+        # 结果不确定的语句不缓存
+        data["sql_content"] = "select now() limit 100;"
+        _get_engine.return_value.filter_sql.return_value = data["sql_content"]
+        c.post("/query/", data=data)
+        c.post("/query/", data=data)
+        self.assertEqual(_get_engine.return_value.query.call_count, 3)
+        archer_config.set("query_result_cache", False)
+
+    @patch("sql.query.user_instances")
+    @patch("sql.query.get_engine")
+    @patch("sql.query.query_priv_check")
+    def test_query_stream(self, _priv_check, _get_engine, _user_instances):
+        """流式查询，按批次返回NDJSON并记录查询日志"""
+        c = Client()
+        c.force_login(self.u2)
+        some_sql = "select some from some_table limit 100;"
+        q_result = ResultSet(
+            full_sql=some_sql, rows=iter([[("v1",), ("v2",)], [("v3",)]])
+        )
+        q_result.column_list = ["some"]
+        _get_engine.return_value.query_check.return_value = {
+            "msg": "",
+            "bad_query": False,
+            "filtered_sql": some_sql,
+            "has_star": False,
+        }
+        _get_engine.return_value.filter_sql.return_value = some_sql
+        _get_engine.return_value.query_stream.return_value = q_result
+        _get_engine.return_value.seconds_behind_master = 100
+        _get_engine.return_value.thread_id = None
+        _priv_check.return_value = {
+            "status": 0,
+            "data": {"limit_num": 100, "priv_check": True},
+        }
+        _user_instances.return_value.get.return_value = self.slave1
+        r = c.post(
+            "/query/",
+            data={
+                "instance_name": self.slave1.instance_name,
+                "sql_content": some_sql,
+                "db_name": "some_db",
+                "limit_num": 100,
+                "stream": "true",
+            },
+        )
+        lines = [
+            json.loads(line) for line in b"".join(r.streaming_content).splitlines()
+        ]
+        _get_engine.return_value.query.assert_not_called()
+        self.assertEqual(lines[0]["data"]["column_list"], ["some"])
+        self.assertEqual(lines[0]["data"]["seconds_behind_master"], 100)
+        self.assertEqual(lines[1]["rows"], [["v1"], ["v2"]])
+        self.assertEqual(lines[2]["rows"], [["v3"]])
+        self.assertEqual(lines[3]["summary"]["affected_rows"], 3)
+        self.assertEqual(
+            QueryLog.objects.filter(sqllog=some_sql).values_list(
+                "effect_row", flat=True
+            )[0],
+            3,
+        )
+
     @patch("sql.query.query_priv_check")
     def testStarOptionOn(self, _priv_check):
         c = Client()
@@ -1525,6 +1699,30 @@ class TestWorkflowView(TransactionTestCase):
         r_json = r.json()
         self.assertEqual(r_json["total"], 0)
 
+    def testWorkflowListViewCursor(self):
+        """测试工单列表游标分页，和offset分页结果一致"""
+        c = Client()
+        c.force_login(self.superuser1)
+        r = c.post("/sqlworkflow_list/", {"limit": 1, "offset": 0})
+        first_page = r.json()
+        self.assertEqual(first_page["total"], 2)
+        self.assertTrue(first_page["next_cursor"])
+        r = c.post("/sqlworkflow_list/", {"limit": 1, "offset": 1})
+        offset_page = r.json()
+        r = c.post(
+            "/sqlworkflow_list/",
+            {"limit": 1, "offset": 1, "cursor": first_page["next_cursor"]},
+        )
+        cursor_page = r.json()
+        self.assertEqual(cursor_page["rows"], offset_page["rows"])
+        self.assertNotEqual(cursor_page["rows"][0]["id"], first_page["rows"][0]["id"])
+        r = c.post(
+            "/sqlworkflow_list/",
+            {"limit": 1, "offset": 2, "cursor": cursor_page["next_cursor"]},
+        )
+        self.assertEqual(r.json()["rows"], [])
+        self.assertIsNone(r.json()["next_cursor"])
+
     def testWorkflowListViewFilter(self):
         """测试工单列表筛选"""
         c = Client()
@@ -1643,6 +1841,58 @@ class TestWorkflowView(TransactionTestCase):
         self.wf2.refresh_from_db()
         self.assertEqual("workflow_abort", self.wf2.status)
 
+    @patch("sql.sql_workflow.get_engine")
+    def test_backup_sql_page(self, _get_engine):
+        """分页获取回滚语句"""
+        self.client.force_login(self.superuser1)
+        _get_engine.return_value.get_rollback_page.return_value = (
+            3,
+            [["sql_3", "rollback_3"]],
+        )
+        r = self.client.get(
+            "/sqlworkflow/backup_sql/",
+            data={"workflow_id": self.wf1.id, "limit": 1, "offset": 0},
+        )
+        self.assertEqual(
+            r.json(),
+            {"status": 0, "msg": "", "total": 3, "rows": [["sql_3", "rollback_3"]]},
+        )
+        _get_engine.return_value.get_rollback_page.assert_called_once_with(
+            workflow=self.wf1, offset=0, limit=1
+        )
+
+    @patch("sql.sql_workflow.async_task")
+    @patch("sql.sql_workflow.get_engine")
+    def test_rollback_export(self, _get_engine, _async_task):
+        """后台导出回滚语句，仅发起导出的用户可以下载"""
+        self.client.force_login(self.superuser1)
+        _get_engine.return_value.iter_rollback.return_value = iter(
+            [("sql_1", iter(["rollback_1_1", "rollback_1_2"]))]
+        )
+        r = self.client.post(
+            "/sqlworkflow/rollback_export/", data={"workflow_id": self.wf1.id}
+        )
+        task_id = r.json()["data"]["task_id"]
+        r = self.client.get(
+            "/sqlworkflow/rollback_export/download/", data={"task_id": task_id}
+        )
+        self.assertEqual(r.json()["data"]["status"], "running")
+        args = _async_task.call_args[0]
+        task = args[0](*args[1:])
+        self.assertEqual(task["status"], "success")
+        with gzip.open(task["file"], "rt") as f:
+            self.assertEqual(f.read(), "/*sql_1*/\nrollback_1_1\nrollback_1_2\n")
+        r = self.client.get(
+            "/sqlworkflow/rollback_export/download/", data={"task_id": task_id}
+        )
+        self.assertEqual(r["Content-Type"], "application/octet-stream")
+        self.client.force_login(self.u2)
+        r = self.client.get(
+            "/sqlworkflow/rollback_export/download/", data={"task_id": task_id}
+        )
+        self.assertEqual(r.json()["status"], 1)
+        os.remove(task["file"])
+
     @patch("sql.sql_workflow.get_engine")
     def test_osc_control(self, _get_engine):
         """测试MySQL工单osc控制"""
@@ -2104,6 +2354,409 @@ class TestArchiver(TestCase):
         r = self.client.post(path="/archive/log/", data=data)
         self.assertDictEqual(json.loads(r.content), {"total": 0, "rows": []})
 
+    @patch("sql.archiver.NativeArchiver")
+    def test_archive_native(self, _native_archiver):
+        """
+        测试开启原生归档时不调用pt-archiver
+        :return:
+        """
+        self.sys_config.set("archive_native", "true")
+        archive(self.archive_apply.id)
+        _native_archiver.return_value.run.assert_called_once()
+
+    @staticmethod
+    def _native_cursor():
+        cursor = MagicMock()
+        cursor.fetchall.side_effect = [[("id",)], [(1, "a"), (2, "b")]]
+        cursor.description = [("id",), ("name",)]
+        cursor.rowcount = 2
+        return cursor
+
+    @patch("sql.utils.native_archiver.get_engine")
+    def test_native_archive_purge(self, _get_engine):
+        """
+        测试原生归档按照主键删除，并记录准确的数量
+        :return:
+        """
+        cursor = self._native_cursor()
+        _get_engine.return_value.get_connection.return_value.cursor.return_value = (
+            cursor
+        )
+        self.sys_config.set("archive_native", "true")
+        self.archive_apply.mode = "purge"
+        self.archive_apply.save()
+        archive(self.archive_apply.id)
+        cursor.execute.assert_called_with(
+            "DELETE FROM `src_db_name`.`src_table_name` WHERE `id` IN (%s,%s);",
+            [1, 2],
+        )
+        log = ArchiveLog.objects.get(archive=self.archive_apply)
+        self.assertTrue(log.success)
+        self.assertEqual((log.select_cnt, log.delete_cnt), (2, 2))
+        self.assertEqual(log.checkpoint, "")
+
+    @patch("sql.utils.native_archiver.get_engine")
+    def test_native_archive_resume(self, _get_engine):
+        """
+        测试原生归档从中断的断点继续执行
+        :return:
+        """
+        cursor = self._native_cursor()
+        _get_engine.return_value.get_connection.return_value.cursor.return_value = (
+            cursor
+        )
+        self.sys_config.set("archive_native", "true")
+        self.archive_apply.mode = "purge"
+        self.archive_apply.save()
+        log = ArchiveLog.objects.create(
+            archive=self.archive_apply,
+            cmd="native-archiver",
+            condition=self.archive_apply.condition,
+            mode="purge",
+            no_delete=False,
+            sleep=0,
+            select_cnt=100,
+            insert_cnt=0,
+            delete_cnt=100,
+            statistics="",
+            success=False,
+            error_info="归档执行报错:interrupted",
+            checkpoint=json.dumps({"pk": [0], "batch_size": 100}),
+            start_time=datetime.now(),
+            end_time=datetime.now(),
+        )
+        archive(self.archive_apply.id)
+        cursor.execute.assert_any_call(
+            "SELECT * FROM `src_db_name`.`src_table_name` WHERE (1=1) AND `id` > %s "
+            "ORDER BY `id` LIMIT 100;",
+            [0],
+        )
+        log.refresh_from_db()
+        self.assertTrue(log.success)
+        self.assertEqual((log.select_cnt, log.delete_cnt), (102, 102))
+        self.assertEqual(
+            ArchiveLog.objects.filter(archive=self.archive_apply).count(), 1
+        )
+
+    @patch("sql.utils.native_archiver.get_engine")
+    def test_native_archive_resume_file(self, _get_engine):
+        """
+        测试文件模式续传时截断中断批次写入的内容，避免重复写入文件
+        :return:
+        """
+        cursor = self._native_cursor()
+        # 主键、中断批次的数据仍然存在、下一批数据
+        cursor.fetchall.side_effect = [[("id",)], [(1,)], [(1, "a"), (2, "b")]]
+        _get_engine.return_value.get_connection.return_value.cursor.return_value = (
+            cursor
+        )
+        self.sys_config.set("archive_native", "true")
+        self.archive_apply.mode = "file"
+        self.archive_apply.save()
+        file_path = NativeArchiver(self.archive_apply).file_path
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with gzip.open(file_path, "wt") as f:
+            f.write("0\tz\n")
+        file_size = os.path.getsize(file_path)
+        # 中断批次已经写入文件，但是源数据未删除
+        with gzip.open(file_path, "at") as f:
+            f.write("1\ta\n2\tb\n")
+        ArchiveLog.objects.create(
+            archive=self.archive_apply,
+            cmd="native-archiver",
+            condition=self.archive_apply.condition,
+            mode="file",
+            no_delete=False,
+            sleep=0,
+            select_cnt=1,
+            insert_cnt=0,
+            delete_cnt=1,
+            statistics="",
+            success=False,
+            error_info="归档执行报错:interrupted",
+            checkpoint=json.dumps(
+                {
+                    "pk": [0],
+                    "batch_size": 100,
+                    "file_size": file_size,
+                    "pending": {"pk": [2], "rows": 2, "file_size": 0},
+                }
+            ),
+            start_time=datetime.now(),
+            end_time=datetime.now(),
+        )
+        try:
+            archive(self.archive_apply.id)
+            with gzip.open(file_path, "rt") as f:
+                self.assertEqual(f.read(), "0\tz\n1\ta\n2\tb\n")
+        finally:
+            os.remove(file_path)
+        log = ArchiveLog.objects.get(archive=self.archive_apply)
+        self.assertTrue(log.success)
+        self.assertEqual((log.select_cnt, log.delete_cnt), (3, 3))
+
+    @patch("sql.utils.native_archiver.get_engine")
+    def test_native_archive_dest_conflict(self, _get_engine):
+        """
+        测试目标表存在主键冲突的数据时不删除源数据，归档失败
+        :return:
+        """
+        cursor = self._native_cursor()
+        # INSERT IGNORE忽略了冲突的一行
+        cursor.rowcount = 1
+        conn = _get_engine.return_value.get_connection.return_value
+        conn.cursor.return_value = cursor
+        self.sys_config.set("archive_native", "true")
+        self.archive_apply.mode = "dest"
+        self.archive_apply.no_delete = False
+        self.archive_apply.save()
+        with self.assertRaises(Exception):
+            archive(self.archive_apply.id)
+        for call in cursor.execute.call_args_list:
+            self.assertFalse(call.args[0].startswith("DELETE"))
+        conn.rollback.assert_called()
+        log = ArchiveLog.objects.get(archive=self.archive_apply)
+        self.assertFalse(log.success)
+        self.assertIn("写入和查询数量不一致:1!=2", log.error_info)
+        self.assertEqual((log.select_cnt, log.insert_cnt, log.delete_cnt), (0, 0, 0))
+
+    @patch("sql.utils.native_archiver.get_engine")
+    def test_native_archive_resume_dest(self, _get_engine):
+        """
+        测试目标表模式续传的第一个批次允许目标表中已存在中断批次写入的数据
+        :return:
+        """
+        cursor = self._native_cursor()
+        # 中断批次已经写入目标表，INSERT IGNORE忽略一行，删除两行
+        type(cursor).rowcount = PropertyMock(side_effect=[1, 2])
+        _get_engine.return_value.get_connection.return_value.cursor.return_value = (
+            cursor
+        )
+        self.sys_config.set("archive_native", "true")
+        self.archive_apply.mode = "dest"
+        self.archive_apply.no_delete = False
+        self.archive_apply.save()
+        ArchiveLog.objects.create(
+            archive=self.archive_apply,
+            cmd="native-archiver",
+            condition=self.archive_apply.condition,
+            mode="dest",
+            no_delete=False,
+            sleep=0,
+            select_cnt=0,
+            insert_cnt=0,
+            delete_cnt=0,
+            statistics="",
+            success=False,
+            error_info="归档执行报错:interrupted",
+            checkpoint=json.dumps(
+                {"pk": None, "batch_size": 100, "pending": {"pk": [2], "rows": 2}}
+            ),
+            start_time=datetime.now(),
+            end_time=datetime.now(),
+        )
+        archive(self.archive_apply.id)
+        log = ArchiveLog.objects.get(archive=self.archive_apply)
+        self.assertTrue(log.success)
+        self.assertEqual((log.select_cnt, log.insert_cnt, log.delete_cnt), (2, 2, 2))
+
+    @patch("sql.utils.archive_scheduler.async_task")
+    def test_archive_scheduler(self, _async_task):
+        """
+        测试归档调度，单个源实例按照优先级依次执行
+        :return:
+        """
+        redis = get_redis_connection("default")
+        keys = [
+            archive_scheduler.QUEUE_KEY,
+            archive_scheduler.QUEUE_TIME_KEY,
+            archive_scheduler.RUNNING_KEY,
+        ]
+        redis.delete(*keys)
+        self.archive_apply.status = WorkflowDict.workflow_status["audit_success"]
+        self.archive_apply.state = True
+        self.archive_apply.save()
+        archive_high = ArchiveConfig.objects.get(id=self.archive_apply.id)
+        archive_high.id = None
+        archive_high.priority = 10
+        archive_high.save()
+        add_archive_task()
+        _async_task.assert_called_once_with(
+            "sql.utils.archive_scheduler.run_archive",
+            archive_high.id,
+            ANY,
+            timeout=-1,
+            task_name=f"archive-{archive_high.id}",
+        )
+        # 重复添加不会重复执行
+        add_archive_task()
+        self.assertEqual(_async_task.call_count, 1)
+        # 执行结束后调度下一个任务
+        with patch("sql.archiver.archive") as _archive:
+            archive_scheduler.run_archive(archive_high.id, time.time())
+            _archive.assert_called_once_with(archive_high.id, queue_time=ANY)
+        self.assertEqual(_async_task.call_args[0][1], self.archive_apply.id)
+        # 入队时添加定时调度
+        self.assertTrue(Schedule.objects.filter(name="归档调度").exists())
+        redis.delete(*keys)
+
+    @patch("sql.utils.archive_scheduler.async_task")
+    def test_archive_scheduler_heartbeat(self, _async_task):
+        """
+        测试超过时间未刷新心跳的运行中任务被回收，队列中的任务由定时调度启动
+        :return:
+        """
+        redis = get_redis_connection("default")
+        keys = [
+            archive_scheduler.QUEUE_KEY,
+            archive_scheduler.QUEUE_TIME_KEY,
+            archive_scheduler.RUNNING_KEY,
+        ]
+        redis.delete(*keys)
+        now = time.time()
+        redis.hset(
+            archive_scheduler.RUNNING_KEY,
+            0,
+            json.dumps(
+                {
+                    "instance_id": self.archive_apply.src_instance_id,
+                    "start": now - archive_scheduler.RUNNING_EXPIRE * 2,
+                    "heartbeat": now - archive_scheduler.RUNNING_EXPIRE - 1,
+                }
+            ),
+        )
+        redis.zadd(archive_scheduler.QUEUE_KEY, {self.archive_apply.id: now})
+        self.assertEqual(archive_scheduler.dispatch(), [self.archive_apply.id])
+        self.assertIsNone(redis.hget(archive_scheduler.RUNNING_KEY, 0))
+        redis.delete(*keys)
+
+    @patch("sql.utils.archive_progress.time")
+    def test_archive_progress(self, _time):
+        """
+        测试归档实时进度
+        :return:
+        """
+        _time.monotonic.side_effect = [0, 10, 10, 11]
+        progress = ArchiveProgress(self.archive_apply.id, total=1000, done=100)
+        progress.update(600, lag=3)
+        self.client.force_login(self.superuser)
+        r = self.client.get("/archive/progress/", {"archive_id": self.archive_apply.id})
+        data = json.loads(r.content)["data"]
+        self.assertEqual(data["state"], "running")
+        self.assertEqual(data["rows_per_sec"], 50)
+        self.assertEqual(data["estimated_remaining"], 400)
+        self.assertEqual(data["eta"], 8)
+        self.assertEqual(data["lag"], 3)
+        # 未达到写入间隔时不更新
+        progress.update(700)
+        self.assertEqual(get_progress(self.archive_apply.id)["rows"], 600)
+
+    def test_bounded_output(self):
+        """
+        测试归档输出仅保留最后的行
+        :return:
+        """
+        output = BoundedOutput(max_lines=2)
+        for i in range(5):
+            output.append(f"{i}\n")
+        self.assertEqual(str(output), "...省略3行输出\n3\n4\n")
+
+    def test_archive_time_window(self):
+        """
+        测试归档时间窗口
+        :return:
+        """
+        now = datetime(2023, 1, 1, 2, 0, 0)
+        self.assertTrue(archive_scheduler.in_time_window(now))
+        self.sys_config.set("archive_time_window", "01:00-06:00")
+        self.assertTrue(archive_scheduler.in_time_window(now))
+        self.sys_config.set("archive_time_window", "22:00-01:00")
+        self.assertFalse(archive_scheduler.in_time_window(now))
+        self.sys_config.set("archive_time_window", "22:00-01:00,1:30-3:00")
+        self.assertTrue(archive_scheduler.in_time_window(now))
+
+
+class TestSlowQueryRollup(TestCase):
+    """测试慢日志预聚合"""
+
+    def setUp(self):
+        self.host = "some_host:3306"
+        SlowQuery.objects.create(
+            checksum="c1", fingerprint="select * from t where id=?", sample="s"
+        )
+        for ts, cnt, query_time in [
+            (datetime(2026, 10, 1, 10, 5), 2, 1.0),
+            (datetime(2026, 10, 1, 11, 5), 3, 2.0),
+            (datetime(2026, 10, 2, 1, 5), 1, 0.5),
+        ]:
+            self._add_history(ts, cnt, query_time)
+
+    def tearDown(self):
+        SlowQueryRollup.objects.all().delete()
+        SlowQueryHistory.objects.all().delete()
+        SlowQuery.objects.all().delete()
+        cache.delete(slowquery_rollup.ROLLUP_ID_KEY)
+
+    def _add_history(self, ts, cnt, query_time):
+        SlowQueryHistory.objects.create(
+            hostname_max=self.host,
+            user_max="u",
+            db_max="db1",
+            checksum_id="c1",
+            sample="s",
+            ts_min=ts,
+            ts_max=ts,
+            ts_cnt=cnt,
+            query_time_sum=query_time,
+            query_time_pct_95=query_time / cnt,
+            rows_examined_sum=cnt * 10,
+            rows_sent_sum=cnt,
+        )
+
+    def test_rollup(self):
+        slowquery_rollup.rollup()
+        self.assertEqual(SlowQueryRollup.objects.filter(granularity="hour").count(), 3)
+        self.assertEqual(SlowQueryRollup.objects.filter(granularity="day").count(), 2)
+        self.assertEqual(slowquery_rollup.rollup_watermark(), datetime(2026, 10, 2, 1))
+        # 水位所在小时的新增明细实时聚合，重复聚合结果不变
+        self._add_history(datetime(2026, 10, 2, 1, 30), 4, 1.0)
+        total, rows = slowquery_rollup.review(
+            self.host, datetime(2026, 10, 1), datetime(2026, 10, 3)
+        )
+        self.assertEqual(total, 1)
+        self.assertEqual(rows[0]["SQLText"], "select * from t where id=?")
+        self.assertEqual(rows[0]["MySQLTotalExecutionCounts"], 10)
+        self.assertEqual(rows[0]["MySQLTotalExecutionTimes"], 4.5)
+        self.assertEqual(rows[0]["QueryTimeAvg"], 0.45)
+        self.assertEqual(rows[0]["ParseRowAvg"], 10)
+        slowquery_rollup.rollup()
+        self.assertEqual(SlowQueryRollup.objects.filter(granularity="hour").count(), 3)
+        self.assertEqual(
+            slowquery_rollup.review(
+                self.host, datetime(2026, 10, 1), datetime(2026, 10, 3)
+            )[1][0]["MySQLTotalExecutionCounts"],
+            10,
+        )
+        self.assertEqual(
+            [row[:2] for row in slowquery_rollup.history_by_day("c1")],
+            [(date(2026, 10, 1), 5), (date(2026, 10, 2), 5)],
+        )
+
+    def test_rollup_late_history(self):
+        """水位之前延迟写入的明细，重新聚合明细所在的天"""
+        slowquery_rollup.rollup()
+        self._add_history(datetime(2026, 9, 30, 3, 5), 6, 3.0)
+        slowquery_rollup.rollup()
+        self.assertEqual(SlowQueryRollup.objects.filter(granularity="hour").count(), 4)
+        day = SlowQueryRollup.objects.get(
+            granularity="day", bucket=datetime(2026, 9, 30)
+        )
+        self.assertEqual(day.ts_cnt, 6)
+        total, rows = slowquery_rollup.review(
+            self.host, datetime(2026, 9, 30), datetime(2026, 10, 3)
+        )
+        self.assertEqual(rows[0]["MySQLTotalExecutionCounts"], 12)
+
 
 class TestAsync(TestCase):
     def setUp(self):
@@ -2371,6 +3024,48 @@ class TestBinLog(TestCase):
         r = self.client.post(path="/binlog/my2sql/", data=data)
         self.assertEqual(json.loads(r.content), {"status": 0, "msg": "ok", "data": []})
 
+    @patch("sql.binlog.async_task")
+    @patch("sql.binlog.Binlog2SQL")
+    def test_my2sql_inprocess(self, _binlog2sql, _async_task):
+        """
+        测试开启内置解析时在进程内解析binlog，不需要设置my2sql路径
+        :return:
+        """
+        self.sys_config.set("binlog_parser_inprocess", "true")
+        self.sys_config.get_all_config()
+        _binlog2sql.return_value.preview.return_value = [
+            {"sql": "INSERT INTO `db1`.`t1` (`id`) VALUES (1);"}
+        ]
+        data = {
+            "instance_name": "test_instance",
+            "save_sql": "true",
+            "rollback": "true",
+            "num": "1",
+            "threads": 1,
+            "start_file": "mysql-bin.000045",
+            "start_pos": "",
+            "end_file": "mysql-bin.000046",
+            "end_pos": "",
+            "stop_time": "",
+            "start_time": "",
+            "only_schemas": "db1",
+            "only_tables[]": ["t1"],
+        }
+        r = self.client.post(path="/binlog/my2sql/", data=data)
+        self.assertEqual(
+            json.loads(r.content),
+            {
+                "status": 0,
+                "msg": "ok",
+                "data": [{"sql": "INSERT INTO `db1`.`t1` (`id`) VALUES (1);"}],
+            },
+        )
+        _binlog2sql.return_value.preview.assert_called_once_with(1)
+        parser_args = _binlog2sql.call_args.kwargs
+        self.assertEqual(parser_args["work_type"], "rollback")
+        self.assertEqual(parser_args["only_tables"], ["t1"])
+        _async_task.assert_called_once()
+
     @patch("builtins.open")
     @patch("sql.plugins.plugin.subprocess")
     def test_my2sql_file(self, _open, _subprocess):
@@ -3222,6 +3917,52 @@ class TestDataDictionary(TestCase):
         self.assertEqual(r.status_code, 200)
         self.assertTrue(r.streaming)
 
+    @patch("sql.data_dictionary.async_task")
+    @patch("sql.data_dictionary.get_engine")
+    def test_export_async(self, _get_engine, _async_task):
+        """
+        测试后台导出，导出完成后下载
+        :return:
+        """
+        _get_engine.return_value.get_tables_metas_data.return_value = []
+        data = {
+            "instance_name": self.ins.instance_name,
+            "db_name": self.db_name,
+            "db_type": "mysql",
+            "async_export": "true",
+        }
+        r = self.client.get(path="/data_dictionary/export/", data=data)
+        task_id = json.loads(r.content)["data"]["task_id"]
+        _async_task.assert_called_once()
+        # 导出完成前
+        r = self.client.get(
+            path="/data_dictionary/export/download/", data={"task_id": task_id}
+        )
+        self.assertEqual(json.loads(r.content)["data"]["status"], "running")
+        # 执行导出任务后下载
+        task = sql.data_dictionary.export_task(*_async_task.call_args[0][1:])
+        self.assertEqual(task["status"], "success")
+        # 导出文件写入任务单独的目录
+        self.assertEqual(os.path.basename(os.path.dirname(task["file"])), task_id)
+        r = self.client.get(
+            path="/data_dictionary/export/download/",
+            data={"task_id": task_id, "status": "true"},
+        )
+        self.assertEqual(json.loads(r.content)["data"]["status"], "success")
+        r = self.client.get(
+            path="/data_dictionary/export/download/", data={"task_id": task_id}
+        )
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.streaming)
+        # 其他用户无法下载
+        self.client.force_login(self.u1)
+        export_perm = Permission.objects.get(codename="data_dictionary_export")
+        self.u1.user_permissions.add(export_perm)
+        r = self.client.get(
+            path="/data_dictionary/export/download/", data={"task_id": task_id}
+        )
+        self.assertEqual(json.loads(r.content)["status"], 1)
+
     @patch("sql.data_dictionary.get_engine")
     def oracle_test_export_db(self, _get_engine):
         """
@@ -82,6 +82,12 @@ urlpatterns = [
     path("sqlworkflow_list_audit/", sql_workflow.sql_workflow_list_audit),
     path("sqlworkflow/detail_content/", sql_workflow.detail_content),
     path("sqlworkflow/backup_sql/", sql_workflow.backup_sql),
+    path("sqlworkflow/execute_progress/", sql_workflow.execute_progress),
+    path("sqlworkflow/rollback_export/", sql_workflow.rollback_export),
+    path(
+        "sqlworkflow/rollback_export/download/",
+        sql_workflow.rollback_export_download,
+    ),
     path("getWorkflowStatus/", sql_workflow.get_workflow_status),
     path("del_sqlcronjob/", tasks.del_schedule),
     path("inception/osc_control/", sql_workflow.osc_control),
@@ -119,6 +125,7 @@ urlpatterns = [
     path("data_dictionary/table_list/", data_dictionary.table_list),
     path("data_dictionary/table_info/", data_dictionary.table_info),
     path("data_dictionary/export/", data_dictionary.export),
+    path("data_dictionary/export/download/", data_dictionary.export_download),
     path("param/list/", instance.param_list),
     path("param/history/", instance.param_history),
     path("param/edit/", instance.param_edit),
@@ -157,6 +164,7 @@ urlpatterns = [
     path("archive/switch/", archiver.archive_switch),
     path("archive/once/", archiver.archive_once),
     path("archive/log/", archiver.archive_log),
+    path("archive/progress/", archiver.archive_progress),
     path("4admin/sync_ding_user/", ding_api.sync_ding_user),
     path("audit/log/", audit_log.audit_log),
     path("audit/input/", audit_log.audit_input),
@@ -0,0 +1,131 @@
+# -*- coding:utf-8 -*-
+"""
+@license: Apache Licence
+@file: archive_progress.py
+@time: 2026/10/17
+"""
+import datetime
+import logging
+import time
+from collections import deque
+
+from django.core.cache import cache
+
+from sql.engines import get_engine
+
+logger = logging.getLogger("default")
+
+# 进度写入redis的最小间隔，单位秒
+PROGRESS_INTERVAL = 2
+# 进度信息的保留时间，单位秒
+PROGRESS_TIMEOUT = 60 * 60 * 24
+# 归档统计日志在内存中保留的最大行数
+STATISTICS_MAX_LINES = 2000
+
+
+def _progress_key(archive_id):
+    return f"archive_progress:{archive_id}"
+
+
+def estimate_rows(instance, db_name, table_name):
+    """通过information_schema.TABLES的TABLE_ROWS估算源表行数，仅支持MySQL，获取失败时返回None"""
+    if instance.db_type != "mysql":
+        return None
+    try:
+        engine = get_engine(instance)
+        result = engine.query(
+            "information_schema",
+            f"""SELECT TABLE_ROWS FROM information_schema.TABLES
+                WHERE TABLE_SCHEMA='{db_name}' AND TABLE_NAME='{table_name}';""",
+        )
+        if result.error or not result.rows:
+            return None
+        return result.rows[0][0]
+    except Exception as e:
+        logger.warning(f"估算归档表行数失败：{e}")
+        return None
+
+
+def get_progress(archive_id):
+    """获取归档任务最近一次执行的进度"""
+    try:
+        return cache.get(_progress_key(archive_id))
+    except Exception as e:
+        logger.warning(f"获取归档进度失败：{e}")
+        return None
+
+
+class ArchiveProgress(object):
+    """
+    归档实时进度，按照PROGRESS_INTERVAL的间隔写入redis
+    包括已归档行数、每秒行数、基于TABLE_ROWS估算的剩余行数和剩余时间、从库延迟
+    TABLE_ROWS为估算值且未考虑归档条件，剩余时间仅供参考
+    """
+
+    def __init__(self, archive_id, total=None, done=0):
+        self.key = _progress_key(archive_id)
+        self.total = total
+        # 断点续传时已完成的行数，不计入本次的速度
+        self.initial = done
+        self.rows = done
+        self.lag = None
+        self.start_time = datetime.datetime.now()
+        self.start = time.monotonic()
+        self.last_write = 0
+
+    def update(self, rows, lag=None, force=False):
+        self.rows = rows
+        if lag is not None:
+            self.lag = lag
+        if force or time.monotonic() - self.last_write >= PROGRESS_INTERVAL:
+            self._write("running")
+
+    def finish(self, success, error_info=""):
+        self._write("success" if success else "failed", error_info)
+
+    def _write(self, state, error_info=""):
+        self.last_write = time.monotonic()
+        elapsed = self.last_write - self.start
+        rows_per_sec = (self.rows - self.initial) / elapsed if elapsed > 0 else 0
+        remaining = max(self.total - self.rows, 0) if self.total is not None else None
+        eta = (
+            int(remaining / rows_per_sec)
+            if remaining is not None and rows_per_sec > 0 and state == "running"
+            else None
+        )
+        progress = {
+            "state": state,
+            "rows": self.rows,
+            "rows_per_sec": round(rows_per_sec, 2),
+            "estimated_total": self.total,
+            "estimated_remaining": remaining,
+            "eta": eta,
+            "lag": self.lag,
+            "elapsed": int(elapsed),
+            "start_time": self.start_time.strftime("%Y-%m-%d %H:%M:%S"),
+            "update_time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "error_info": error_info,
+        }
+        try:
+            cache.set(self.key, progress, timeout=PROGRESS_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"写入归档进度失败：{e}")
+
+
+class BoundedOutput(object):
+    """保留最后max_lines行的输出，避免长时间归档的输出占用过多内存"""
+
+    def __init__(self, max_lines=STATISTICS_MAX_LINES):
+        self.lines = deque(maxlen=max_lines)
+        self.dropped = 0
+
+    def append(self, line):
+        if len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+        self.lines.append(line)
+
+    def __str__(self):
+        output = "".join(self.lines)
+        if self.dropped:
+            output = f"...省略{self.dropped}行输出\n{output}"
+        return output
@@ -0,0 +1,191 @@
+# -*- coding:utf-8 -*-
+"""
+@license: Apache Licence
+@file: archive_scheduler.py
+@time: 2026/10/17
+"""
+import datetime
+import logging
+import threading
+import time
+
+import simplejson as json
+from django.conf import settings
+from django_q.tasks import async_task
+from django_redis import get_redis_connection
+
+from common.config import SysConfig
+from sql.models import ArchiveConfig
+from sql.utils.tasks import add_archive_dispatch_schedule, task_info
+
+logger = logging.getLogger("default")
+
+QUEUE_KEY = "archive_scheduler:queue"
+QUEUE_TIME_KEY = "archive_scheduler:queue_time"
+RUNNING_KEY = "archive_scheduler:running"
+LOCK_KEY = "archive_scheduler:lock"
+# 运行中的归档任务刷新心跳的间隔，单位秒
+HEARTBEAT_INTERVAL = 60
+# 超过该时间未刷新心跳的运行中记录视为已终止，回收其占用的并发数，单位秒
+RUNNING_EXPIRE = HEARTBEAT_INTERVAL * 10
+# 优先级在排序分数中的权重，保证优先级高的任务先执行，同优先级按照入队时间先后执行
+PRIORITY_WEIGHT = 10**10
+
+
+def _concurrency():
+    """
+    获取并发限制，返回 (全局并发数, 单个源实例并发数)
+    全局并发数默认为django-q的workers数量减一，保留一个worker给SQL执行等其他任务
+    """
+    config = SysConfig()
+    workers = int(settings.Q_CLUSTER.get("workers") or 4)
+    max_concurrency = int(config.get("archive_max_concurrency") or max(1, workers - 1))
+    instance_concurrency = int(config.get("archive_instance_concurrency") or 1)
+    return max_concurrency, instance_concurrency
+
+
+def in_time_window(now=None):
+    """
+    是否在允许归档的时间窗口内，archive_time_window格式为 01:00-06:00，支持跨天，多个窗口使用逗号分隔
+    未配置时不限制
+    """
+    windows = SysConfig().get("archive_time_window")
+    if not windows:
+        return True
+    now = (now or datetime.datetime.now()).strftime("%H:%M")
+    for window in windows.split(","):
+        try:
+            start, end = [t.strip().zfill(5) for t in window.split("-")]
+        except ValueError:
+            logger.warning(f"归档时间窗口配置错误：{window}")
+            continue
+        if start <= end and start <= now < end:
+            return True
+        if start > end and (now >= start or now < end):
+            return True
+    return False
+
+
+def enqueue(archive_cnf_list):
+    """
+    将归档任务加入调度队列，已在队列中或者正在执行的任务不重复添加
+    :param archive_cnf_list: ArchiveConfig列表
+    :return:
+    """
+    redis = get_redis_connection("default")
+    now = time.time()
+    running = redis.hkeys(RUNNING_KEY)
+    running = {int(archive_id) for archive_id in running}
+    for archive_info in archive_cnf_list:
+        if archive_info.id in running:
+            continue
+        score = -archive_info.priority * PRIORITY_WEIGHT + now
+        if redis.zadd(QUEUE_KEY, {archive_info.id: score}, nx=True):
+            redis.hset(QUEUE_TIME_KEY, archive_info.id, now)
+    # 定时调度队列，时间窗口开始或者运行中的任务被终止后，队列中的任务也可以启动
+    if not task_info("归档调度"):
+        add_archive_dispatch_schedule()
+    dispatch()
+
+
+def dispatch():
+    """
+    按照优先级从队列中取出归档任务执行，受时间窗口、全局并发数和单个源实例并发数限制
+    归档任务执行结束后会再次调度，同时每分钟定时调度一次，队列中的任务依次执行
+    :return: 本次启动的归档任务id列表
+    """
+    if not in_time_window():
+        return []
+    max_concurrency, instance_concurrency = _concurrency()
+    redis = get_redis_connection("default")
+    started = []
+    with redis.lock(LOCK_KEY, timeout=60, blocking_timeout=10):
+        running = {}
+        now = time.time()
+        for archive_id, value in redis.hgetall(RUNNING_KEY).items():
+            value = json.loads(value)
+            if now - value.get("heartbeat", value["start"]) > RUNNING_EXPIRE:
+                redis.hdel(RUNNING_KEY, archive_id)
+                continue
+            running[int(archive_id)] = value["instance_id"]
+        queue = [int(archive_id) for archive_id in redis.zrange(QUEUE_KEY, 0, -1)]
+        if not queue or len(running) >= max_concurrency:
+            return []
+        archive_configs = ArchiveConfig.objects.in_bulk(queue)
+        instance_running = {}
+        for instance_id in running.values():
+            instance_running[instance_id] = instance_running.get(instance_id, 0) + 1
+        for archive_id in queue:
+            if len(running) >= max_concurrency:
+                break
+            archive_info = archive_configs.get(archive_id)
+            # 已删除的归档配置直接出队
+            if archive_info is None:
+                redis.zrem(QUEUE_KEY, archive_id)
+                redis.hdel(QUEUE_TIME_KEY, archive_id)
+                continue
+            instance_id = archive_info.src_instance_id
+            if instance_running.get(instance_id, 0) >= instance_concurrency:
+                continue
+            queue_time = float(redis.hget(QUEUE_TIME_KEY, archive_id) or now)
+            redis.zrem(QUEUE_KEY, archive_id)
+            redis.hdel(QUEUE_TIME_KEY, archive_id)
+            redis.hset(
+                RUNNING_KEY,
+                archive_id,
+                json.dumps({"instance_id": instance_id, "start": now}),
+            )
+            running[archive_id] = instance_id
+            instance_running[instance_id] = instance_running.get(instance_id, 0) + 1
+            started.append((archive_id, queue_time))
+    # 释放锁之后再添加任务，同步模式下任务结束时会再次调度
+    for archive_id, queue_time in started:
+        async_task(
+            "sql.utils.archive_scheduler.run_archive",
+            archive_id,
+            queue_time,
+            timeout=-1,
+            task_name=f"archive-{archive_id}",
+        )
+    return [archive_id for archive_id, _ in started]
+
+
+def _heartbeat(archive_id, stopped):
+    """归档任务执行期间定时刷新运行中记录的心跳，记录已被回收时不再写入"""
+    redis = get_redis_connection("default")
+    while not stopped.wait(HEARTBEAT_INTERVAL):
+        try:
+            value = redis.hget(RUNNING_KEY, archive_id)
+            if value is None:
+                continue
+            value = json.loads(value)
+            value["heartbeat"] = time.time()
+            redis.hset(RUNNING_KEY, archive_id, json.dumps(value))
+        except Exception as e:
+            logger.warning(f"归档任务{archive_id}刷新心跳失败：{e}")
+
+
+def run_archive(archive_id, queue_time=None):
+    """执行调度的归档任务，结束后释放并发数并调度下一个任务"""
+    from sql.archiver import archive
+
+    stopped = threading.Event()
+    heartbeat = threading.Thread(
+        target=_heartbeat, args=(archive_id, stopped), daemon=True
+    )
+    heartbeat.start()
+    try:
+        archive(
+            archive_id,
+            queue_time=datetime.datetime.fromtimestamp(queue_time)
+            if queue_time
+            else None,
+        )
+    finally:
+        stopped.set()
+        heartbeat.join()
+        try:
+            get_redis_connection("default").hdel(RUNNING_KEY, archive_id)
+            dispatch()
+        except Exception as e:
+            logger.error(f"归档任务调度失败：{e}")
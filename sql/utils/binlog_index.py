@@ -0,0 +1,226 @@
+# -*- coding:utf-8 -*-
+"""
+@license: Apache Licence
+@file: binlog_index.py
+@time: 2026/10/17
+"""
+import datetime
+import logging
+import random
+
+from pymysqlreplication import BinLogStreamReader
+from pymysqlreplication.event import GtidEvent, QueryEvent, XidEvent
+
+from common.config import SysConfig
+from sql.engines import get_engine
+from sql.models import BinlogIndex, BinlogPosition, Instance
+
+logger = logging.getLogger("default")
+
+# 稀疏位置索引的时间间隔，单位秒
+CHECKPOINT_INTERVAL = 60
+# 按时间定位位置时前后预留的时间，避免事务提交顺序和事件时间不一致时漏掉数据
+LOCATE_SLACK = datetime.timedelta(seconds=CHECKPOINT_INTERVAL)
+# binlog文件中第一个事件的位置
+BINLOG_START_POS = 4
+
+
+def _parse_gtid_set(gtid_set):
+    """uuid:1-10,uuid:5-6 转换为 {uuid: [1, 10]}"""
+    gtids = {}
+    for item in filter(None, gtid_set.split(",")):
+        sid, _, interval = item.rpartition(":")
+        start, _, end = interval.partition("-")
+        gtids[sid] = [int(start), int(end or start)]
+    return gtids
+
+
+def _format_gtid_set(gtids):
+    return ",".join(
+        f"{sid}:{start}-{end}" if start != end else f"{sid}:{start}"
+        for sid, (start, end) in sorted(gtids.items())
+    )
+
+
+def _index_file(instance, index, file_size):
+    """从已索引的位置开始读取单个binlog文件，记录时间范围、GTID范围和稀疏位置"""
+    stream = BinLogStreamReader(
+        connection_settings={
+            "host": instance.host,
+            "port": int(instance.port),
+            "user": instance.user,
+            "passwd": instance.password,
+        },
+        server_id=random.randint(100000000, 999999999),
+        log_file=index.log_file,
+        log_pos=index.indexed_pos or BINLOG_START_POS,
+        resume_stream=True,
+        blocking=False,
+        only_events=[GtidEvent, QueryEvent, XidEvent],
+    )
+    last_position = (
+        BinlogPosition.objects.filter(instance=instance, log_file=index.log_file)
+        .order_by("-log_pos")
+        .first()
+    )
+    last_checkpoint = last_position.event_time if last_position else None
+    gtids = _parse_gtid_set(index.gtid_set)
+    positions = []
+    try:
+        for event in stream:
+            # 读取到下一个文件时结束
+            if stream.log_file != index.log_file:
+                break
+            if not event.timestamp:
+                continue
+            event_time = datetime.datetime.fromtimestamp(event.timestamp)
+            if index.first_time is None or event_time < index.first_time:
+                index.first_time = event_time
+            if index.last_time is None or event_time > index.last_time:
+                index.last_time = event_time
+            if isinstance(event, GtidEvent):
+                sid, _, gno = event.gtid.rpartition(":")
+                start, end = gtids.get(sid, [int(gno), int(gno)])
+                gtids[sid] = [min(start, int(gno)), max(end, int(gno))]
+                continue
+            if isinstance(event, QueryEvent) and event.query.strip().upper() == "BEGIN":
+                continue
+            # 事务提交或者DDL之后的位置可以作为解析的开始位置
+            index.indexed_pos = event.packet.log_pos
+            if (
+                last_checkpoint is None
+                or (event_time - last_checkpoint).total_seconds() >= CHECKPOINT_INTERVAL
+            ):
+                positions.append(
+                    BinlogPosition(
+                        instance=instance,
+                        log_file=index.log_file,
+                        log_pos=event.packet.log_pos,
+                        event_time=event_time,
+                    )
+                )
+                last_checkpoint = event_time
+    finally:
+        stream.close()
+    BinlogPosition.objects.bulk_create(positions, batch_size=1000)
+    index.file_size = file_size
+    index.gtid_set = _format_gtid_set(gtids)
+    index.save()
+    return len(positions)
+
+
+def index_instance(instance):
+    """
+    增量索引实例的binlog，已经清理的binlog同时删除索引，只读取未索引的部分
+    :return: 本次新增的位置索引数
+    """
+    query_engine = get_engine(instance=instance)
+    result = query_engine.query("information_schema", "show binary logs;")
+    if result.error:
+        raise RuntimeError(f"获取binlog列表失败：{result.error}")
+    logs = [(row[0], int(row[1])) for row in result.rows]
+    log_files = [log_file for log_file, _ in logs]
+    BinlogIndex.objects.filter(instance=instance).exclude(
+        log_file__in=log_files
+    ).delete()
+    BinlogPosition.objects.filter(instance=instance).exclude(
+        log_file__in=log_files
+    ).delete()
+    count = 0
+    for log_file, file_size in logs:
+        index, _ = BinlogIndex.objects.get_or_create(
+            instance=instance, log_file=log_file
+        )
+        if index.file_size >= file_size:
+            continue
+        count += _index_file(instance, index, file_size)
+    return count
+
+
+def index_task():
+    """定时索引binlog_index_instances中配置的实例，多个实例使用逗号分隔"""
+    instance_names = SysConfig().get("binlog_index_instances") or ""
+    for instance_name in filter(None, [n.strip() for n in instance_names.split(",")]):
+        try:
+            instance = Instance.objects.get(
+                instance_name=instance_name, db_type="mysql"
+            )
+            index_instance(instance)
+        except Exception as e:
+            logger.error(f"实例{instance_name}binlog索引失败：{e}")
+
+
+def _parse_time(value):
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M"):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def locate_start(instance, start_time):
+    """
+    定位开始时间之前最近的事务结束位置
+    :return: (binlog文件, 位置)，没有索引时返回None
+    """
+    position = (
+        BinlogPosition.objects.filter(
+            instance=instance, event_time__lte=start_time - LOCATE_SLACK
+        )
+        .order_by("-event_time", "-log_file", "-log_pos")
+        .first()
+    )
+    if position:
+        return position.log_file, position.log_pos
+    # 开始时间早于所有位置索引时，从第一个包含该时间的文件开头读取
+    index = (
+        BinlogIndex.objects.filter(instance=instance, last_time__gte=start_time)
+        .order_by("log_file")
+        .first()
+    )
+    return (index.log_file, BINLOG_START_POS) if index else None
+
+
+def locate_stop(instance, stop_time):
+    """
+    定位结束时间之后最近的事务结束位置
+    :return: (binlog文件, 位置)，结束时间晚于已索引的范围时返回None
+    """
+    position = (
+        BinlogPosition.objects.filter(
+            instance=instance, event_time__gte=stop_time + LOCATE_SLACK
+        )
+        .order_by("event_time", "log_file", "log_pos")
+        .first()
+    )
+    return (position.log_file, position.log_pos) if position else None
+
+
+def resolve_range(
+    instance, start_file, start_pos, end_file, end_pos, start_time, stop_time
+):
+    """
+    根据binlog索引收窄解析范围，仅在定位的位置比页面指定的位置更精确时替换
+    :return: (start_file, start_pos, end_file, end_pos)
+    """
+    start_time = _parse_time(start_time) if start_time else None
+    stop_time = _parse_time(stop_time) if stop_time else None
+    if start_time:
+        located = locate_start(instance, start_time)
+        if located and (
+            not start_file or located > (start_file, start_pos or BINLOG_START_POS)
+        ):
+            start_file, start_pos = located
+    if stop_time:
+        located = locate_stop(instance, stop_time)
+        if located and (not end_file or located < (end_file, end_pos or float("inf"))):
+            end_file, end_pos = located
+    return start_file, start_pos, end_file, end_pos
+
+
+def file_index(instance):
+    """:return: {binlog文件: BinlogIndex}"""
+    return {
+        index.log_file: index for index in BinlogIndex.objects.filter(instance=instance)
+    }
@@ -0,0 +1,390 @@
+# -*- coding:utf-8 -*-
+"""
+@license: Apache Licence
+@file: binlog_parser.py
+@time: 2026/10/17
+"""
+import datetime
+import decimal
+import logging
+import os
+import random
+from itertools import islice
+
+import MySQLdb
+import simplejson as json
+from pymysqlreplication import BinLogStreamReader
+from pymysqlreplication.row_event import (
+    DeleteRowsEvent,
+    UpdateRowsEvent,
+    WriteRowsEvent,
+)
+
+logger = logging.getLogger("default")
+
+ROW_EVENTS = {
+    "insert": WriteRowsEvent,
+    "update": UpdateRowsEvent,
+    "delete": DeleteRowsEvent,
+}
+# 文件写入的缓冲行数，所有表合计，超过后批量追加到文件
+WRITE_BUFFER_SIZE = 1000
+# 回滚文件倒序时每次读取的块大小
+REVERSE_BLOCK_SIZE = 1024 * 1024
+
+
+def _to_timestamp(value):
+    """页面传入的时间转换为时间戳，为空时返回None"""
+    if not value:
+        return None
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M"):
+        try:
+            return int(datetime.datetime.strptime(value, fmt).timestamp())
+        except ValueError:
+            continue
+    raise ValueError(f"时间格式错误：{value}")
+
+
+def _quote_name(name):
+    return "`{}`".format(str(name).replace("`", "``"))
+
+
+def _literal(value):
+    """binlog中的列值转换为SQL字面量"""
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, (int, float, decimal.Decimal)):
+        return str(value)
+    if isinstance(value, bytes):
+        return f"0x{value.hex()}" if value else "''"
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value, ensure_ascii=False)
+    elif isinstance(value, set):
+        value = ",".join(sorted(value))
+    # 换行等字符会被转义，每条SQL只占一行
+    return "'{}'".format(MySQLdb.escape_string(str(value)).decode("utf-8"))
+
+
+class RowChange(object):
+    """binlog中单行数据的变更"""
+
+    def __init__(
+        self, sql_type, schema, table, primary_key, before, after, log_file, log_pos
+    ):
+        self.sql_type = sql_type
+        self.schema = schema
+        self.table = table
+        self.primary_key = primary_key
+        # insert仅有after，delete仅有before
+        self.before = before
+        self.after = after
+        self.log_file = log_file
+        self.log_pos = log_pos
+        self.timestamp = None
+
+    def _table_name(self, no_db_prefix):
+        if no_db_prefix:
+            return _quote_name(self.table)
+        return f"{_quote_name(self.schema)}.{_quote_name(self.table)}"
+
+    def _where(self, values, full_columns):
+        columns = list(values)
+        if self.primary_key and not full_columns:
+            columns = [
+                column for column in columns if column in self.primary_key
+            ] or columns
+        return " AND ".join(
+            f"{_quote_name(column)} IS NULL"
+            if values[column] is None
+            else f"{_quote_name(column)}={_literal(values[column])}"
+            for column in columns
+        )
+
+    def _insert(self, values, table_name, ignore_primary_key):
+        columns = [
+            column
+            for column in values
+            if not (ignore_primary_key and column in self.primary_key)
+        ]
+        return "INSERT INTO {} ({}) VALUES ({});".format(
+            table_name,
+            ",".join(_quote_name(column) for column in columns),
+            ",".join(_literal(values[column]) for column in columns),
+        )
+
+    def _update(self, before, after, table_name, full_columns):
+        columns = [
+            column
+            for column in after
+            if full_columns or before.get(column) != after[column]
+        ] or list(after)
+        return "UPDATE {} SET {} WHERE {};".format(
+            table_name,
+            ",".join(
+                f"{_quote_name(column)}={_literal(after[column])}" for column in columns
+            ),
+            self._where(before, full_columns),
+        )
+
+    def to_sql(
+        self,
+        rollback=False,
+        full_columns=False,
+        no_db_prefix=False,
+        ignore_primary_key=False,
+        extra_info=False,
+    ):
+        """
+        生成正向或者回滚SQL，参数含义和my2sql一致
+        :return: 单行SQL
+        """
+        table_name = self._table_name(no_db_prefix)
+        sql_type = self.sql_type
+        if rollback:
+            sql_type = {"insert": "delete", "delete": "insert"}.get(sql_type, sql_type)
+        if sql_type == "insert":
+            values = self.before if rollback else self.after
+            sql = self._insert(values, table_name, ignore_primary_key)
+        elif sql_type == "delete":
+            values = self.after if rollback else self.before
+            sql = f"DELETE FROM {table_name} WHERE {self._where(values, full_columns)};"
+        elif rollback:
+            sql = self._update(self.after, self.before, table_name, full_columns)
+        else:
+            sql = self._update(self.before, self.after, table_name, full_columns)
+        if extra_info:
+            dt = (
+                datetime.datetime.fromtimestamp(self.timestamp)
+                if self.timestamp
+                else ""
+            )
+            sql += f" # datetime={dt} binlog={self.log_file} stoppos={self.log_pos}"
+        return sql
+
+
+class BinlogSQLWriter(object):
+    """
+    将SQL写入文件，可以按表拆分文件，所有表共用WRITE_BUFFER_SIZE行的缓冲
+    回滚SQL需要倒序执行，关闭时将文件按行倒序
+    """
+
+    def __init__(self, path, work_type, file_per_table=False):
+        self.path = path
+        self.work_type = work_type
+        self.file_per_table = file_per_table
+        self.buffers = {}
+        self.buffered = 0
+        self.files = set()
+        self.count = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _file_name(self, change):
+        if self.file_per_table:
+            name = f"{change.schema}.{change.table}.{self.work_type}.sql"
+        else:
+            name = f"{self.work_type}.sql"
+        return os.path.join(self.path, name)
+
+    def write(self, change, sql):
+        self.buffers.setdefault(self._file_name(change), []).append(sql)
+        self.buffered += 1
+        self.count += 1
+        if self.buffered >= WRITE_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        for file_name, lines in self.buffers.items():
+            with open(file_name, "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+            self.files.add(file_name)
+        self.buffers = {}
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+        if self.work_type == "rollback":
+            for file_name in self.files:
+                _reverse_lines(file_name)
+        return sorted(self.files)
+
+
+def _reverse_lines(file_name):
+    """按块从文件末尾读取，将文件按行倒序，内存中仅保留一个块"""
+    tmp_name = f"{file_name}.tmp"
+    with open(file_name, "rb") as src, open(tmp_name, "wb") as dst:
+        src.seek(0, os.SEEK_END)
+        position = src.tell()
+        tail = b""
+        while position > 0:
+            size = min(REVERSE_BLOCK_SIZE, position)
+            position -= size
+            src.seek(position)
+            lines = (src.read(size) + tail).split(b"\n")
+            # 块的第一行可能不完整，和下一个块拼接
+            tail = lines.pop(0)
+            for line in reversed(lines):
+                if line:
+                    dst.write(line + b"\n")
+        if tail:
+            dst.write(tail + b"\n")
+    os.replace(tmp_name, file_name)
+
+
+class Binlog2SQL(object):
+    """
+    进程内解析binlog，流式读取行事件并生成正向或者回滚SQL，参数和my2sql保持一致
+    库、表、类型过滤在解析行数据之前完成，未命中的事件不会解码
+    """
+
+    def __init__(
+        self,
+        instance,
+        work_type="2sql",
+        start_file=None,
+        start_pos=None,
+        end_file=None,
+        end_pos=None,
+        start_time=None,
+        stop_time=None,
+        only_schemas=None,
+        only_tables=None,
+        sql_type=None,
+        extra_info=False,
+        ignore_primary_key=False,
+        full_columns=False,
+        no_db_prefix=False,
+        file_per_table=False,
+    ):
+        self.instance = instance
+        self.work_type = work_type
+        self.start_file = start_file
+        self.start_pos = start_pos or 4
+        self.end_file = end_file
+        self.end_pos = end_pos
+        self.start_time = _to_timestamp(start_time)
+        self.stop_time = _to_timestamp(stop_time)
+        self.only_schemas = [schema for schema in only_schemas or [] if schema]
+        self.only_tables = [table for table in only_tables or [] if table]
+        self.sql_type = [t for t in sql_type or [] if t in ROW_EVENTS] or list(
+            ROW_EVENTS
+        )
+        self.sql_options = {
+            "rollback": work_type == "rollback",
+            "full_columns": full_columns,
+            "no_db_prefix": no_db_prefix,
+            "ignore_primary_key": ignore_primary_key,
+            "extra_info": extra_info,
+        }
+        self.file_per_table = file_per_table
+
+    def open_stream(self):
+        """以从库身份连接实例，读取到当前最新的binlog后结束"""
+        return BinLogStreamReader(
+            connection_settings={
+                "host": self.instance.host,
+                "port": int(self.instance.port),
+                "user": self.instance.user,
+                "passwd": self.instance.password,
+            },
+            server_id=random.randint(100000000, 999999999),
+            log_file=self.start_file,
+            log_pos=self.start_pos,
+            resume_stream=True,
+            blocking=False,
+            only_events=[ROW_EVENTS[t] for t in self.sql_type],
+            only_schemas=self.only_schemas or None,
+            only_tables=self.only_tables or None,
+            skip_to_timestamp=self.start_time,
+        )
+
+    def _finished(self, log_file, log_pos, timestamp):
+        if self.stop_time and timestamp > self.stop_time:
+            return True
+        if not self.end_file or not log_file:
+            return False
+        if log_file > self.end_file:
+            return True
+        return (
+            log_file == self.end_file and bool(self.end_pos) and log_pos > self.end_pos
+        )
+
+    def _matched(self, event):
+        if self.only_schemas and event.schema not in self.only_schemas:
+            return False
+        if self.only_tables and event.table not in self.only_tables:
+            return False
+        return True
+
+    def iter_changes(self, stream=None):
+        """
+        流式读取行变更，提前结束迭代时关闭binlog连接
+        :param stream: binlog事件流，默认连接实例读取，测试时可以传入事件列表
+        :return: 生成器 RowChange
+        """
+        stream = stream or self.open_stream()
+        types = {ROW_EVENTS[t]: t for t in self.sql_type}
+        try:
+            for event in stream:
+                log_file = getattr(stream, "log_file", None)
+                log_pos = event.packet.log_pos
+                if self._finished(log_file, log_pos, event.timestamp):
+                    break
+                sql_type = next(
+                    (t for cls, t in types.items() if isinstance(event, cls)), None
+                )
+                if sql_type is None or not self._matched(event):
+                    continue
+                primary_key = event.primary_key or ()
+                if isinstance(primary_key, str):
+                    primary_key = (primary_key,)
+                for row in event.rows:
+                    change = RowChange(
+                        sql_type,
+                        event.schema,
+                        event.table,
+                        primary_key,
+                        row.get("before_values", row.get("values"))
+                        if sql_type != "insert"
+                        else None,
+                        row.get("after_values", row.get("values"))
+                        if sql_type != "delete"
+                        else None,
+                        log_file,
+                        log_pos,
+                    )
+                    change.timestamp = event.timestamp
+                    yield change
+        finally:
+            stream.close()
+
+    def iter_sql(self, stream=None):
+        """:return: 生成器 (RowChange, SQL)"""
+        for change in self.iter_changes(stream):
+            yield change, change.to_sql(**self.sql_options)
+
+    def preview(self, num, stream=None):
+        """读取前num条SQL后立即断开连接，用于页面展示"""
+        sql_iter = self.iter_sql(stream)
+        try:
+            return [{"sql": sql} for _, sql in islice(sql_iter, num)]
+        finally:
+            sql_iter.close()
+
+    def save(self, path, stream=None):
+        """
+        单次读取binlog写入文件，开启file_per_table时按表拆分文件
+        :return: 写入的SQL条数
+        """
+        writer = BinlogSQLWriter(
+            path,
+            "rollback" if self.sql_options["rollback"] else "forward",
+            self.file_per_table,
+        )
+        try:
+            for change, sql in self.iter_sql(stream):
+                writer.write(change, sql)
+        finally:
+            writer.close()
+        return writer.count
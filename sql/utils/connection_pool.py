@@ -0,0 +1,176 @@
+# -*- coding:utf-8 -*-
+"""
+@license: Apache Licence
+@file: connection_pool.py
+@time: 2026/10/17
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger("default")
+
+# 进程内共享的连接池，key 为 (instance_id, db_name)
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class PoolExhausted(Exception):
+    """连接池已满，并且在等待时间内没有可用连接"""
+
+
+class ConnectionPool(object):
+    """
+    线程安全的数据库连接池，供 engine 复用实例连接
+    :param creator: 创建新连接的函数
+    :param max_size: 池内最大连接数(包括借出的连接)
+    :param idle_timeout: 空闲连接的最长保留时间，单位秒
+    :param wait_timeout: 连接池已满时等待可用连接的最长时间，单位秒
+    :param ping: 连接健康检查函数，连接异常时抛出异常
+    :param reset: 归还连接时重置会话状态的函数，失败时抛出异常
+    """
+
+    def __init__(
+        self,
+        creator,
+        max_size=10,
+        idle_timeout=300,
+        wait_timeout=10,
+        ping=None,
+        reset=None,
+    ):
+        self.creator = creator
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.ping = ping
+        self.reset = reset
+        self.closed = False
+        # 空闲连接列表，元素为 (conn, 最后使用时间)
+        self._idle = deque()
+        self._size = 0
+        self._cond = threading.Condition()
+
+    @property
+    def size(self):
+        """池内连接总数，包括借出的连接"""
+        return self._size
+
+    @property
+    def idle_size(self):
+        """池内空闲连接数"""
+        return len(self._idle)
+
+    def acquire(self):
+        """从池内获取一个可用连接，没有空闲连接时新建，连接数已满时等待"""
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            conn = None
+            with self._cond:
+                self._evict_idle()
+                if self._idle:
+                    # 优先使用最近归还的连接，让长期空闲的连接自然过期
+                    conn, _ = self._idle.pop()
+                elif self._size < self.max_size:
+                    self._size += 1
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolExhausted(
+                            f"连接池已满(max_size={self.max_size})，等待{self.wait_timeout}秒后仍无可用连接"
+                        )
+                    self._cond.wait(remaining)
+                    continue
+            # 网络操作放在锁外执行，避免阻塞其他线程
+            if conn is None:
+                try:
+                    return self.creator()
+                except Exception:
+                    self._forget()
+                    raise
+            try:
+                if self.ping:
+                    self.ping(conn)
+                return conn
+            except Exception as e:
+                logger.info(f"连接池连接健康检查失败，丢弃连接：{e}")
+                self._discard(conn)
+
+    def release(self, conn):
+        """归还连接，重置会话状态失败或连接池已关闭时直接关闭连接"""
+        if self.closed:
+            self._discard(conn)
+            return
+        try:
+            if self.reset:
+                self.reset(conn)
+        except Exception as e:
+            logger.info(f"连接池连接重置失败，丢弃连接：{e}")
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def close(self):
+        """关闭连接池，关闭全部空闲连接，借出的连接归还时关闭"""
+        with self._cond:
+            self.closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+        for conn in idle:
+            self._discard(conn)
+
+    def _evict_idle(self):
+        """清理超过空闲时间的连接，需要在持有锁时调用"""
+        now = time.monotonic()
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            conn, _ = self._idle.popleft()
+            self._size -= 1
+            _close_quietly(conn)
+
+    def _discard(self, conn):
+        _close_quietly(conn)
+        self._forget()
+
+    def _forget(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+def get_pool(key, signature, creator, **kwargs):
+    """
+    获取进程内共享的连接池，不存在时创建
+    :param key: 连接池标识，如 (instance_id, db_name)
+    :param signature: 连接信息签名，实例连接信息修改后会重建连接池
+    :param creator: 创建新连接的函数
+    :param kwargs: ConnectionPool 的其他参数
+    :return:
+    """
+    with _pools_lock:
+        pool, pool_signature = _pools.get(key, (None, None))
+        if pool is not None and pool_signature == signature and not pool.closed:
+            return pool
+        if pool is not None:
+            pool.close()
+        pool = ConnectionPool(creator, **kwargs)
+        _pools[key] = (pool, signature)
+        return pool
+
+
+def close_pools(instance_id=None):
+    """关闭连接池，不指定实例时关闭全部连接池"""
+    with _pools_lock:
+        keys = [k for k in _pools if instance_id is None or k[0] == instance_id]
+        pools = [_pools.pop(k)[0] for k in keys]
+    for pool in pools:
+        pool.close()
@@ -1,7 +1,12 @@
 # -*- coding:utf-8 -*-
 import logging
 
+import uuid
+
 import sqlparse
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.forms import model_to_dict
 from sqlparse.tokens import Keyword
 import pandas as pd
@@ -13,43 +18,85 @@ import traceback
 
 logger = logging.getLogger("default")
 
+# 脱敏规则版本号，规则变更时更新，各进程据此判断是否需要重新编译规则
+MASKING_RULES_VERSION_KEY = "data_masking_rules_version"
+# 进程内缓存的已编译脱敏规则 (版本号, {rule_type: Masker})
+_compiled_rules = (None, {})
+
+
+class Masker(object):
+    """编译后的脱敏规则，正则表达式只编译一次"""
+
+    def __init__(self, rule_regex, hide_group):
+        self.rule_regex = rule_regex
+        self.hide_group = int(hide_group)
+        self.pattern = re.compile(rule_regex, re.I)
+        self.pattern_dotall = re.compile(rule_regex, re.I | re.S)
+        # 正则替换模式，隐藏的组使用****代替
+        self.replace_pattern = "".join(
+            "****" if i == self.hide_group else rf"\{i}"
+            for i in range(1, self.pattern.groups + 1)
+        )
+
+    def mask(self, value):
+        """利用正则表达式分组脱敏数据，未匹配时返回原值"""
+        m = self.pattern.search(str(value))
+        if m is None:
+            return value
+        groups = list(m.groups("")[: m.lastindex])
+        if 0 < self.hide_group <= len(groups):
+            groups[self.hide_group - 1] = "****"
+        return "".join(groups)
+
+    def sub(self, value, dotall=False):
+        """利用正则表达式替换脱敏数据"""
+        pattern = self.pattern_dotall if dotall else self.pattern
+        return pattern.sub(self.replace_pattern, str(value))
+
+
+def compiled_masking_rules():
+    """获取已编译的全部脱敏规则，{rule_type: Masker}，规则版本号未变化时复用进程内缓存"""
+    global _compiled_rules
+    try:
+        version = cache.get(MASKING_RULES_VERSION_KEY)
+        if version is None:
+            cache.add(MASKING_RULES_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+            version = cache.get(MASKING_RULES_VERSION_KEY)
+    except Exception as e:
+        logger.warning(f"获取脱敏规则版本号失败，直接读取脱敏规则：{e}")
+        version = None
+    if version is None or _compiled_rules[0] != version:
+        rules = {
+            i.rule_type: Masker(i.rule_regex, i.hide_group)
+            for i in DataMaskingRules.objects.all()
+        }
+        if version is None:
+            return rules
+        _compiled_rules = (version, rules)
+    return _compiled_rules[1]
+
+
+@receiver(post_save, sender=DataMaskingRules)
+@receiver(post_delete, sender=DataMaskingRules)
+@receiver(post_save, sender=DataMaskingColumns)
+@receiver(post_delete, sender=DataMaskingColumns)
+def invalidate_masking_rules(**kwargs):
+    """脱敏规则或脱敏字段变更后更新版本号，各进程下次脱敏时重新编译规则，查询结果缓存同时失效"""
+    try:
+        cache.set(MASKING_RULES_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+    except Exception as e:
+        logger.error(f"更新脱敏规则版本号失败：{e}")
+
 
 def data_masking(instance, db_name, sql, sql_result):
     """脱敏数据"""
     try:
-        keywords_count = {}
-        # 解析查询语句，判断UNION需要单独处理
-        p = sqlparse.parse(sql)[0]
-        for token in p.tokens:
-            if token.ttype is Keyword and token.value.upper() in ["UNION", "UNION ALL"]:
-                keywords_count["UNION"] = keywords_count.get("UNION", 0) + 1
-        # 通过goInception获取select list
-        inception_engine = GoInceptionEngine()
-        select_list = inception_engine.query_data_masking(
-            instance=instance, db_name=db_name, sql=sql
-        )
-        # 如果UNION存在，那么调用去重函数
-        select_list = (
-            del_repeat(select_list, keywords_count) if keywords_count else select_list
-        )
         # 分析语法树获取命中脱敏规则的列数据
-        hit_columns = analyze_query_tree(select_list, instance)
+        hit_columns = get_hit_columns(instance, db_name, sql)
         sql_result.mask_rule_hit = True if hit_columns else False
         # 对命中规则列hit_columns的数据进行脱敏
-        masking_rules = {
-            i.rule_type: model_to_dict(i) for i in DataMaskingRules.objects.all()
-        }
         if hit_columns and sql_result.rows:
-            rows = list(sql_result.rows)
-            for column in hit_columns:
-                index, rule_type = column["index"], column["rule_type"]
-                masking_rule = masking_rules.get(rule_type)
-                if not masking_rule:
-                    continue
-                for idx, item in enumerate(rows):
-                    rows[idx] = list(item)
-                    rows[idx][index] = regex(masking_rule, rows[idx][index])
-                sql_result.rows = rows
+            sql_result.rows = mask_rows(sql_result.rows, hit_columns, masking_rules())
             # 脱敏结果
             sql_result.is_masked = True
     except Exception as msg:
@@ -59,6 +106,51 @@ def data_masking(instance, db_name, sql, sql_result):
     return sql_result
 
 
+def get_hit_columns(instance, db_name, sql):
+    """通过goInception解析查询语句，返回命中脱敏规则的列信息"""
+    keywords_count = {}
+    # 解析查询语句，判断UNION需要单独处理
+    p = sqlparse.parse(sql)[0]
+    for token in p.tokens:
+        if token.ttype is Keyword and token.value.upper() in ["UNION", "UNION ALL"]:
+            keywords_count["UNION"] = keywords_count.get("UNION", 0) + 1
+    # 通过goInception获取select list
+    inception_engine = GoInceptionEngine()
+    select_list = inception_engine.query_data_masking(
+        instance=instance, db_name=db_name, sql=sql
+    )
+    # 如果UNION存在，那么调用去重函数
+    select_list = (
+        del_repeat(select_list, keywords_count) if keywords_count else select_list
+    )
+    return analyze_query_tree(select_list, instance)
+
+
+def masking_rules():
+    """获取全部脱敏规则，{rule_type: Masker}"""
+    return compiled_masking_rules()
+
+
+def mask_rows(rows, hit_columns, rules):
+    """
+    按照命中规则的列信息对结果集数据进行脱敏，返回脱敏后的数据列表
+    先生成 列索引 -> 脱敏规则 的执行计划，再单次遍历结果集
+    """
+    plan = [
+        (column["index"], rules[column["rule_type"]])
+        for column in hit_columns
+        if column["rule_type"] in rules
+    ]
+    # 单次遍历结果集，每行只转换一次
+    masked_rows = []
+    for row in rows:
+        row = list(row)
+        for index, masker in plan:
+            row[index] = masker.mask(row[index])
+        masked_rows.append(row)
+    return masked_rows
+
+
 def del_repeat(select_list, keywords_count):
     """输入的 data 是inception_engine.query_data_masking的list结果
     去重前
@@ -120,26 +212,6 @@ def analyze_query_tree(select_list, instance):
     return hit_columns
 
 
-def regex(masking_rule, value):
-    """利用正则表达式脱敏数据"""
-    rule_regex = masking_rule["rule_regex"]
-    hide_group = masking_rule["hide_group"]
-    # 正则匹配必须分组，隐藏的组会使用****代替
-    try:
-        p = re.compile(rule_regex, re.I)
-        m = p.search(str(value))
-        masking_str = ""
-        for i in range(m.lastindex):
-            if i == hide_group - 1:
-                group = "****"
-            else:
-                group = m.group(i + 1)
-            masking_str = masking_str + group
-        return masking_str
-    except AttributeError:
-        return value
-
-
 def brute_mask(instance, sql_result):
     """输入的是一个resultset
     sql_result.full_sql
@@ -148,30 +220,22 @@ def brute_mask(instance, sql_result):
     返回同样结构的sql_result , error 中写入脱敏时产生的错误.
     """
     # 读取所有关联实例的脱敏规则，去重后应用到结果集，不会按照具体配置的字段匹配
-    rule_types = (
+    rule_types = set(
         DataMaskingColumns.objects.filter(instance=instance)
         .values_list("rule_type", flat=True)
         .distinct()
     )
-    masking_rules = DataMaskingRules.objects.filter(rule_type__in=rule_types)
-    for reg in masking_rules:
-        compiled_r = re.compile(reg.rule_regex, re.I)
-        replace_pattern = r""
-        rows = list(sql_result.rows)
-        for i in range(1, compiled_r.groups + 1):
-            if i == int(reg.hide_group):
-                replace_pattern += r"****"
-            else:
-                replace_pattern += r"\{}".format(i)
-        for i in range(len(sql_result.rows)):
-            temp_value_list = []
-            for j in range(len(sql_result.rows[i])):
-                # 进行正则替换
-                temp_value_list += [
-                    compiled_r.sub(replace_pattern, str(sql_result.rows[i][j]))
-                ]
-            rows[i] = tuple(temp_value_list)
-        sql_result.rows = rows
+    maskers = [m for t, m in compiled_masking_rules().items() if t in rule_types]
+    if not maskers or not sql_result.rows:
+        return sql_result
+    # 每个单元格依次应用全部规则
+    rows = []
+    for row in sql_result.rows:
+        row = [str(value) for value in row]
+        for masker in maskers:
+            row = [masker.sub(value) for value in row]
+        rows.append(tuple(row))
+    sql_result.rows = rows
     return sql_result
 
 
@@ -188,6 +252,27 @@ def simple_column_mask(instance, sql_result):
     sql_result_column_list = [c.lower() for c in sql_result.column_list]
     if masking_columns:
         try:
+            # 解析原SQL查询别名字段，[(字段名, 别名)]，与脱敏字段无关，只解析一次
+            alias_columns = []
+            try:
+                for _c in sql_result_column_list:
+                    alias_column_regex = (
+                        r'"?([^\s"]+)"?\s+(as\s+)?"?({})[",\s+]?'.format(re.escape(_c))
+                    )
+                    alias_column_r = re.compile(alias_column_regex, re.I)
+                    search_data = re.search(alias_column_r, sql_result.full_sql)
+                    # 字段名
+                    _column_name = search_data.group(1).lower()
+                    s_column_name = re.sub(r'^"?\w+"?\."?|\.|"$', "", _column_name)
+                    # 别名
+                    alias_name = search_data.group(3).lower()
+                    alias_columns.append((s_column_name, alias_name))
+            except:
+                pass
+
+            # 生成 列索引 -> 脱敏规则 的执行计划
+            rules = compiled_masking_rules()
+            plan = []
             for mc in masking_columns:
                 # 脱敏规则字段名
                 column_name = mc.column_name.lower()
@@ -197,54 +282,31 @@ def simple_column_mask(instance, sql_result):
                     _masking_column_index.append(
                         sql_result_column_list.index(column_name)
                     )
-                # 别名字段脱敏处理
-                try:
-                    for _c in sql_result_column_list:
-                        alias_column_regex = (
-                            r'"?([^\s"]+)"?\s+(as\s+)?"?({})[",\s+]?'.format(
-                                re.escape(_c)
-                            )
+                # 别名字段脱敏处理，如果字段名匹配脱敏配置字段,对此字段进行脱敏处理
+                for s_column_name, alias_name in alias_columns:
+                    if s_column_name == column_name:
+                        _masking_column_index.append(
+                            sql_result_column_list.index(alias_name)
                         )
-                        alias_column_r = re.compile(alias_column_regex, re.I)
-                        # 解析原SQL查询别名字段
-                        search_data = re.search(alias_column_r, sql_result.full_sql)
-                        # 字段名
-                        _column_name = search_data.group(1).lower()
-                        s_column_name = re.sub(r'^"?\w+"?\."?|\.|"$', "", _column_name)
-                        # 别名
-                        alias_name = search_data.group(3).lower()
-                        # 如果字段名匹配脱敏配置字段,对此字段进行脱敏处理
-                        if s_column_name == column_name:
-                            _masking_column_index.append(
-                                sql_result_column_list.index(alias_name)
-                            )
-                except:
-                    pass
-
+                if not _masking_column_index:
+                    continue
+                if mc.rule_type not in rules:
+                    raise DataMaskingRules.DoesNotExist(
+                        "DataMaskingRules matching query does not exist."
+                    )
                 for masking_column_index in _masking_column_index:
-                    # 脱敏规则
-                    masking_rule = DataMaskingRules.objects.get(rule_type=mc.rule_type)
-                    # 脱敏后替换字符串
-                    compiled_r = re.compile(masking_rule.rule_regex, re.I | re.S)
-                    replace_pattern = r""
-                    for i in range(1, compiled_r.groups + 1):
-                        if i == int(masking_rule.hide_group):
-                            replace_pattern += r"****"
-                        else:
-                            replace_pattern += r"\{}".format(i)
-
-                    rows = list(sql_result.rows)
-                    for i in range(len(sql_result.rows)):
-                        temp_value_list = []
-                        for j in range(len(sql_result.rows[i])):
-                            column_data = sql_result.rows[i][j]
-                            if j == masking_column_index:
-                                column_data = compiled_r.sub(
-                                    replace_pattern, str(sql_result.rows[i][j])
-                                )
-                            temp_value_list += [column_data]
-                        rows[i] = tuple(temp_value_list)
-                    sql_result.rows = rows
+                    plan.append((masking_column_index, rules[mc.rule_type]))
+
+            if plan:
+                rows = []
+                for row in sql_result.rows:
+                    row = list(row)
+                    for masking_column_index, masker in plan:
+                        row[masking_column_index] = masker.sub(
+                            row[masking_column_index], dotall=True
+                        )
+                    rows.append(tuple(row))
+                sql_result.rows = rows
         except Exception as e:
             sql_result.error = str(e)
 
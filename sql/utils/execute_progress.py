@@ -0,0 +1,70 @@
+# -*- coding:utf-8 -*-
+"""
+@license: Apache Licence
+@file: execute_progress.py
+@time: 2026/10/17
+"""
+import datetime
+import logging
+import time
+
+from django.core.cache import cache
+
+logger = logging.getLogger("default")
+
+# 进度写入缓存的最小间隔，单位秒
+PROGRESS_INTERVAL = 1
+# 进度信息的保留时间，单位秒
+PROGRESS_TIMEOUT = 60 * 60 * 24
+
+
+def _progress_key(workflow_id):
+    return f"execute_progress:{workflow_id}"
+
+
+def get_execute_progress(workflow_id):
+    """获取工单的执行进度，不存在时返回None"""
+    try:
+        return cache.get(_progress_key(workflow_id))
+    except Exception as e:
+        logger.warning(f"获取工单执行进度失败：{e}")
+        return None
+
+
+class ExecuteProgress(object):
+    """
+    工单逐条执行的进度，按照PROGRESS_INTERVAL的间隔写入缓存
+    包括语句总数、已执行语句数、执行百分比和当前执行的语句序号
+    """
+
+    def __init__(self, workflow_id, total):
+        self.key = _progress_key(workflow_id)
+        self.total = total
+        self.executed = 0
+        self.start_time = datetime.datetime.now()
+        self.last_write = 0
+
+    def update(self, executed, force=False):
+        self.executed = executed
+        if force or time.monotonic() - self.last_write >= PROGRESS_INTERVAL:
+            self._write("running")
+
+    def finish(self, success):
+        self._write("success" if success else "failed")
+
+    def _write(self, state):
+        self.last_write = time.monotonic()
+        progress = {
+            "state": state,
+            "total": self.total,
+            "executed": self.executed,
+            "percentage": round(self.executed * 100 / self.total, 2)
+            if self.total
+            else 100,
+            "start_time": self.start_time.strftime("%Y-%m-%d %H:%M:%S"),
+            "update_time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        try:
+            cache.set(self.key, progress, timeout=PROGRESS_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"写入工单执行进度失败：{e}")
@@ -3,12 +3,13 @@ import logging
 import traceback
 
 from django.db import close_old_connections, connection, transaction
-from django_redis import get_redis_connection
 from common.utils.const import WorkflowDict
 from common.config import SysConfig
 from sql.engines.models import ReviewResult, ReviewSet
 from sql.models import SqlWorkflow
 from sql.notify import notify_for_execute
+from sql.utils.parse_cache import bump_schema_version
+from sql.utils.resource_cache import InstanceResourceCache
 from sql.utils.workflow_audit import Audit
 from sql.engines import get_engine
 
@@ -106,11 +107,12 @@ def execute_callback(task):
         operator_display="系统",
     )
 
-    # DDL工单结束后清空实例资源缓存
+    # DDL工单结束后清理涉及表的实例资源缓存和语法树解析缓存
     if workflow.syntax_type == 1:
-        r = get_redis_connection("default")
-        for key in r.scan_iter(match="*insRes*", count=2000):
-            r.delete(key)
+        bump_schema_version(workflow.instance_id)
+        InstanceResourceCache(workflow.instance).invalidate_by_sql(
+            workflow.db_name, workflow.sqlworkflowcontent.sql_content
+        )
 
     # 开启了Execute阶段通知参数才发送消息通知
     sys_config = SysConfig()
@@ -0,0 +1,192 @@
+# -*- coding:utf-8 -*-
+"""
+@license: Apache Licence
+@file: keyset_pagination.py
+@time: 2026/10/17
+"""
+import base64
+import datetime
+import logging
+from functools import reduce
+from operator import attrgetter, or_
+
+import simplejson as json
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+logger = logging.getLogger("default")
+
+# 精确统计的最大行数，超过后返回执行计划估算的行数
+APPROXIMATE_COUNT_THRESHOLD = 10000
+# 全文索引是否存在的缓存时间，单位秒
+FULLTEXT_INDEX_CACHE_TIMEOUT = 60 * 10
+
+
+def encode_cursor(values):
+    """游标为排序字段值的json，时间使用isoformat"""
+    values = [
+        value.isoformat() if isinstance(value, datetime.datetime) else value
+        for value in values
+    ]
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """:return: 排序字段值列表，游标不合法时返回None"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception:
+        return None
+    if not isinstance(values, list):
+        return None
+    result = []
+    for value in values:
+        if isinstance(value, str):
+            try:
+                value = datetime.datetime.fromisoformat(value)
+            except ValueError:
+                return None
+        result.append(value)
+    return result
+
+
+def keyset_filter(queryset, fields, values):
+    """
+    按照fields倒序，过滤出游标之后的数据，例如(create_time, id)：
+    create_time < t OR (create_time = t AND id < i)
+    """
+    conditions = []
+    for index, field in enumerate(fields):
+        condition = {f: v for f, v in zip(fields[:index], values[:index])}
+        condition[f"{field}__lt"] = values[index]
+        conditions.append(Q(**condition))
+    return queryset.filter(reduce(or_, conditions))
+
+
+def cursor_of(row, fields):
+    """从values()的字典或者模型对象中获取游标"""
+    if isinstance(row, dict):
+        return encode_cursor([row[field] for field in fields])
+    return encode_cursor(
+        [attrgetter(field.replace("__", "."))(row) for field in fields]
+    )
+
+
+def _explain_rows(queryset):
+    """MySQL执行计划估算的扫描行数，获取失败时返回0"""
+    try:
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN {sql}", params)
+            columns = [column[0].lower() for column in cursor.description]
+            row = cursor.fetchone()
+        return int(row[columns.index("rows")] or 0) if row else 0
+    except Exception as e:
+        logger.warning(f"获取执行计划估算行数失败：{e}")
+        return 0
+
+
+def approximate_count(queryset, threshold=APPROXIMATE_COUNT_THRESHOLD):
+    """
+    统计总数，最多扫描threshold+1行，超过阈值时返回执行计划估算的行数
+    :return: (总数, 是否为估算值)
+    """
+    count = queryset.order_by().values("pk")[: threshold + 1].count()
+    if count <= threshold:
+        return count, False
+    return max(_explain_rows(queryset.order_by()), count), True
+
+
+def paginate(queryset, offset, limit, cursor=None, fields=("create_time", "id")):
+    """
+    按照fields倒序分页，传入上一页返回的游标时使用keyset分页，否则使用offset分页
+    :param queryset: 已经过滤、选择字段(values)的queryset，需要包含fields
+    :return: (总数, 当前页数据, 下一页游标, 总数是否为估算值)
+    """
+    ordered = queryset.order_by(*[f"-{field}" for field in fields])
+    values = decode_cursor(cursor) if cursor else None
+    if values and len(values) == len(fields):
+        page = keyset_filter(ordered, fields, values)
+        page = page[:limit] if limit else page
+    else:
+        page = ordered[offset : offset + limit] if limit else ordered[offset:]
+    rows = list(page)
+    next_cursor = cursor_of(rows[-1], fields) if limit and len(rows) == limit else None
+    total, approximate = approximate_count(queryset)
+    return total, rows, next_cursor, approximate
+
+
+def _fulltext_index_key(table, column):
+    return f"fulltext_index:{table}.{column}"
+
+
+def invalidate_fulltext_index(table, column):
+    """创建或者删除全文索引后清除缓存"""
+    cache.delete(_fulltext_index_key(table, column))
+
+
+def has_fulltext_index(table, column):
+    """字段是否存在全文索引，结果缓存FULLTEXT_INDEX_CACHE_TIMEOUT秒"""
+    key = _fulltext_index_key(table, column)
+    exists = cache.get(key)
+    if exists is None:
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """select count(*) from information_schema.statistics
+                       where table_schema=database() and table_name=%s
+                         and column_name=%s and index_type='FULLTEXT';""",
+                    [table, column],
+                )
+                exists = cursor.fetchone()[0] > 0
+        except Exception as e:
+            logger.warning(f"获取全文索引信息失败：{e}")
+            exists = False
+        cache.set(key, exists, timeout=FULLTEXT_INDEX_CACHE_TIMEOUT)
+    return exists
+
+
+def ngram_token_size():
+    """全文索引ngram分词的长度，短于该长度的词无法通过全文索引匹配，结果缓存"""
+    key = "fulltext_index:ngram_token_size"
+    size = cache.get(key)
+    if size is None:
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("select @@ngram_token_size;")
+                size = int(cursor.fetchone()[0])
+        except Exception as e:
+            logger.warning(f"获取ngram_token_size失败：{e}")
+            size = 2
+        cache.set(key, size, timeout=FULLTEXT_INDEX_CACHE_TIMEOUT)
+    return size
+
+
+def text_search(model, column, search, like_columns=()):
+    """
+    文本检索，column存在全文索引(ngram)时使用全文索引的id子查询做短语匹配，
+    like_columns仍然使用like，与全文索引的id子查询OR；
+    不存在全文索引或者检索词短于ngram分词长度(全文索引无法匹配)时对全部字段使用like
+    :return: Q条件
+    """
+    table = model._meta.db_table
+    like = [Q(**{f"{c}__icontains": search}) for c in like_columns]
+    terms = search.split()
+    if (
+        not terms
+        or not has_fulltext_index(table, column)
+        or min(len(term) for term in terms) < ngram_token_size()
+    ):
+        return reduce(or_, [Q(**{f"{column}__icontains": search}), *like])
+    phrase = '"{}"'.format(search.replace('"', " "))
+    pk = model._meta.pk.column
+    match = Q(
+        pk__in=RawSQL(
+            f"SELECT `{pk}` FROM `{table}` "
+            f"WHERE MATCH(`{column}`) AGAINST (%s IN BOOLEAN MODE)",
+            [phrase],
+        )
+    )
+    return reduce(or_, [match, *like])
@@ -0,0 +1,471 @@
+# -*- coding:utf-8 -*-
+"""
+@license: Apache Licence
+@file: native_archiver.py
+@time: 2026/10/17
+"""
+import datetime
+import gzip
+import logging
+import os
+import time
+import traceback
+
+import simplejson as json
+from django.conf import settings
+from django.db import connection, close_old_connections
+
+from common.config import SysConfig
+from sql.engines import get_engine
+from sql.models import ArchiveConfig, ArchiveLog, Instance
+from sql.utils.archive_progress import ArchiveProgress, estimate_rows
+
+logger = logging.getLogger("default")
+
+# 每批次的行数范围，批次大小根据耗时和从库延迟自动调整
+MIN_BATCH_SIZE = 100
+MAX_BATCH_SIZE = 20000
+INIT_BATCH_SIZE = 1000
+# 单个批次(查询+写入+删除)的目标耗时，单位秒
+TARGET_BATCH_TIME = 0.5
+# 检查从库延迟的间隔，单位秒
+LAG_CHECK_INTERVAL = 5
+
+
+def _quote(name):
+    return "`{}`".format(name.replace("`", "``"))
+
+
+def _file_value(value):
+    """按照SELECT INTO OUTFILE的格式转义字段值，与pt-archiver --file的输出保持一致"""
+    if value is None:
+        return r"\N"
+    if isinstance(value, bytes):
+        value = value.decode("utf-8", errors="replace")
+    elif isinstance(value, bool):
+        value = int(value)
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+        .replace("\0", "\\0")
+    )
+
+
+class NativeArchiver(object):
+    """
+    基于MysqlEngine的分批归档，替代pt-archiver
+    按照主键范围遍历源表，批量写入目标表或压缩文件，再按主键批量删除源数据
+    批次大小根据单批次耗时和从库延迟自动调整，每个批次完成后在ArchiveLog记录断点，中断后再次执行会从断点继续
+    """
+
+    def __init__(self, archive_info, queue_time=None):
+        self.archive_info = archive_info
+        self.queue_time = queue_time
+        self.config = SysConfig()
+        self.mode = archive_info.mode
+        self.no_delete = archive_info.no_delete if self.mode != "purge" else False
+        self.src_db_name = archive_info.src_db_name
+        self.src_table_name = archive_info.src_table_name
+        self.s_engine = get_engine(archive_info.src_instance)
+        self.d_engine = (
+            get_engine(archive_info.dest_instance) if self.mode == "dest" else None
+        )
+        self.batch_size = INIT_BATCH_SIZE
+        self.max_lag = int(self.config.get("archive_max_lag", 0) or 0)
+        self.lag_engines = self._lag_engines()
+        self.last_lag_check = 0
+        self.log = None
+        self.progress = None
+        self.lag = None
+        self.checkpoint = None
+        # 断点续传时的断点信息，文件模式需要根据断点处理中断批次写入的文件内容，目标表模式需要放行中断批次的重复数据
+        self.resume = None
+        # 文件模式已确认写入的文件大小
+        self.file_size = 0
+        self.stats = {"select": 0, "insert": 0, "delete": 0, "batch": 0, "wait": 0}
+
+    def _lag_engines(self):
+        """需要检查延迟的从库，未配置最大延迟时不检查"""
+        names = self.config.get("archive_lag_instances") or ""
+        names = [name.strip() for name in names.split(",") if name.strip()]
+        if not self.max_lag or not names:
+            return []
+        return [
+            get_engine(instance)
+            for instance in Instance.objects.filter(instance_name__in=names)
+        ]
+
+    @property
+    def cmd(self):
+        """归档参数描述，不包含密码信息"""
+        s_ins = self.archive_info.src_instance
+        cmd = (
+            f"native-archiver --source h={s_ins.host},P={s_ins.port},"
+            f"D={self.src_db_name},t={self.src_table_name}"
+        )
+        if self.mode == "dest":
+            d_ins = self.archive_info.dest_instance
+            cmd += (
+                f" --dest h={d_ins.host},P={d_ins.port},"
+                f"D={self.archive_info.dest_db_name},t={self.archive_info.dest_table_name}"
+            )
+        elif self.mode == "file":
+            cmd += f" --file {self.file_path}"
+        elif self.mode == "purge":
+            cmd += " --purge"
+        if self.no_delete:
+            cmd += " --no-delete"
+        return f"{cmd} --where '{self.archive_info.condition}' --sleep {self.archive_info.sleep}"
+
+    @property
+    def file_path(self):
+        output_directory = os.path.join(settings.BASE_DIR, "downloads/archiver")
+        return (
+            f"{output_directory}/{self.archive_info.src_instance.instance_name}-"
+            f"{self.src_db_name}-{self.src_table_name}.txt.gz"
+        )
+
+    def primary_key(self):
+        """获取源表的主键列，按照主键中的顺序返回"""
+        sql = f"""SELECT COLUMN_NAME FROM information_schema.STATISTICS
+                  WHERE TABLE_SCHEMA=%s AND TABLE_NAME=%s AND INDEX_NAME='PRIMARY'
+                  ORDER BY SEQ_IN_INDEX;"""
+        conn = self.s_engine.get_connection(self.src_db_name)
+        cursor = conn.cursor()
+        cursor.execute(sql, (self.src_db_name, self.src_table_name))
+        pk = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        if not pk:
+            raise Exception(f"表{self.src_db_name}.{self.src_table_name}没有主键，无法使用原生归档")
+        return pk
+
+    def _start_log(self, start_time):
+        """获取未完成的归档日志继续执行，不存在时新建"""
+        log = (
+            ArchiveLog.objects.filter(
+                archive=self.archive_info,
+                success=False,
+                mode=self.mode,
+                condition=self.archive_info.condition,
+            )
+            .exclude(checkpoint="")
+            .order_by("-id")
+            .first()
+        )
+        if (
+            log
+            and ArchiveLog.objects.filter(
+                archive=self.archive_info, id__gt=log.id
+            ).exists()
+        ):
+            log = None
+        if log:
+            checkpoint = json.loads(log.checkpoint)
+            self.resume = checkpoint
+            self.checkpoint = checkpoint["pk"]
+            self.batch_size = checkpoint.get("batch_size", INIT_BATCH_SIZE)
+            self.stats["select"] = log.select_cnt
+            self.stats["insert"] = log.insert_cnt
+            self.stats["delete"] = log.delete_cnt
+            log.statistics += f"Resumed at {start_time} from {self.checkpoint}\n"
+            log.error_info = ""
+            log.queue_time = self.queue_time
+            log.save(update_fields=["statistics", "error_info", "queue_time"])
+            return log
+        return ArchiveLog.objects.create(
+            archive=self.archive_info,
+            cmd=self.cmd,
+            condition=self.archive_info.condition,
+            mode=self.mode,
+            no_delete=self.no_delete,
+            sleep=self.archive_info.sleep,
+            select_cnt=0,
+            insert_cnt=0,
+            delete_cnt=0,
+            statistics=f"Started at {start_time}\n",
+            success=False,
+            error_info="",
+            queue_time=self.queue_time,
+            start_time=start_time,
+            end_time=start_time,
+        )
+
+    def _checkpoint_json(self, pending=None):
+        checkpoint = {"pk": self.checkpoint, "batch_size": self.batch_size}
+        if self.mode == "file":
+            checkpoint["file_size"] = self.file_size
+        if pending:
+            checkpoint["pending"] = pending
+        return json.dumps(checkpoint, default=str)
+
+    def _save_checkpoint(self, last_pk):
+        """批次完成后记录断点和准确的行数"""
+        self.checkpoint = last_pk
+        if connection.connection and not connection.is_usable():
+            close_old_connections()
+        ArchiveLog.objects.filter(id=self.log.id).update(
+            select_cnt=self.stats["select"],
+            insert_cnt=self.stats["insert"],
+            delete_cnt=self.stats["delete"],
+            checkpoint=self._checkpoint_json(),
+            end_time=datetime.datetime.now(),
+        )
+
+    def _save_pending(self, last_pk, rows, file_size=None):
+        """
+        在删除源数据之前记录正在处理的批次
+        文件模式记录本批次写入后的文件大小，中断后根据源数据是否已经删除，决定保留还是截断本批次写入的文件内容
+        目标表模式在写入之前记录，中断后续传的第一个批次允许目标表中已存在本批次的数据
+        """
+        if connection.connection and not connection.is_usable():
+            close_old_connections()
+        pending = {"pk": last_pk, "rows": rows}
+        if file_size is not None:
+            pending["file_size"] = file_size
+        ArchiveLog.objects.filter(id=self.log.id).update(
+            checkpoint=self._checkpoint_json(pending)
+        )
+
+    def _exists(self, cursor, pk, pk_value):
+        """源表中是否还存在该主键的数据"""
+        table = f"{_quote(self.src_db_name)}.{_quote(self.src_table_name)}"
+        where = " AND ".join(f"{_quote(col)}=%s" for col in pk)
+        cursor.execute(f"SELECT 1 FROM {table} WHERE {where} LIMIT 1;", list(pk_value))
+        return bool(cursor.fetchall())
+
+    def _recover_file(self, cursor, pk):
+        """
+        文件模式续传前将文件截断到已确认的大小，避免中断批次的数据重复写入文件
+        中断批次的源数据已经删除时保留该批次写入的内容，并从该批次之后继续
+        """
+        if not os.path.exists(self.file_path):
+            self.file_size = 0
+            return
+        if not self.resume or self.resume.get("file_size") is None:
+            self.file_size = os.path.getsize(self.file_path)
+            return
+        self.file_size = self.resume["file_size"]
+        pending = self.resume.get("pending")
+        if (
+            pending
+            and not self.no_delete
+            and not self._exists(cursor, pk, pending["pk"])
+        ):
+            self.checkpoint = pending["pk"]
+            self.file_size = pending["file_size"]
+            self.stats["select"] += pending["rows"]
+            self.stats["delete"] += pending["rows"]
+            self._save_checkpoint(self.checkpoint)
+        if os.path.getsize(self.file_path) > self.file_size:
+            with open(self.file_path, "r+b") as f:
+                f.truncate(self.file_size)
+
+    def _wait_for_lag(self):
+        """从库延迟超过阈值时降低批次大小并等待"""
+        if not self.lag_engines:
+            return
+        if time.monotonic() - self.last_lag_check < LAG_CHECK_INTERVAL:
+            return
+        while True:
+            self.last_lag_check = time.monotonic()
+            lags = []
+            for engine in self.lag_engines:
+                try:
+                    lags.append(engine.seconds_behind_master)
+                except Exception as e:
+                    logger.warning(f"获取从库{engine.instance_name}延迟失败：{e}")
+            lags = [lag for lag in lags if lag is not None]
+            self.lag = max(lags) if lags else None
+            if not lags or max(lags) <= self.max_lag:
+                return
+            self.batch_size = max(MIN_BATCH_SIZE, self.batch_size // 2)
+            self.stats["wait"] += LAG_CHECK_INTERVAL
+            time.sleep(LAG_CHECK_INTERVAL)
+
+    def _adjust_batch_size(self, elapsed):
+        """根据单批次耗时调整批次大小，使每个批次的耗时接近TARGET_BATCH_TIME"""
+        if elapsed > TARGET_BATCH_TIME * 1.5:
+            self.batch_size = max(
+                MIN_BATCH_SIZE, int(self.batch_size * TARGET_BATCH_TIME / elapsed)
+            )
+        elif elapsed < TARGET_BATCH_TIME / 2:
+            self.batch_size = min(MAX_BATCH_SIZE, self.batch_size * 2)
+
+    def _select(self, cursor, pk, columns):
+        """按照主键范围获取下一批数据"""
+        table = f"{_quote(self.src_db_name)}.{_quote(self.src_table_name)}"
+        pk_cols = ",".join(_quote(col) for col in pk)
+        where = f"({self.archive_info.condition})"
+        args = []
+        if self.checkpoint is not None:
+            if len(pk) == 1:
+                where += f" AND {pk_cols} > %s"
+            else:
+                where += f" AND ({pk_cols}) > ({','.join(['%s'] * len(pk))})"
+            args = list(self.checkpoint)
+        cursor.execute(
+            f"SELECT {columns} FROM {table} WHERE {where} "
+            f"ORDER BY {pk_cols} LIMIT {self.batch_size};",
+            args,
+        )
+        return cursor.fetchall(), [desc[0] for desc in cursor.description]
+
+    def _insert(self, rows, columns):
+        """
+        写入目标表，断点续传时可能重复写入中断批次的数据，使用INSERT IGNORE
+        :return: 实际写入的行数，忽略的行不计入
+        """
+        table = (
+            f"{_quote(self.archive_info.dest_db_name)}."
+            f"{_quote(self.archive_info.dest_table_name)}"
+        )
+        conn = self.d_engine.get_connection(self.archive_info.dest_db_name)
+        cursor = conn.cursor()
+        cursor.executemany(
+            f"INSERT IGNORE INTO {table} ({','.join(_quote(c) for c in columns)}) "
+            f"VALUES ({','.join(['%s'] * len(columns))})",
+            rows,
+        )
+        inserted = cursor.rowcount
+        conn.commit()
+        cursor.close()
+        return inserted
+
+    def _write_file(self, rows):
+        """每个批次追加一个gzip member，返回写入后的文件大小，可以作为截断位置"""
+        with gzip.open(self.file_path, "at", encoding="utf-8") as f:
+            for row in rows:
+                f.write("\t".join(_file_value(value) for value in row) + "\n")
+        return os.path.getsize(self.file_path)
+
+    def _delete(self, cursor, pk, pk_values):
+        """按照主键删除源数据"""
+        table = f"{_quote(self.src_db_name)}.{_quote(self.src_table_name)}"
+        if len(pk) == 1:
+            where = f"{_quote(pk[0])} IN ({','.join(['%s'] * len(pk_values))})"
+            args = [value[0] for value in pk_values]
+        else:
+            placeholder = f"({','.join(['%s'] * len(pk))})"
+            where = (
+                f"({','.join(_quote(col) for col in pk)}) IN "
+                f"({','.join([placeholder] * len(pk_values))})"
+            )
+            args = [v for value in pk_values for v in value]
+        cursor.execute(f"DELETE FROM {table} WHERE {where};", args)
+        return cursor.rowcount
+
+    def archive(self):
+        """执行归档，返回 (select_cnt, insert_cnt, delete_cnt)"""
+        pk = self.primary_key()
+        conn = self.s_engine.get_connection(self.src_db_name)
+        cursor = conn.cursor()
+        if self.mode == "file":
+            os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+            self._recover_file(cursor, pk)
+        # 仅续传的第一个批次允许目标表中已存在中断批次写入的数据
+        resume_pending = bool(self.resume and self.resume.get("pending"))
+        while True:
+            self._wait_for_lag()
+            start = time.monotonic()
+            batch_size = self.batch_size
+            rows, columns = self._select(cursor, pk, "*")
+            if not rows:
+                break
+            pk_index = [columns.index(col) for col in pk]
+            pk_values = [[row[i] for i in pk_index] for row in rows]
+            if self.mode == "dest":
+                self._save_pending(pk_values[-1], len(rows))
+                inserted = self._insert(rows, columns)
+                if resume_pending:
+                    inserted = len(rows)
+                elif inserted != len(rows) and not self.no_delete:
+                    # 目标表存在主键冲突的数据，不删除源数据
+                    conn.rollback()
+                    self._save_checkpoint(self.checkpoint)
+                    raise Exception(
+                        f"写入和查询数量不一致:{inserted}!={len(rows)}，"
+                        f"目标表可能存在主键冲突的数据，主键范围{pk_values[0]}~{pk_values[-1]}"
+                    )
+                self.stats["insert"] += inserted
+            elif self.mode == "file":
+                file_size = self._write_file(rows)
+                self._save_pending(pk_values[-1], len(rows), file_size)
+                self.file_size = file_size
+            self.stats["select"] += len(rows)
+            if not self.no_delete:
+                self.stats["delete"] += self._delete(cursor, pk, pk_values)
+            conn.commit()
+            self.stats["batch"] += 1
+            resume_pending = False
+            self._adjust_batch_size(time.monotonic() - start)
+            self._save_checkpoint(pk_values[-1])
+            self.progress.update(self.stats["select"], lag=self.lag)
+            if len(rows) < batch_size:
+                break
+            if self.archive_info.sleep:
+                time.sleep(self.archive_info.sleep)
+        cursor.close()
+        return self.stats["select"], self.stats["insert"], self.stats["delete"]
+
+    def check(self, select_cnt, insert_cnt, delete_cnt):
+        """校验归档数量，规则与pt-archiver保持一致"""
+        if self.mode == "dest" and not self.no_delete and insert_cnt != delete_cnt:
+            return f"删除和写入数量不一致:{insert_cnt}!={delete_cnt}"
+        if self.mode in ("file", "purge") and not self.no_delete:
+            if select_cnt != delete_cnt:
+                return f"查询和删除数量不一致:{select_cnt}!={delete_cnt}"
+        return ""
+
+    def run(self):
+        """执行归档并记录日志，失败时保留断点并抛出异常"""
+        start_time = datetime.datetime.now()
+        self.log = self._start_log(start_time)
+        self.progress = ArchiveProgress(
+            self.archive_info.id,
+            total=estimate_rows(
+                self.archive_info.src_instance, self.src_db_name, self.src_table_name
+            ),
+            done=self.stats["select"],
+        )
+        error_info = ""
+        try:
+            select_cnt, insert_cnt, delete_cnt = self.archive()
+            error_info = self.check(select_cnt, insert_cnt, delete_cnt)
+        except Exception as e:
+            logger.error(f"归档任务{self.archive_info.id}执行失败：{traceback.format_exc()}")
+            error_info = f"归档执行报错:{e}"
+        finally:
+            self.s_engine.close()
+            if self.d_engine:
+                self.d_engine.close()
+            for engine in self.lag_engines:
+                engine.close()
+        end_time = datetime.datetime.now()
+        statistics = (
+            f"Finished at {end_time}\n"
+            f"SELECT {self.stats['select']}\n"
+            f"INSERT {self.stats['insert']}\n"
+            f"DELETE {self.stats['delete']}\n"
+            f"Batches {self.stats['batch']}, last batch size {self.batch_size}, "
+            f"lag wait {self.stats['wait']}s\n"
+        )
+        if connection.connection and not connection.is_usable():
+            close_old_connections()
+        self.log.refresh_from_db()
+        self.log.statistics += statistics
+        self.log.success = not error_info
+        self.log.error_info = error_info
+        self.log.end_time = end_time
+        # 归档完成后清理断点，数量不一致时也无需继续
+        if self.log.success or not error_info.startswith("归档执行报错"):
+            self.log.checkpoint = ""
+        self.log.save()
+        self.progress.finish(self.log.success, error_info)
+        ArchiveConfig(id=self.archive_info.id, last_archive_time=end_time).save(
+            update_fields=["last_archive_time"]
+        )
+        if error_info:
+            raise Exception(f"{error_info}\n{self.log.statistics}")
@@ -0,0 +1,122 @@
+# -*- coding:utf-8 -*-
+"""
+@license: Apache Licence
+@file: parse_cache.py
+@time: 2026/10/17
+"""
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.core.cache import cache
+
+from sql.utils.sql_utils import sql_fingerprint
+
+logger = logging.getLogger("default")
+
+# 解析结果在redis中的过期时间，兜底在Archery外部执行的DDL，单位秒
+PARSE_CACHE_TIMEOUT = 60 * 60
+# 进程内LRU缓存的最大条目数
+PARSE_CACHE_MAX_SIZE = 1024
+
+
+class LRUCache(object):
+    """线程安全的进程内LRU缓存"""
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+_local_cache = LRUCache(PARSE_CACHE_MAX_SIZE)
+
+
+def _schema_version_key(instance_id):
+    return f"instance_schema_version:{instance_id}"
+
+
+def schema_version(instance_id):
+    """获取实例的表结构版本号，不存在时生成，版本号变化后旧的解析结果自然失效"""
+    key = _schema_version_key(instance_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_schema_version(instance_id):
+    """实例表结构变更后更新版本号，使该实例的解析结果缓存失效"""
+    try:
+        cache.set(_schema_version_key(instance_id), uuid.uuid4().hex, timeout=None)
+    except Exception as e:
+        logger.error(f"更新实例表结构版本号失败：{e}")
+
+
+def cached_parse(kind, instance, db_name, sql, parser):
+    """
+    缓存goInception的解析结果，key为(解析类型, 实例, 库, SQL指纹, 表结构版本号)
+    先查进程内LRU缓存，再查redis，都未命中时调用parser解析，解析异常时不缓存
+    :param kind: 解析类型，如 query_print、query_data_masking
+    :param instance: 实例对象
+    :param db_name: 库名
+    :param sql: 待解析的语句
+    :param parser: 无参数的解析函数
+    :return: 解析结果，多次调用共享同一对象，调用方不应修改
+    """
+    if not getattr(instance, "id", None):
+        return parser()
+    try:
+        version = schema_version(instance.id)
+    except Exception as e:
+        logger.warning(f"获取实例表结构版本号失败，跳过解析缓存：{e}")
+        return parser()
+    fingerprint = hashlib.sha1(
+        # 实例地址修改后视为不同的表结构
+        f"{instance.host}\0{instance.port}\0{db_name}\0{sql_fingerprint(sql)}".encode(
+            "utf-8"
+        )
+    ).hexdigest()
+    key = f"goinception_parse:{kind}:{instance.id}:{version}:{fingerprint}"
+    # 进程内缓存同样设置过期时间，与redis保持一致
+    deadline, result = _local_cache.get(key, (0, None))
+    if result is not None and deadline > time.monotonic():
+        return result
+    try:
+        result = cache.get(key)
+    except Exception as e:
+        logger.warning(f"读取解析缓存失败：{e}")
+        result = None
+    if result is None:
+        result = parser()
+        try:
+            cache.set(key, result, timeout=PARSE_CACHE_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"写入解析缓存失败：{e}")
+    _local_cache.set(key, (time.monotonic() + PARSE_CACHE_TIMEOUT, result))
+    return result
@@ -0,0 +1,268 @@
+# -*- coding:utf-8 -*-
+"""
+@license: Apache Licence
+@file: query_log_writer.py
+@time: 2026/10/17
+"""
+import datetime
+import gzip
+import logging
+import os
+import time
+
+import simplejson as json
+from django.conf import settings
+from django.db import OperationalError, close_old_connections, connection
+from django.db.models import Min
+from django_q.tasks import async_task
+from django_redis import get_redis_connection
+
+from common.config import SysConfig
+from common.utils.extend_json_encoder import ExtendJSONEncoder
+from sql.models import QueryLog
+from sql.utils.tasks import del_schedule
+
+logger = logging.getLogger("default")
+
+# 缓冲左进右出，写入任务每批从右侧移入处理列表，写入完成后清空处理列表
+BUFFER_KEY = "query_log:buffer"
+PROCESSING_KEY = "query_log:processing"
+# 无法写入的日志移入死信列表，不阻塞后续日志
+DEAD_LETTER_KEY = "query_log:dead_letter"
+FLUSH_THROTTLE_KEY = "query_log:flush_throttle"
+FLUSH_LOCK_KEY = "query_log:flush_lock"
+# 写入锁的过期时间，单位秒，每批写入后续期
+FLUSH_LOCK_TIMEOUT = 300
+# 批量写入的间隔，单位毫秒，间隔内写入缓冲的查询日志由同一个任务批量写入
+FLUSH_INTERVAL_MS = 500
+# 每批写入的行数
+FLUSH_BATCH_SIZE = 500
+# 归档时每批读取、删除的行数
+ARCHIVE_BATCH_SIZE = 5000
+ARCHIVE_FIELDS = [
+    "id",
+    "instance_name",
+    "db_name",
+    "sqllog",
+    "effect_row",
+    "cost_time",
+    "username",
+    "user_display",
+    "priv_check",
+    "hit_rule",
+    "masking",
+    "favorite",
+    "alias",
+    "create_time",
+]
+
+
+def _save(fields):
+    # 防止查询超时
+    if connection.connection and not connection.is_usable():
+        close_old_connections()
+    QueryLog.objects.create(**fields)
+
+
+def write(fields):
+    """
+    记录查询日志，开启query_log_async时写入Redis缓冲，由异步任务批量写入，否则直接写入
+    写入缓冲失败时直接写入数据库，不丢失日志
+    """
+    if not SysConfig().get("query_log_async"):
+        _save(fields)
+        return
+    fields = dict(fields, create_time=datetime.datetime.now())
+    try:
+        redis = get_redis_connection("default")
+        redis.lpush(BUFFER_KEY, json.dumps(fields, cls=ExtendJSONEncoder))
+    except Exception as e:
+        logger.warning(f"查询日志写入缓冲失败，直接写入数据库：{e}")
+        _save(fields)
+        return
+    # 每个间隔内仅提交一个写入任务，提交失败时由定时任务写入
+    try:
+        if redis.set(FLUSH_THROTTLE_KEY, 1, nx=True, px=FLUSH_INTERVAL_MS):
+            async_task("sql.utils.query_log_writer.flush", FLUSH_INTERVAL_MS)
+    except Exception as e:
+        logger.warning(f"提交查询日志写入任务失败：{e}")
+
+
+def _load(item):
+    fields = json.loads(item)
+    fields["create_time"] = datetime.datetime.strptime(
+        fields["create_time"], "%Y-%m-%d %H:%M:%S"
+    )
+    return QueryLog(**fields)
+
+
+def pending():
+    """缓冲和处理列表中待写入的日志数，Redis不可用时返回0"""
+    try:
+        redis = get_redis_connection("default")
+        return redis.llen(BUFFER_KEY) + redis.llen(PROCESSING_KEY)
+    except Exception as e:
+        logger.warning(f"获取查询日志缓冲长度失败：{e}")
+        return 0
+
+
+def _next_batch(redis):
+    """
+    获取待写入的一批日志，按写入缓冲的顺序返回
+    上次任务中断时遗留在处理列表中的日志优先写入，否则从缓冲移入一批
+    """
+    if not redis.llen(PROCESSING_KEY):
+        pipe = redis.pipeline()
+        for _ in range(FLUSH_BATCH_SIZE):
+            pipe.rpoplpush(BUFFER_KEY, PROCESSING_KEY)
+        pipe.execute()
+    return list(reversed(redis.lrange(PROCESSING_KEY, 0, -1)))
+
+
+def _save_batch(items):
+    """
+    批量写入一批日志，批量写入失败时逐行写入
+    数据库连接异常时抛出，处理列表保留由下次任务重试
+    :return: (写入的行数, 无法写入的日志)
+    """
+    logs, dead = [], []
+    for item in items:
+        try:
+            logs.append((item, _load(item)))
+        except Exception as e:
+            logger.error(f"查询日志解析失败，移入死信列表：{e}")
+            dead.append(item)
+    try:
+        QueryLog.objects.bulk_create([log for _, log in logs])
+        return len(logs), dead
+    except OperationalError:
+        raise
+    except Exception as e:
+        logger.error(f"查询日志批量写入失败，逐行写入：{e}")
+    saved = 0
+    for item, log in logs:
+        try:
+            log.save(force_insert=True)
+            saved += 1
+        except OperationalError:
+            raise
+        except Exception as e:
+            logger.error(f"查询日志写入失败，移入死信列表：{e}")
+            dead.append(item)
+    return saved, dead
+
+
+def flush(delay_ms=0):
+    """
+    将缓冲中的查询日志批量写入数据库，delay_ms用于等待间隔内的日志写入缓冲
+    数据库连接异常时日志保留在处理列表中，由下次任务重试
+    关闭异步写入且缓冲写完后删除定时任务
+    :return: 写入的行数
+    """
+    if delay_ms:
+        time.sleep(delay_ms / 1000)
+    close_old_connections()
+    redis = get_redis_connection("default")
+    lock = redis.lock(FLUSH_LOCK_KEY, timeout=FLUSH_LOCK_TIMEOUT)
+    # 已有任务在写入时直接返回，缓冲中的日志由该任务写入
+    if not lock.acquire(blocking=False):
+        return 0
+    saved = 0
+    try:
+        while True:
+            items = _next_batch(redis)
+            if not items:
+                break
+            batch_saved, dead = _save_batch(items)
+            pipe = redis.pipeline()
+            if dead:
+                pipe.rpush(DEAD_LETTER_KEY, *dead)
+            pipe.delete(PROCESSING_KEY)
+            pipe.execute()
+            saved += batch_saved
+            lock.reacquire()
+    finally:
+        lock.release()
+    if not SysConfig().get("query_log_async") and not pending():
+        del_schedule(name="查询日志写入")
+    return saved
+
+
+def _month_start(dt):
+    return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month(dt):
+    return (dt.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+
+
+def archive_path():
+    return os.path.join(settings.BASE_DIR, "downloads/query_log_archive/")
+
+
+def archive_month(month_start):
+    """
+    归档单个月份未收藏的查询日志，每批写入gzip压缩的jsonl文件后删除该批日志
+    :return: (归档文件路径, 归档行数)
+    """
+    month_end = _next_month(month_start)
+    queryset = QueryLog.objects.filter(
+        create_time__gte=month_start, create_time__lt=month_end, favorite=False
+    )
+    os.makedirs(archive_path(), exist_ok=True)
+    file_name = os.path.join(
+        archive_path(),
+        f"query_log_{month_start:%Y%m}_{datetime.datetime.now():%Y%m%d%H%M%S}.jsonl.gz",
+    )
+    count = 0
+    last_id = 0
+    with gzip.open(file_name, "wt", encoding="utf-8") as f:
+        while True:
+            rows = list(
+                queryset.filter(id__gt=last_id)
+                .order_by("id")
+                .values(*ARCHIVE_FIELDS)[:ARCHIVE_BATCH_SIZE]
+            )
+            if not rows:
+                break
+            for row in rows:
+                f.write(json.dumps(row, cls=ExtendJSONEncoder) + "\n")
+            f.flush()
+            # 仅删除已经写入文件的日志，写入期间被收藏的日志保留
+            QueryLog.objects.filter(
+                id__in=[row["id"] for row in rows], favorite=False
+            ).delete()
+            last_id = rows[-1]["id"]
+            count += len(rows)
+    if not count:
+        os.remove(file_name)
+        return None, 0
+    return file_name, count
+
+
+def archive():
+    """
+    按月归档超过query_log_retention_days天的查询日志，仅归档完整的月份，收藏的日志不归档
+    :return: [(归档文件路径, 归档行数)]
+    """
+    retention_days = int(SysConfig().get("query_log_retention_days") or 0)
+    if retention_days <= 0:
+        return []
+    cutoff = _month_start(
+        datetime.datetime.now() - datetime.timedelta(days=retention_days)
+    )
+    # 异步写入时id和操作时间的顺序不一致，按照最早的操作时间确定第一个月份
+    first = QueryLog.objects.filter(create_time__lt=cutoff, favorite=False).aggregate(
+        first=Min("create_time")
+    )["first"]
+    if first is None:
+        return []
+    result = []
+    month = _month_start(first)
+    while month < cutoff:
+        file_name, count = archive_month(month)
+        if count:
+            logger.info(f"查询日志归档完成，文件：{file_name}，行数：{count}")
+            result.append((file_name, count))
+        month = _next_month(month)
+    return result
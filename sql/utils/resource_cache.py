@@ -0,0 +1,177 @@
+# -*- coding:utf-8 -*-
+"""
+@license: Apache Licence
+@file: resource_cache.py
+@time: 2026/10/17
+"""
+import logging
+import re
+import time
+
+import simplejson as json
+import sqlparse
+from django_redis import get_redis_connection
+
+from sql.utils.sql_utils import extract_tables
+
+logger = logging.getLogger("default")
+
+# 库、schema、表列表的缓存时间，单位秒
+RESOURCE_CACHE_TIMEOUT = 60 * 5
+# 字段列表的缓存时间，MySQL实例会根据表的变更时间主动失效，可以缓存更久
+COLUMN_CACHE_TIMEOUT = 60 * 60
+# 实例资源hash整体的过期时间，用于回收长期未访问的实例
+HASH_EXPIRE = 60 * 60 * 24
+# 视图DDL，视图没有变更时间且解析只能得到基表，匹配时清理视图所在的整个库
+VIEW_DDL_RE = re.compile(
+    r"^\s*(create|alter|drop)\s+(or\s+replace\s+)?(algorithm\s*=\s*\w+\s+)?"
+    r"(definer\s*=\s*\S+\s+)?(sql\s+security\s+\w+\s+)?view\s+"
+    r"(if\s+exists\s+)?(`?(?P<schema>[^`\s.]+)`?\.)?",
+    re.IGNORECASE,
+)
+
+
+class InstanceResourceCache(object):
+    """
+    实例资源(库、schema、表、字段)的结构化缓存，每个实例对应一个redis hash
+    field格式：
+        database
+        schema:{db}
+        table:{db}:{schema}
+        column:{db}:{schema}:{tb}
+        versions:{db}  MySQL表的变更时间，{tb: "CREATE_TIME|UPDATE_TIME"}
+    value为json，{"ts": 写入时间, "rows": 资源列表}
+    """
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.key = f"instance_resource:{instance.id}"
+        self.redis = get_redis_connection("default")
+
+    @staticmethod
+    def field(resource_type, db_name="", schema_name="", tb_name=""):
+        if resource_type == "database":
+            return "database"
+        if resource_type == "schema":
+            return f"schema:{db_name}"
+        if resource_type == "table":
+            return f"table:{db_name}:{schema_name}"
+        return f"column:{db_name}:{schema_name}:{tb_name}"
+
+    def _timeout(self, field):
+        if field.startswith("column:") and self.instance.db_type == "mysql":
+            return COLUMN_CACHE_TIMEOUT
+        return RESOURCE_CACHE_TIMEOUT
+
+    def get(self, field):
+        """获取缓存的资源列表，不存在或已过期时返回None"""
+        try:
+            value = self.redis.hget(self.key, field)
+        except Exception as e:
+            logger.warning(f"读取实例资源缓存失败：{e}")
+            return None
+        if value is None:
+            return None
+        value = json.loads(value)
+        if time.time() - value["ts"] > self._timeout(field):
+            return None
+        return value["rows"]
+
+    def set(self, field, rows):
+        try:
+            pipe = self.redis.pipeline()
+            pipe.hset(
+                self.key,
+                field,
+                json.dumps({"ts": time.time(), "rows": rows}, default=str),
+            )
+            pipe.expire(self.key, HASH_EXPIRE)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"写入实例资源缓存失败：{e}")
+
+    def refresh_table_versions(self, query_engine, db_name):
+        """
+        增量刷新MySQL库内表的变更时间，仅清理变更过或者已删除的表的字段缓存
+        :param query_engine: 实例的engine
+        :param db_name: 库名
+        :return:
+        """
+        if self.instance.db_type != "mysql":
+            return
+        sql = f"""SELECT TABLE_NAME, CONCAT(IFNULL(CREATE_TIME, ''), '|', IFNULL(UPDATE_TIME, ''))
+                  FROM information_schema.TABLES WHERE TABLE_SCHEMA='{db_name}';"""
+        result = query_engine.query("information_schema", sql, close_conn=False)
+        if result.error:
+            logger.warning(f"获取表变更时间失败：{result.error}")
+            return
+        versions = {row[0]: row[1] for row in result.rows}
+        field = f"versions:{db_name}"
+        try:
+            old_versions = json.loads(self.redis.hget(self.key, field) or "{}")
+            changed = [
+                f"column:{db_name}::{tb}"
+                for tb, version in old_versions.items()
+                if versions.get(tb) != version
+            ]
+            if changed:
+                self.redis.hdel(self.key, *changed)
+            self.redis.hset(self.key, field, json.dumps(versions))
+        except Exception as e:
+            logger.warning(f"刷新表变更时间失败：{e}")
+
+    def invalidate(self, db_name=None, tables=None):
+        """
+        精确清理实例资源缓存
+        :param db_name: 为空时清理整个实例
+        :param tables: 为空时清理整个库，否则仅清理表列表和指定表的字段
+        :return:
+        """
+        try:
+            if db_name is None:
+                self.redis.delete(self.key)
+                return
+            if tables:
+                fields = [
+                    field
+                    for field in self._fields(f"column:{db_name}:*")
+                    if field.rsplit(":", 1)[-1] in tables
+                ]
+                fields += self._fields(f"table:{db_name}:*")
+            else:
+                fields = self._fields(f"*:{db_name}") + self._fields(f"*:{db_name}:*")
+                fields.append("database")
+            if fields:
+                self.redis.hdel(self.key, *set(fields))
+        except Exception as e:
+            logger.warning(f"清理实例资源缓存失败：{e}")
+
+    def invalidate_by_sql(self, db_name, sql):
+        """根据DDL语句涉及的表清理缓存，存在无法解析的语句或者视图DDL时清理整个库"""
+        tables_by_db = {}
+        for statement in sqlparse.split(sql):
+            view_ddl = VIEW_DDL_RE.match(
+                sqlparse.format(statement, strip_comments=True)
+            )
+            if view_ddl:
+                self.invalidate((view_ddl.group("schema") or db_name).strip("`"))
+                continue
+            try:
+                tables = extract_tables(statement)
+            except Exception:
+                tables = []
+            if not tables:
+                self.invalidate(db_name)
+                return
+            for table in tables:
+                schema = (table["schema"] or db_name).strip("`")
+                tables_by_db.setdefault(schema, []).append(table["name"].strip("`"))
+        for schema, names in tables_by_db.items():
+            self.invalidate(schema, names)
+
+    def _fields(self, match):
+        """扫描当前实例hash内的field，范围仅限单个实例"""
+        return [
+            field.decode("utf-8") if isinstance(field, bytes) else field
+            for field, _ in self.redis.hscan_iter(self.key, match=match, count=1000)
+        ]
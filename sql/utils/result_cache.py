@@ -0,0 +1,102 @@
+# -*- coding:utf-8 -*-
+"""
+@license: Apache Licence
+@file: result_cache.py
+@time: 2026/10/17
+"""
+import hashlib
+import logging
+import pickle
+import re
+import zlib
+
+from django.core.cache import cache
+
+from sql.engines.models import ResultSet
+from sql.utils.data_masking import MASKING_RULES_VERSION_KEY
+
+logger = logging.getLogger("default")
+
+# 结果不确定的函数、变量和语句，包含这些内容的查询不使用缓存
+NON_DETERMINISTIC_RE = re.compile(
+    r"\b(now|sysdate|curdate|curtime|current_date|current_time|current_timestamp"
+    r"|localtime|localtimestamp|utc_date|utc_time|utc_timestamp|unix_timestamp"
+    r"|rand|random|uuid|uuid_short|gen_random_uuid|newid|sys_guid|connection_id"
+    r"|last_insert_id|found_rows|row_count|user|current_user|session_user"
+    r"|system_user|sleep|pg_sleep|get_lock|release_lock|nextval|currval)\s*\("
+    r"|\b(current_date|current_time|current_timestamp|localtime|localtimestamp"
+    r"|current_user|sysdate|systimestamp)\b"
+    r"|@"
+    r"|\bfor\s+update\b|\block\s+in\s+share\s+mode\b|\binto\s+(out|dump)file\b",
+    re.I,
+)
+
+
+def result_cache_enabled(config, instance):
+    """
+    是否对实例开启查询结果缓存，需开启query_result_cache
+    query_result_cache_instances为空时对全部实例生效，否则仅对列出的实例生效
+    """
+    if not config.get("query_result_cache"):
+        return False
+    instances = config.get("query_result_cache_instances")
+    if not instances:
+        return True
+    return instance.instance_name in [i.strip() for i in instances.split(",")]
+
+
+def cacheable(sql):
+    """仅缓存结果确定的查询语句"""
+    if not re.match(r"^\s*(select|with)\b", sql, re.I):
+        return False
+    return not NON_DETERMINISTIC_RE.search(sql)
+
+
+def result_cache_key(instance, db_name, sql, limit_num, **kwargs):
+    """
+    生成查询结果缓存的key，包括实例、库、过滤后的语句、limit以及脱敏规则版本号
+    权限校验在读取缓存前完成，校验通过的用户共享缓存，用户权限的差异体现在limit上
+    :return: 缓存key，获取脱敏规则版本号失败时返回None
+    """
+    try:
+        masking_version = cache.get(MASKING_RULES_VERSION_KEY) or ""
+    except Exception as e:
+        logger.warning(f"获取脱敏规则版本号失败，跳过查询结果缓存：{e}")
+        return None
+    extra = "\0".join(f"{k}={v}" for k, v in sorted(kwargs.items()))
+    digest = hashlib.sha1(
+        f"{db_name}\0{sql}\0{limit_num}\0{extra}\0{masking_version}".encode("utf-8")
+    ).hexdigest()
+    return f"query_result:{instance.id}:{digest}"
+
+
+def get_cached_result(key):
+    """读取缓存的查询结果，返回ResultSet，不存在或读取失败时返回None"""
+    try:
+        data = cache.get(key)
+        if data is None:
+            return None
+        query_result = ResultSet()
+        query_result.__dict__.update(pickle.loads(zlib.decompress(data)))
+        return query_result
+    except Exception as e:
+        logger.warning(f"读取查询结果缓存失败：{e}")
+        return None
+
+
+def set_cached_result(key, query_result, timeout=60, max_size=1024):
+    """
+    缓存查询结果(已脱敏)，压缩后超过max_size(KB)的结果集不缓存
+    :return: 是否写入缓存
+    """
+    try:
+        data = zlib.compress(
+            pickle.dumps(query_result.__dict__, protocol=pickle.HIGHEST_PROTOCOL)
+        )
+        if len(data) > max_size * 1024:
+            return False
+        cache.set(key, data, timeout=timeout)
+        return True
+    except Exception as e:
+        logger.warning(f"写入查询结果缓存失败：{e}")
+        return False
@@ -0,0 +1,479 @@
+# -*- coding:utf-8 -*-
+"""
+@license: Apache Licence
+@file: slowlog_ingest.py
+@time: 2026/10/17
+"""
+import datetime
+import hashlib
+import logging
+import os
+import random
+import re
+
+import simplejson as json
+
+from common.config import SysConfig
+from sql.engines import get_engine
+from sql.models import Instance, SlowLogCheckpoint, SlowQuery, SlowQueryHistory
+
+logger = logging.getLogger("default")
+
+# 聚合周期，和pt-query-digest定时采集的周期保持一致，单位秒
+INGEST_INTERVAL = 60 * 5
+# 每个指纹保留的执行时长样本数，用于计算95%和中位数，保证内存占用恒定
+SAMPLE_SIZE = 1000
+# 批量写入的行数
+INSERT_BATCH = 500
+# performance_schema中的时间单位为皮秒
+PICOSECOND = 10**12
+
+TIME_PATTERN = re.compile(r"^# Time: (\S+)(?:\s+(\S+))?")
+USER_HOST_PATTERN = re.compile(
+    r"^# User@Host: (\S*?)\[[^\]]*\] @ (\S*) ?\[([^\]]*)\]", re.I
+)
+METRIC_PATTERN = re.compile(r"(\w+): (\S+)")
+USE_PATTERN = re.compile(r"^use `?([^`;\s]+)`?;", re.I)
+TIMESTAMP_PATTERN = re.compile(r"^SET timestamp=(\d+);", re.I)
+# 日志文件头部，例如 /usr/sbin/mysqld, Version: 5.7.40-log (MySQL Community Server (GPL)). started with:
+HEADER_PATTERN = re.compile(r"^\S+, Version: .* started with:")
+
+FINGERPRINT_RULES = [
+    (re.compile(r"/\*.*?\*/", re.S), ""),
+    (re.compile(r"(?:--|#)[^'\"\r\n]*(?=[\r\n]|\Z)", re.M), ""),
+    (re.compile(r"\\[\"']"), ""),
+    (re.compile(r'".*?"', re.S), "?"),
+    (re.compile(r"'.*?'", re.S), "?"),
+    (re.compile(r"\bfalse\b|\btrue\b", re.I), "?"),
+    (re.compile(r"\b[0-9+-][0-9a-f.xb+-]*"), "?"),
+    (re.compile(r"[xb.+-]\?"), "?"),
+    (re.compile(r"\s+"), " "),
+]
+FINGERPRINT_LOWER_RULES = [
+    (re.compile(r"\bnull\b"), "?"),
+    (re.compile(r"\b(in|values?)(?:[\s,]*\([\s?,]*\))+"), r"\1(?+)"),
+    (re.compile(r"\blimit \?(?:, ?\?| offset \?)?"), "limit ?"),
+    (re.compile(r"\s*;\s*$"), ""),
+]
+
+
+def fingerprint(sql):
+    """
+    SQL指纹，规则和pt-query-digest的fingerprint保持一致，常量替换为?，IN和VALUES列表折叠为(?+)
+    """
+    if re.match(r"^\s*use\s", sql, re.I):
+        return "use ?"
+    query = sql
+    for pattern, repl in FINGERPRINT_RULES:
+        query = pattern.sub(repl, query)
+    query = query.strip().lower()
+    for pattern, repl in FINGERPRINT_LOWER_RULES:
+        query = pattern.sub(repl, query)
+    return query
+
+
+def checksum(fingerprint_text):
+    """指纹的校验和，和pt-query-digest一致取md5的后16位"""
+    return hashlib.md5(fingerprint_text.encode("utf-8")).hexdigest()[-16:].upper()
+
+
+class MetricStats(object):
+    """单个指标的统计，使用蓄水池抽样保留固定数量的样本"""
+
+    def __init__(self):
+        self.cnt = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.samples = []
+
+    def add(self, value):
+        self.cnt += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self.samples) < SAMPLE_SIZE:
+            self.samples.append(value)
+        else:
+            index = random.randint(0, self.cnt - 1)
+            if index < SAMPLE_SIZE:
+                self.samples[index] = value
+
+    def add_total(self, cnt, total, max_value=None):
+        """累加汇总值，无法获取单次执行的明细时使用平均值作为样本"""
+        self.cnt += cnt
+        self.sum += total
+        if max_value is not None:
+            self.max = max_value if self.max is None else max(self.max, max_value)
+        self.samples = [self.sum / self.cnt] if self.cnt else []
+
+    def percentile(self, pct):
+        if not self.samples:
+            return None
+        samples = sorted(self.samples)
+        return samples[min(int(len(samples) * pct), len(samples) - 1)]
+
+
+class QueryStats(object):
+    """一个聚合周期内单个指纹的统计"""
+
+    def __init__(self, fingerprint_text, sample):
+        self.fingerprint = fingerprint_text
+        self.sample = sample
+        self.sample_time = -1
+        self.ts_min = None
+        self.ts_max = None
+        self.user = ""
+        self.client = ""
+        self.db = None
+        self.metrics = {
+            "query_time": MetricStats(),
+            "lock_time": MetricStats(),
+            "rows_sent": MetricStats(),
+            "rows_examined": MetricStats(),
+        }
+
+    def add(self, event):
+        ts = event["ts"]
+        self.ts_min = ts if self.ts_min is None else min(self.ts_min, ts)
+        self.ts_max = ts if self.ts_max is None else max(self.ts_max, ts)
+        self.user = event["user"] or self.user
+        self.client = event["client"] or self.client
+        self.db = event["db"] or self.db
+        for name, stats in self.metrics.items():
+            stats.add(event[name])
+        # 保留执行时间最长的语句作为样例
+        if event["query_time"] > self.sample_time:
+            self.sample_time = event["query_time"]
+            self.sample = event["sql"]
+
+
+def _parse_time(value, extra=None):
+    """解析慢日志的# Time，兼容5.7及以上的ISO格式和5.6的yymmdd hh:mm:ss格式"""
+    try:
+        if extra:
+            return datetime.datetime.strptime(f"{value} {extra}", "%y%m%d %H:%M:%S")
+        return datetime.datetime.strptime(
+            value.rstrip("Z")[:26], "%Y-%m-%dT%H:%M:%S.%f"
+        )
+    except ValueError:
+        try:
+            return datetime.datetime.strptime(
+                value.rstrip("Z")[:19], "%Y-%m-%dT%H:%M:%S"
+            )
+        except ValueError:
+            return None
+
+
+def parse_slow_log(f, offset=0):
+    """
+    逐行解析慢日志文件，内存中仅保留当前语句
+    :param f: 二进制方式打开的文件
+    :param offset: 开始读取的位置
+    :return: 生成器 (语句信息, 语句开始位置, 语句结束位置)
+    """
+    f.seek(offset)
+    position = offset
+    event = None
+    event_start = offset
+    event_time = None
+    # 语句前的# Time行的位置
+    time_start = None
+    sql_lines = []
+
+    def build():
+        sql = "".join(sql_lines).strip()
+        if not sql or "query_time" not in event:
+            return None
+        return dict(event, sql=sql, ts=event.get("ts") or event_time)
+
+    while True:
+        line = f.readline()
+        # 文件末尾未写完的行下次再读取
+        if not line or not line.endswith(b"\n"):
+            break
+        line_start = position
+        position += len(line)
+        text = line.decode("utf-8", errors="replace")
+        time_match = TIME_PATTERN.match(text)
+        user_match = USER_HOST_PATTERN.match(text)
+        header_match = HEADER_PATTERN.match(text)
+        if time_match or user_match or header_match:
+            # 下一条语句或者日志头部开始时，上一条语句结束
+            if event is not None and sql_lines:
+                result = build()
+                if result:
+                    yield result, event_start, line_start
+            event, sql_lines = None, []
+            if time_match:
+                event_time = _parse_time(*time_match.groups()) or event_time
+                time_start = line_start
+            elif user_match:
+                event = {
+                    "user": user_match.group(1),
+                    "client": user_match.group(3) or user_match.group(2),
+                    "db": None,
+                }
+                event_start = line_start if time_start is None else time_start
+                time_start = None
+            continue
+        if event is None:
+            continue
+        if text.startswith("#"):
+            if text.startswith("# Query_time"):
+                metrics = dict(METRIC_PATTERN.findall(text))
+                event["query_time"] = float(metrics.get("Query_time", 0))
+                event["lock_time"] = float(metrics.get("Lock_time", 0))
+                event["rows_sent"] = float(metrics.get("Rows_sent", 0))
+                event["rows_examined"] = float(metrics.get("Rows_examined", 0))
+            continue
+        use_match = USE_PATTERN.match(text)
+        timestamp_match = TIMESTAMP_PATTERN.match(text)
+        if use_match and not sql_lines:
+            event["db"] = use_match.group(1)
+        elif timestamp_match and not sql_lines:
+            event["ts"] = datetime.datetime.utcfromtimestamp(
+                int(timestamp_match.group(1))
+            )
+        else:
+            sql_lines.append(text)
+    # 文件末尾的语句以分号结尾时认为已经写完
+    if event is not None and "".join(sql_lines).rstrip().endswith(";"):
+        result = build()
+        if result:
+            yield result, event_start, position
+
+
+class SlowLogAggregator(object):
+    """按照聚合周期和指纹汇总慢日志，周期结束后批量写入慢日志明细"""
+
+    def __init__(self, instance):
+        self.hostname = f"{instance.host}:{instance.port}"
+        self.intervals = {}
+        self.saved = 0
+
+    def add(self, event):
+        if event["ts"] is None:
+            return
+        interval = int(event["ts"].timestamp()) // INGEST_INTERVAL
+        fingerprint_text = fingerprint(event["sql"])
+        key = checksum(fingerprint_text)
+        stats = self.intervals.setdefault(interval, {}).get(key)
+        if stats is None:
+            stats = QueryStats(fingerprint_text, event["sql"])
+            self.intervals[interval][key] = stats
+        stats.add(event)
+
+    def flush(self, before=None):
+        """写入早于before的聚合周期，before为空时写入全部"""
+        intervals = sorted(
+            interval
+            for interval in self.intervals
+            if before is None or interval < before
+        )
+        queries = {}
+        histories = []
+        for interval in intervals:
+            for key, stats in self.intervals.pop(interval).items():
+                query = queries.get(key)
+                if query is None or stats.ts_max > query.last_seen:
+                    queries[key] = SlowQuery(
+                        checksum=key,
+                        fingerprint=stats.fingerprint,
+                        sample=stats.sample,
+                        first_seen=min(stats.ts_min, query.first_seen)
+                        if query
+                        else stats.ts_min,
+                        last_seen=stats.ts_max,
+                    )
+                histories.append(self._history(key, stats))
+        if not histories:
+            return 0
+        self._save_queries(queries)
+        SlowQueryHistory.objects.bulk_create(
+            histories, batch_size=INSERT_BATCH, ignore_conflicts=True
+        )
+        self.saved += len(histories)
+        return len(histories)
+
+    @staticmethod
+    def _save_queries(queries):
+        """
+        写入慢SQL指纹，仅在更晚时更新最后出现时间和样例，更早时更新首次出现时间
+        补采历史慢日志时不会使最后出现时间倒退
+        """
+        existing = {
+            checksum: (first_seen, last_seen)
+            for checksum, first_seen, last_seen in SlowQuery.objects.filter(
+                checksum__in=list(queries)
+            ).values_list("checksum", "first_seen", "last_seen")
+        }
+        newer, earlier = [], []
+        for key, query in queries.items():
+            first_seen, last_seen = existing.get(key, (None, None))
+            if last_seen is None or query.last_seen > last_seen:
+                newer.append(query)
+            if first_seen is not None and query.first_seen < first_seen:
+                earlier.append(query)
+        SlowQuery.objects.bulk_create(
+            newer,
+            batch_size=INSERT_BATCH,
+            update_conflicts=True,
+            update_fields=["sample", "last_seen"],
+        )
+        if earlier:
+            SlowQuery.objects.bulk_update(
+                earlier, ["first_seen"], batch_size=INSERT_BATCH
+            )
+
+    def _history(self, key, stats):
+        query_time = stats.metrics["query_time"]
+        lock_time = stats.metrics["lock_time"]
+        rows_sent = stats.metrics["rows_sent"]
+        rows_examined = stats.metrics["rows_examined"]
+        return SlowQueryHistory(
+            hostname_max=self.hostname,
+            client_max=stats.client,
+            user_max=stats.user,
+            db_max=stats.db,
+            checksum_id=key,
+            sample=stats.sample,
+            ts_min=stats.ts_min,
+            ts_max=stats.ts_max,
+            ts_cnt=query_time.cnt,
+            query_time_sum=query_time.sum,
+            query_time_min=query_time.min,
+            query_time_max=query_time.max,
+            query_time_pct_95=query_time.percentile(0.95),
+            query_time_median=query_time.percentile(0.5),
+            lock_time_sum=lock_time.sum,
+            lock_time_min=lock_time.min,
+            lock_time_max=lock_time.max,
+            lock_time_pct_95=lock_time.percentile(0.95),
+            rows_sent_sum=rows_sent.sum,
+            rows_sent_min=rows_sent.min,
+            rows_sent_max=rows_sent.max,
+            rows_sent_pct_95=rows_sent.percentile(0.95),
+            rows_examined_sum=rows_examined.sum,
+            rows_examined_min=rows_examined.min,
+            rows_examined_max=rows_examined.max,
+            rows_examined_pct_95=rows_examined.percentile(0.95),
+        )
+
+
+def _save_checkpoint(checkpoint, position):
+    checkpoint.position = json.dumps(position)
+    checkpoint.save(update_fields=["position", "update_time"])
+
+
+def ingest_file(instance, path):
+    """
+    采集慢日志文件，从断点开始读取，每个聚合周期结束后写入慢日志明细并更新断点
+    文件inode变化或者文件变小时认为日志已经轮转，从头开始读取
+    :return: 写入的慢日志明细行数
+    """
+    checkpoint, _ = SlowLogCheckpoint.objects.get_or_create(
+        instance=instance, source=path
+    )
+    position = json.loads(checkpoint.position or "{}")
+    stat = os.stat(path)
+    offset = position.get("offset", 0)
+    if position.get("inode") != stat.st_ino or stat.st_size < offset:
+        offset = 0
+    aggregator = SlowLogAggregator(instance)
+    current = None
+    with open(path, "rb") as f:
+        for event, start, end in parse_slow_log(f, offset):
+            interval = (
+                int(event["ts"].timestamp()) // INGEST_INTERVAL if event["ts"] else None
+            )
+            # 进入新的聚合周期时写入之前的周期，断点之前的语句均已写入
+            if interval is not None and current is not None and interval > current:
+                if aggregator.flush(before=interval):
+                    _save_checkpoint(
+                        checkpoint, {"inode": stat.st_ino, "offset": start}
+                    )
+            if interval is not None:
+                current = interval if current is None else max(current, interval)
+            aggregator.add(event)
+            offset = end
+    aggregator.flush()
+    _save_checkpoint(checkpoint, {"inode": stat.st_ino, "offset": offset})
+    return aggregator.saved
+
+
+def ingest_digest(instance):
+    """
+    采集performance_schema.events_statements_summary_by_digest，和上次采集的累计值相减得到本周期的执行情况
+    平均执行时长超过slowlog_long_query_time(默认1秒)的语句写入慢日志明细，首次采集仅记录累计值
+    :return: 写入的慢日志明细行数
+    """
+    long_query_time = float(SysConfig().get("slowlog_long_query_time") or 1)
+    checkpoint, _ = SlowLogCheckpoint.objects.get_or_create(
+        instance=instance, source="digest"
+    )
+    position = json.loads(checkpoint.position or "{}")
+    last_digests = position.get("digests", {})
+    last_time = position.get("time")
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    sql = """select SCHEMA_NAME,DIGEST,DIGEST_TEXT,COUNT_STAR,SUM_TIMER_WAIT,MAX_TIMER_WAIT,
+                    SUM_LOCK_TIME,SUM_ROWS_SENT,SUM_ROWS_EXAMINED
+             from performance_schema.events_statements_summary_by_digest
+             where DIGEST is not null;"""
+    query_engine = get_engine(instance=instance)
+    result = query_engine.query("performance_schema", sql)
+    if result.error:
+        raise RuntimeError(f"获取performance_schema语句统计失败：{result.error}")
+    aggregator = SlowLogAggregator(instance)
+    digests = {}
+    for (
+        db,
+        digest,
+        digest_text,
+        cnt,
+        timer,
+        max_timer,
+        lock,
+        sent,
+        examined,
+    ) in result.rows:
+        counters = [int(cnt), int(timer), int(lock), int(sent), int(examined)]
+        digests[f"{db}|{digest}"] = counters
+        last = last_digests.get(f"{db}|{digest}")
+        if last_time is None or not digest_text:
+            continue
+        # 统计被清空或者实例重启后累计值会变小，此时上次的累计值按0处理
+        if last is None or counters[0] < last[0]:
+            last = [0, 0, 0, 0, 0]
+        delta = [value - last_value for value, last_value in zip(counters, last)]
+        if delta[0] <= 0 or delta[1] / delta[0] / PICOSECOND < long_query_time:
+            continue
+        fingerprint_text = fingerprint(digest_text)
+        stats = aggregator.intervals.setdefault(0, {}).setdefault(
+            checksum(fingerprint_text), QueryStats(fingerprint_text, digest_text)
+        )
+        stats.ts_min = datetime.datetime.fromisoformat(last_time)
+        stats.ts_max = now
+        stats.db = stats.db or db
+        stats.metrics["query_time"].add_total(
+            delta[0], delta[1] / PICOSECOND, int(max_timer) / PICOSECOND
+        )
+        stats.metrics["lock_time"].add_total(delta[0], delta[2] / PICOSECOND)
+        stats.metrics["rows_sent"].add_total(delta[0], delta[3])
+        stats.metrics["rows_examined"].add_total(delta[0], delta[4])
+    aggregator.flush()
+    _save_checkpoint(checkpoint, {"time": now.isoformat(), "digests": digests})
+    return aggregator.saved
+
+
+def ingest_digest_task():
+    """定时采集slowlog_ingest_instances中配置的实例，多个实例使用逗号分隔"""
+    instance_names = SysConfig().get("slowlog_ingest_instances") or ""
+    for instance_name in filter(None, [n.strip() for n in instance_names.split(",")]):
+        try:
+            instance = Instance.objects.get(
+                instance_name=instance_name, db_type="mysql"
+            )
+            ingest_digest(instance)
+        except Exception as e:
+            logger.error(f"实例{instance_name}慢日志采集失败：{e}")
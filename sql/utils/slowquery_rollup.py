@@ -0,0 +1,312 @@
+# -*- coding:utf-8 -*-
+"""
+@license: Apache Licence
+@file: slowquery_rollup.py
+@time: 2026/10/17
+"""
+import datetime
+import logging
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Max, Min, Sum, Value as V
+from django.db.models.functions import Coalesce, TruncDay, TruncHour
+
+from sql.models import SlowQuery, SlowQueryHistory, SlowQueryRollup
+
+logger = logging.getLogger("default")
+
+HOUR = datetime.timedelta(hours=1)
+DAY = datetime.timedelta(days=1)
+# 每次重新聚合水位之前的小时数，用于处理延迟写入的慢日志明细
+ROLLUP_LOOKBACK_HOURS = 2
+# 已聚合的慢日志明细最大id，id大于该值的明细时间早于重新聚合的范围时，重新聚合明细所在的天
+ROLLUP_ID_KEY = "slowquery_rollup:history_id"
+# 首次聚合或者长时间未聚合时，每批聚合的时间范围
+ROLLUP_BATCH = DAY
+# 慢日志明细的时间为UTC时间，趋势图按照东八区的日期展示
+REPORT_TZ_OFFSET = datetime.timedelta(hours=8)
+
+
+def _truncate_hour(dt):
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+def _truncate_day(dt):
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _aggregates(db_field):
+    """慢日志明细和预聚合的指标字段同名，使用同一组聚合函数"""
+    return {
+        "cnt": Sum("ts_cnt"),
+        "last_time": Max("ts_max"),
+        "query_time": Sum("query_time_sum"),
+        "query_time_pct_95_max": Max("query_time_pct_95"),
+        "rows_examined": Sum("rows_examined_sum"),
+        "rows_sent": Sum("rows_sent_sum"),
+        "db": Max(db_field),
+    }
+
+
+def _rollup_objects(rows, granularity, bucket_field):
+    return [
+        SlowQueryRollup(
+            granularity=granularity,
+            bucket=row[bucket_field],
+            hostname=row["host"],
+            db_name=row["db_key"],
+            checksum_id=row["checksum"],
+            ts_cnt=row["cnt"] or 0,
+            ts_max=row["last_time"],
+            query_time_sum=row["query_time"] or 0,
+            query_time_pct_95=row["query_time_pct_95_max"] or 0,
+            rows_examined_sum=row["rows_examined"] or 0,
+            rows_sent_sum=row["rows_sent"] or 0,
+        )
+        for row in rows
+    ]
+
+
+def rollup_watermark():
+    """
+    预聚合水位，即最后一个小时聚合的统计时间，该小时可能尚未结束
+    水位之前的数据读取预聚合，水位及之后的数据实时聚合慢日志明细
+    """
+    return SlowQueryRollup.objects.filter(granularity="hour").aggregate(Max("bucket"))[
+        "bucket__max"
+    ]
+
+
+def _rollup_hours(start, end):
+    """重新聚合[start, end)范围内的小时数据"""
+    rows = (
+        SlowQueryHistory.objects.filter(ts_min__gte=start, ts_min__lt=end)
+        .annotate(
+            hour=TruncHour("ts_min"),
+            host=F("hostname_max"),
+            db_key=Coalesce("db_max", V("")),
+        )
+        .values("hour", "host", "db_key", "checksum")
+        .annotate(**_aggregates("db_max"))
+        .order_by()
+    )
+    objs = _rollup_objects(rows, "hour", "hour")
+    with transaction.atomic():
+        SlowQueryRollup.objects.filter(
+            granularity="hour", bucket__gte=start, bucket__lt=end
+        ).delete()
+        SlowQueryRollup.objects.bulk_create(objs, batch_size=1000)
+
+
+def _rollup_days(start, end):
+    """使用小时数据重新聚合[start, end)范围内的天数据"""
+    rows = (
+        SlowQueryRollup.objects.filter(
+            granularity="hour", bucket__gte=start, bucket__lt=end
+        )
+        .annotate(day=TruncDay("bucket"), host=F("hostname"), db_key=F("db_name"))
+        .values("day", "host", "db_key", "checksum")
+        .annotate(**_aggregates("db_name"))
+        .order_by()
+    )
+    objs = _rollup_objects(rows, "day", "day")
+    with transaction.atomic():
+        SlowQueryRollup.objects.filter(
+            granularity="day", bucket__gte=start, bucket__lt=end
+        ).delete()
+        SlowQueryRollup.objects.bulk_create(objs, batch_size=1000)
+
+
+def _rollup_late_days(last_id, max_id, start):
+    """
+    重新聚合延迟写入的明细所在的天，例如pt-query-digest补采、导入历史慢日志文件
+    :param last_id: 上次聚合时明细的最大id
+    :param max_id: 本次聚合时明细的最大id
+    :param start: 本次增量聚合的开始时间，之后的明细会重新聚合
+    :return: 重新聚合的天列表
+    """
+    days = sorted(
+        SlowQueryHistory.objects.filter(
+            id__gt=last_id, id__lte=max_id, ts_min__lt=start
+        )
+        .annotate(day=TruncDay("ts_min"))
+        .values_list("day", flat=True)
+        .distinct()
+        .order_by()
+    )
+    for day in days:
+        _rollup_hours(day, min(day + DAY, start))
+        _rollup_days(day, day + DAY)
+    return days
+
+
+def rollup():
+    """
+    增量聚合慢日志明细，从水位前ROLLUP_LOOKBACK_HOURS小时开始重新聚合到最新的明细，供定时任务调用
+    上次聚合之后新增的明细时间早于该范围时，同时重新聚合明细所在的天
+    :return: 本次聚合的时间范围
+    """
+    stats = SlowQueryHistory.objects.aggregate(Max("ts_min"), Max("id"))
+    latest, max_id = stats["ts_min__max"], stats["id__max"]
+    if latest is None:
+        return None
+    end = _truncate_hour(latest) + HOUR
+    watermark = rollup_watermark()
+    last_id = cache.get(ROLLUP_ID_KEY)
+    # 首次聚合，或者记录的明细id丢失时全量聚合
+    if watermark is None or last_id is None:
+        start = _truncate_hour(
+            SlowQueryHistory.objects.aggregate(Min("ts_min"))["ts_min__min"]
+        )
+    else:
+        start = watermark - HOUR * ROLLUP_LOOKBACK_HOURS
+        late_days = _rollup_late_days(last_id, max_id, start)
+        if late_days:
+            logger.info(f"慢日志预聚合重新聚合延迟写入的明细，日期：{late_days}")
+    begin = start
+    while start < end:
+        batch_end = min(start + ROLLUP_BATCH, end)
+        _rollup_hours(start, batch_end)
+        _rollup_days(_truncate_day(start), _truncate_day(batch_end - HOUR) + DAY)
+        start = batch_end
+    cache.set(ROLLUP_ID_KEY, max_id, timeout=None)
+    logger.debug(f"慢日志预聚合完成，范围：{begin} - {end}")
+    return begin, end
+
+
+def _segments(start, end):
+    """
+    将查询范围按照水位拆分为 完整天的预聚合、小时预聚合、实时聚合的明细 三类区间
+    :return: [(数据来源, 开始时间, 结束时间)]
+    """
+    watermark = rollup_watermark()
+    split = min(max(watermark or start, start), end)
+    day_start = _truncate_day(start)
+    if day_start < start:
+        day_start += DAY
+    day_end = max(_truncate_day(split), day_start)
+    segments = [
+        ("hour", start, min(day_start, split)),
+        ("day", day_start, day_end),
+        ("hour", day_end, split),
+        ("history", split, end),
+    ]
+    return [segment for segment in segments if segment[1] < segment[2]]
+
+
+def review(
+    hostname,
+    start,
+    end,
+    db_name=None,
+    search=None,
+    sort_name="MySQLTotalExecutionCounts",
+    sort_order="desc",
+    offset=0,
+    limit=None,
+):
+    """
+    基于预聚合统计实例[start, end)范围内的慢日志，水位之后的数据实时聚合
+    :return: (总数, 当前页的统计数据)，字段和slowquery_review的返回保持一致
+    """
+    summary = {}
+    for source, segment_start, segment_end in _segments(start, end):
+        if source == "history":
+            queryset = SlowQueryHistory.objects.filter(
+                hostname_max=hostname,
+                ts_min__gte=segment_start,
+                ts_min__lt=segment_end,
+            )
+            db_field = "db_max"
+        else:
+            queryset = SlowQueryRollup.objects.filter(
+                granularity=source,
+                hostname=hostname,
+                bucket__gte=segment_start,
+                bucket__lt=segment_end,
+            )
+            db_field = "db_name"
+        if db_name:
+            queryset = queryset.filter(**{db_field: db_name})
+        if search:
+            queryset = queryset.filter(checksum__fingerprint__icontains=search)
+        rows = queryset.values("checksum").annotate(**_aggregates(db_field)).order_by()
+        for row in rows:
+            item = summary.setdefault(
+                row["checksum"],
+                {
+                    "SQLId": row["checksum"],
+                    "CreateTime": None,
+                    "DBName": None,
+                    "MySQLTotalExecutionCounts": 0,
+                    "MySQLTotalExecutionTimes": 0,
+                    "ParseTotalRowCounts": 0,
+                    "ReturnTotalRowCounts": 0,
+                },
+            )
+            if row["last_time"] and (
+                item["CreateTime"] is None or row["last_time"] > item["CreateTime"]
+            ):
+                item["CreateTime"] = row["last_time"]
+            item["DBName"] = max(
+                filter(None, [item["DBName"], row["db"]]), default=None
+            )
+            item["MySQLTotalExecutionCounts"] += row["cnt"] or 0
+            item["MySQLTotalExecutionTimes"] += row["query_time"] or 0
+            item["ParseTotalRowCounts"] += row["rows_examined"] or 0
+            item["ReturnTotalRowCounts"] += row["rows_sent"] or 0
+
+    rows = list(summary.values())
+    for row in rows:
+        cnt = row["MySQLTotalExecutionCounts"] or 1
+        row["QueryTimeAvg"] = round(row["MySQLTotalExecutionTimes"] / cnt, 6)
+        row["MySQLTotalExecutionTimes"] = round(row["MySQLTotalExecutionTimes"], 6)
+        row["ParseRowAvg"] = int(row["ParseTotalRowCounts"] / cnt)
+        row["ReturnRowAvg"] = int(row["ReturnTotalRowCounts"] / cnt)
+
+    # 按照SQL文本排序时才需要获取全部指纹，否则仅获取当前页的指纹
+    if sort_name == "SQLText":
+        _fill_fingerprint(rows)
+    if rows and sort_name in rows[0]:
+        rows.sort(
+            key=lambda r: (r[sort_name] is not None, r[sort_name]),
+            reverse=sort_order == "desc",
+        )
+    page = rows[offset : offset + limit if limit else None]
+    if sort_name != "SQLText":
+        _fill_fingerprint(page)
+    return len(rows), page
+
+
+def _fill_fingerprint(rows):
+    fingerprints = dict(
+        SlowQuery.objects.filter(
+            checksum__in=[row["SQLId"] for row in rows]
+        ).values_list("checksum", "fingerprint")
+    )
+    for row in rows:
+        row["SQLText"] = fingerprints.get(row["SQLId"], "")
+
+
+def history_by_day(checksum):
+    """
+    慢SQL每日的执行次数和95%执行时长，水位之前读取小时预聚合，之后实时读取慢日志明细
+    :return: [(日期, 执行次数, 95%执行时长)]
+    """
+    watermark = rollup_watermark()
+    rows = []
+    if watermark:
+        rows += SlowQueryRollup.objects.filter(
+            granularity="hour", checksum=checksum, bucket__lt=watermark
+        ).values_list("bucket", "ts_cnt", "query_time_pct_95")
+    history = SlowQueryHistory.objects.filter(checksum=checksum)
+    if watermark:
+        history = history.filter(ts_min__gte=watermark)
+    rows += history.values_list("ts_min", "ts_cnt", "query_time_pct_95")
+    days = {}
+    for ts, cnt, pct_95 in rows:
+        day = (ts + REPORT_TZ_OFFSET).date()
+        total, pct = days.get(day, (0, 0))
+        days[day] = (total + (cnt or 0), max(pct, pct_95 or 0))
+    return [(day, cnt, pct) for day, (cnt, pct) in sorted(days.items())]
@@ -312,3 +312,29 @@ def get_exec_sqlitem_list(reviewResult, db_name):
             )
         )
     return list
+
+
+# SQL指纹中需要归一化的内容：反引号标识符保持不变，连续空白合并为一个空格，字符串和数字替换为?
+_fingerprint_re = re.compile(
+    r"(`(?:[^`]|``)*`)"
+    r"|(\s+)"
+    r"|'(?:[^'\\]|\\.|'')*'"
+    r'|"(?:[^"\\]|\\.|"")*"'
+    r"|(?<![\w$.])\d+(?:\.\d+)?(?:e[-+]?\d+)?(?![\w$])",
+    re.I | re.S,
+)
+_fingerprint_list_re = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+
+def sql_fingerprint(sql):
+    """
+    生成SQL指纹，字面量替换为?并合并空白字符，仅字面量不同的语句指纹相同
+    不修改大小写和注释，避免影响标识符和可执行注释
+    :param sql:
+    :return:
+    """
+    sql = _fingerprint_re.sub(
+        lambda m: m.group(1) or (" " if m.group(2) else "?"),
+        sql.strip().rstrip(";").rstrip(),
+    )
+    return _fingerprint_list_re.sub("(?+)", sql)
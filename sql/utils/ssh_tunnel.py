@@ -5,14 +5,22 @@
 @file: ssh_tunnel.py
 @time: 2020/05/09
 """
+import hashlib
+import logging
+import threading
+import time
+
+from django.conf import settings
 from sshtunnel import SSHTunnelForwarder
 from paramiko import RSAKey
 import io
 
+logger = logging.getLogger("default")
 
-class SSHConnection(object):
+
+class SSHTunnel(object):
     """
-    ssh隧道连接类，用于映射ssh隧道端口到本地，连接结束时需要清理
+    进程内共享的ssh隧道，同一个(隧道, 远端地址)只维护一个端口映射
     """
 
     def __init__(
@@ -32,31 +40,158 @@ class SSHConnection(object):
         self.tun_port = int(tun_port)
         self.tun_user = tun_user
         self.tun_password = tun_password
+        self.pkey = pkey
+        self.pkey_password = pkey_password
+        self.server = None
+        # 引用计数和最后一次释放时间，用于回收空闲隧道
+        self.refs = 0
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
 
-        if pkey:
+    def _forwarder(self):
+        if self.pkey:
             private_key_file_obj = io.StringIO()
-            private_key_file_obj.write(pkey)
+            private_key_file_obj.write(self.pkey)
             private_key_file_obj.seek(0)
-            self.private_key = RSAKey.from_private_key(
-                private_key_file_obj, password=pkey_password
+            private_key = RSAKey.from_private_key(
+                private_key_file_obj, password=self.pkey_password
             )
-            self.server = SSHTunnelForwarder(
+            return SSHTunnelForwarder(
                 ssh_address_or_host=(self.tun_host, self.tun_port),
                 ssh_username=self.tun_user,
-                ssh_pkey=self.private_key,
+                ssh_pkey=private_key,
                 remote_bind_address=(self.host, self.port),
             )
-        else:
-            self.server = SSHTunnelForwarder(
-                ssh_address_or_host=(self.tun_host, self.tun_port),
-                ssh_username=self.tun_user,
-                ssh_password=self.tun_password,
-                remote_bind_address=(self.host, self.port),
-            )
-        self.server.start()
+        return SSHTunnelForwarder(
+            ssh_address_or_host=(self.tun_host, self.tun_port),
+            ssh_username=self.tun_user,
+            ssh_password=self.tun_password,
+            remote_bind_address=(self.host, self.port),
+        )
+
+    def ensure_started(self):
+        """隧道未启动或者ssh连接已断开时(重新)建立隧道"""
+        with self.lock:
+            if self.server is not None and self.server.is_active:
+                return
+            if self.server is not None:
+                logger.warning(f"ssh隧道{self.tun_host}:{self.tun_port}连接已断开，重新建立隧道")
+                self.stop()
+            server = self._forwarder()
+            server.start()
+            self.server = server
+
+    def stop(self):
+        if self.server is not None:
+            try:
+                self.server.close()
+            except Exception:
+                pass
+            self.server = None
+
+    @property
+    def local_bind_port(self):
+        return self.server.local_bind_port
+
+
+class SSHTunnelRegistry(object):
+    """
+    ssh隧道注册表，按照(隧道, 远端地址, 认证信息)复用隧道，引用计数为0并且空闲超时后关闭
+    """
+
+    def __init__(self):
+        self._tunnels = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(
+        host, port, tun_host, tun_port, tun_user, tun_password, pkey, pkey_password
+    ):
+        secret = hashlib.sha1(
+            f"{tun_password}\0{pkey}\0{pkey_password}".encode("utf-8")
+        ).hexdigest()
+        return tun_host, int(tun_port), tun_user, host, int(port), secret
+
+    def acquire(self, *args, idle_timeout=600):
+        """获取隧道并增加引用计数，隧道不存在或者已断开时建立隧道"""
+        key = self.key(*args)
+        with self._lock:
+            self._expire_idle(idle_timeout)
+            tunnel = self._tunnels.get(key)
+            if tunnel is None:
+                tunnel = SSHTunnel(*args)
+                self._tunnels[key] = tunnel
+            tunnel.refs += 1
+        # 建立隧道耗时较长，不在注册表锁内执行
+        try:
+            tunnel.ensure_started()
+        except Exception:
+            self.release(tunnel)
+            raise
+        return tunnel
+
+    def release(self, tunnel):
+        """减少引用计数，隧道保留至空闲超时"""
+        with self._lock:
+            tunnel.refs -= 1
+            tunnel.last_used = time.monotonic()
+
+    def close_all(self):
+        with self._lock:
+            tunnels = list(self._tunnels.values())
+            self._tunnels.clear()
+        for tunnel in tunnels:
+            tunnel.stop()
+
+    def _expire_idle(self, idle_timeout):
+        """关闭无引用并且空闲超时的隧道，需要在持有锁时调用"""
+        now = time.monotonic()
+        for key, tunnel in list(self._tunnels.items()):
+            if tunnel.refs <= 0 and now - tunnel.last_used > idle_timeout:
+                del self._tunnels[key]
+                tunnel.stop()
+
+    def __len__(self):
+        return len(self._tunnels)
+
+
+tunnel_registry = SSHTunnelRegistry()
+
+
+class SSHConnection(object):
+    """
+    ssh隧道连接类，用于映射ssh隧道端口到本地，连接结束时需要清理
+    隧道由进程内的注册表共享，清理时仅释放引用，空闲超时后才会真正关闭
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        tun_host,
+        tun_port,
+        tun_user,
+        tun_password,
+        pkey,
+        pkey_password,
+    ):
+        self.tunnel = None
+        self.tunnel = tunnel_registry.acquire(
+            host,
+            port,
+            tun_host,
+            tun_port,
+            tun_user,
+            tun_password,
+            pkey,
+            pkey_password,
+            idle_timeout=settings.SSH_TUNNEL_IDLE_TIMEOUT,
+        )
 
     def __del__(self):
-        self.server.close()
+        if self.tunnel is not None:
+            tunnel_registry.release(self.tunnel)
+            self.tunnel = None
 
     def get_ssh(self):
         """
@@ -64,4 +199,4 @@ class SSHConnection(object):
         :param request:
         :return:
         """
-        return "127.0.0.1", self.server.local_bind_port
+        return "127.0.0.1", self.tunnel.local_bind_port
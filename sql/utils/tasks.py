@@ -50,6 +50,116 @@ def add_sync_ding_user_schedule():
     )
 
 
+def add_slowquery_rollup_schedule():
+    """添加慢日志预聚合定时任务"""
+    del_schedule(name="慢日志预聚合")
+    schedule(
+        "sql.utils.slowquery_rollup.rollup",
+        name="慢日志预聚合",
+        schedule_type="I",
+        minutes=10,
+        repeats=-1,
+        timeout=-1,
+    )
+
+
+def add_slowlog_ingest_schedule():
+    """添加慢日志采集定时任务"""
+    del_schedule(name="慢日志采集")
+    schedule(
+        "sql.utils.slowlog_ingest.ingest_digest_task",
+        name="慢日志采集",
+        schedule_type="I",
+        minutes=5,
+        repeats=-1,
+        timeout=-1,
+    )
+
+
+def add_binlog_index_schedule():
+    """添加binlog索引定时任务"""
+    del_schedule(name="binlog索引")
+    schedule(
+        "sql.utils.binlog_index.index_task",
+        name="binlog索引",
+        schedule_type="I",
+        minutes=10,
+        repeats=-1,
+        timeout=-1,
+    )
+
+
+def add_archive_dispatch_schedule():
+    """添加归档调度定时任务，按照时间窗口和并发限制启动队列中的归档任务"""
+    del_schedule(name="归档调度")
+    schedule(
+        "sql.utils.archive_scheduler.dispatch",
+        name="归档调度",
+        schedule_type="I",
+        minutes=1,
+        repeats=-1,
+        timeout=-1,
+    )
+
+
+def add_query_log_flush_schedule():
+    """添加查询日志写入定时任务，兜底写入异步任务提交失败时遗留在缓冲中的日志"""
+    del_schedule(name="查询日志写入")
+    schedule(
+        "sql.utils.query_log_writer.flush",
+        name="查询日志写入",
+        schedule_type="I",
+        minutes=1,
+        repeats=-1,
+        timeout=-1,
+    )
+
+
+def add_query_log_archive_schedule():
+    """添加查询日志归档定时任务"""
+    del_schedule(name="查询日志归档")
+    schedule(
+        "sql.utils.query_log_writer.archive",
+        name="查询日志归档",
+        schedule_type="D",
+        repeats=-1,
+        timeout=-1,
+    )
+
+
+def _ensure_schedule(name, add_schedule):
+    """定时任务不存在时才添加，避免保存配置时重置已有定时任务的下次执行时间"""
+    if not task_info(name):
+        add_schedule()
+
+
+def sync_config_schedules(config):
+    """根据系统配置添加或者删除慢日志预聚合、慢日志采集、binlog索引、查询日志定时任务"""
+    if config.get("slowquery_rollup"):
+        _ensure_schedule("慢日志预聚合", add_slowquery_rollup_schedule)
+    else:
+        del_schedule(name="慢日志预聚合")
+    if config.get("slowlog_ingest_instances"):
+        _ensure_schedule("慢日志采集", add_slowlog_ingest_schedule)
+    else:
+        del_schedule(name="慢日志采集")
+    if config.get("binlog_index_instances"):
+        _ensure_schedule("binlog索引", add_binlog_index_schedule)
+    else:
+        del_schedule(name="binlog索引")
+    # 关闭异步写入后保留定时任务直到缓冲写完，由flush写完后删除
+    from sql.utils.query_log_writer import pending
+
+    if config.get("query_log_async") or pending():
+        _ensure_schedule("查询日志写入", add_query_log_flush_schedule)
+    else:
+        del_schedule(name="查询日志写入")
+    if int(config.get("query_log_retention_days") or 0) > 0:
+        _ensure_schedule("查询日志归档", add_query_log_archive_schedule)
+    else:
+        del_schedule(name="查询日志归档")
+
+
 def del_schedule(name):
     """删除schedule"""
     try:
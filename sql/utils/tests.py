@@ -12,17 +12,21 @@ import os
 import django
 
 import datetime
+import gzip
 import json
+import shutil
 from unittest.mock import patch, MagicMock
 
 from django.conf import settings
+from django.db import OperationalError
 from django.contrib.auth.models import Permission, Group
-from django.test import TestCase, Client
+from django.test import TestCase, Client, override_settings
 from django_q.models import Schedule
+from django_redis import get_redis_connection
 
 from common.config import SysConfig
 from common.utils.const import WorkflowDict
-from sql.engines.models import ReviewResult, ReviewSet
+from sql.engines.models import ResultSet, ReviewResult, ReviewSet
 from sql.models import (
     Users,
     SqlWorkflow,
@@ -38,6 +42,12 @@ from sql.models import (
     DataMaskingColumns,
     InstanceTag,
     ArchiveConfig,
+    SlowLogCheckpoint,
+    SlowQuery,
+    SlowQueryHistory,
+    BinlogIndex,
+    BinlogPosition,
+    QueryLog,
 )
 from sql.utils.resource_group import user_groups, user_instances, auth_group_users
 from sql.utils.sql_review import (
@@ -49,9 +59,46 @@ from sql.utils.sql_review import (
 )
 from sql.utils.sql_utils import *
 from sql.utils.execute_sql import execute, execute_callback
-from sql.utils.tasks import add_sql_schedule, del_schedule, task_info
+from sql.utils.tasks import (
+    add_sql_schedule,
+    del_schedule,
+    sync_config_schedules,
+    task_info,
+)
 from sql.utils.workflow_audit import Audit
-from sql.utils.data_masking import data_masking, brute_mask, simple_column_mask
+from sql.utils.data_masking import (
+    data_masking,
+    brute_mask,
+    simple_column_mask,
+    mask_rows,
+    masking_rules,
+    Masker,
+)
+from sql.utils.connection_pool import (
+    ConnectionPool,
+    PoolExhausted,
+    get_pool,
+    close_pools,
+)
+from sql.utils.ssh_tunnel import SSHConnection, tunnel_registry
+from sql.utils.resource_cache import InstanceResourceCache
+from sql.utils.slowlog_ingest import fingerprint, ingest_digest, ingest_file
+from sql.utils.binlog_parser import Binlog2SQL
+from sql.utils.binlog_index import index_instance, resolve_range
+from sql.utils.keyset_pagination import (
+    approximate_count,
+    decode_cursor,
+    encode_cursor,
+    paginate,
+    text_search,
+)
+from sql.utils import query_log_writer
+from pymysqlreplication.event import GtidEvent, QueryEvent, XidEvent
+from pymysqlreplication.row_event import (
+    DeleteRowsEvent,
+    UpdateRowsEvent,
+    WriteRowsEvent,
+)
 
 User = Users
 __author__ = "hhyo"
@@ -80,6 +127,26 @@ class TestSQLUtils(TestCase):
         self.assertEqual(get_syntax_type(ddl_sql, parser=False, db_type="mysql"), "DDL")
         self.assertIsNone(get_syntax_type(other_sql, parser=False, db_type="mysql"))
 
+    def test_sql_fingerprint(self):
+        """
+        测试SQL指纹，字面量不同的语句指纹相同，标识符保持不变
+        :return:
+        """
+        sql1 = "select * from users where id in (1, 2, 3) and name='a''b' limit 100;"
+        sql2 = "select *  from users\n where id in (4) and name='c' limit 10"
+        self.assertEqual(
+            sql_fingerprint(sql1),
+            "select * from users where id in (?+) and name=? limit ?",
+        )
+        self.assertEqual(
+            sql_fingerprint(sql2),
+            "select * from users where id in (?) and name=? limit ?",
+        )
+        self.assertEqual(
+            sql_fingerprint("select `a  1`, t1.c2 from db1.t1"),
+            "select `a  1`, t1.c2 from db1.t1",
+        )
+
     def test_remove_comments(self):
         """
         测试去除SQL注释
@@ -826,6 +893,15 @@ class TestTasks(TestCase):
         with self.assertRaises(Schedule.DoesNotExist):
             Schedule.objects.get(name="some_name1")
 
+    def test_sync_config_schedules(self):
+        """已存在的定时任务不重新创建，关闭的定时任务删除"""
+        sync_config_schedules({"slowquery_rollup": True})
+        created = Schedule.objects.get(name="慢日志预聚合")
+        sync_config_schedules({"slowquery_rollup": True})
+        self.assertEqual(Schedule.objects.get(name="慢日志预聚合").id, created.id)
+        sync_config_schedules({})
+        self.assertFalse(Schedule.objects.filter(name="慢日志预聚合").exists())
+
 
 class TestAudit(TestCase):
     def setUp(self):
@@ -1173,6 +1249,21 @@ class TestAudit(TestCase):
         Audit.todo(self.user)
         Audit.todo(self.su)
 
+    def test_todo_count(self):
+        """测试待办数量，需要同时在工单的资源组和当前审批权限组中"""
+        auth_group = Group.objects.create(name="todo_auth_group")
+        self.audit.current_audit = str(auth_group.id)
+        self.audit.save()
+        self.assertEqual(Audit.todo(self.user), 0)
+        self.user.groups.add(auth_group)
+        self.assertEqual(Audit.todo(self.user), 0)
+        self.user.resource_group.add(self.res_group)
+        self.assertEqual(Audit.todo(self.user), 1)
+        self.assertEqual(Audit.todo(self.su), 1)
+        self.audit.current_status = WorkflowDict.workflow_status["audit_success"]
+        self.audit.save()
+        self.assertEqual(Audit.todo(self.user), 0)
+
     def test_detail(self):
         """测试获取审核信息"""
         result = Audit.detail(self.audit.audit_id)
@@ -1805,6 +1896,36 @@ class TestDataMasking(TestCase):
             print("test_data_masking_union_support_keyword", r.rows)
             self.assertEqual(r.rows, mask_result_rows)
 
+    def test_masking_rules_cached(self):
+        """已编译的脱敏规则在规则未变更时复用，规则变更后重新编译"""
+        rules = masking_rules()
+        self.assertIs(masking_rules()[1], rules[1])
+        DataMaskingRules.objects.filter(rule_type=1).update(hide_group=1)
+        self.assertIs(masking_rules()[1], rules[1])
+        rule = DataMaskingRules.objects.get(rule_type=1)
+        rule.save()
+        self.assertEqual(masking_rules()[1].hide_group, 1)
+
+    def test_masker_mask(self):
+        masker = Masker("(.{3})(.*)(.{4})", 2)
+        self.assertEqual(masker.mask("18888888888"), "188****8888")
+        self.assertEqual(masker.mask("188"), "188")
+        self.assertIsNone(masker.mask(None))
+        self.assertEqual(masker.sub("tel:18888888888"), "tel****8888")
+
+    def test_mask_rows_large_result(self):
+        """10000行x50列结果集脱敏，性能测试使用manage.py masking_benchmark"""
+        rows = [
+            tuple(f"1{i:010d}" if j % 10 == 0 else f"v{i}_{j}" for j in range(50))
+            for i in range(10000)
+        ]
+        hit_columns = [{"index": j, "rule_type": 1} for j in range(0, 50, 10)]
+        rules = masking_rules()
+        masked_rows = mask_rows(rows, hit_columns, rules)
+        self.assertEqual(masked_rows[1][0], "100****0001")
+        self.assertEqual(masked_rows[1][1], "v1_1")
+        self.assertEqual(len(masked_rows), 10000)
+
     def test_brute_mask(self):
         sql = """select * from users;"""
         rows = (("18888888888",), ("18888888889",), ("18888888810",))
@@ -1907,3 +2028,791 @@ class TestResourceGroup(TestCase):
             auth_group_names=[self.agp.name], group_id=self.rgp1.group_id
         )
         self.assertIn(self.user, users)
+
+
+class TestConnectionPool(TestCase):
+    def tearDown(self):
+        close_pools()
+
+    def test_acquire_reuse_connection(self):
+        """归还的连接再次获取时复用，并且执行健康检查和会话重置"""
+        creator = MagicMock()
+        ping = MagicMock()
+        reset = MagicMock()
+        pool = ConnectionPool(creator, ping=ping, reset=reset)
+        conn = pool.acquire()
+        pool.release(conn)
+        self.assertEqual(pool.acquire(), conn)
+        creator.assert_called_once()
+        ping.assert_called_once_with(conn)
+        reset.assert_called_once_with(conn)
+        self.assertEqual(pool.size, 1)
+
+    def test_acquire_ping_failed(self):
+        """健康检查失败的连接被丢弃并新建连接"""
+        creator = MagicMock(side_effect=["conn1", "conn2"])
+        pool = ConnectionPool(creator, ping=MagicMock(side_effect=Exception("gone")))
+        pool.release(pool.acquire())
+        self.assertEqual(pool.acquire(), "conn2")
+        self.assertEqual(pool.size, 1)
+
+    def test_release_reset_failed(self):
+        """会话重置失败的连接直接关闭，不放回连接池"""
+        conn = MagicMock()
+        pool = ConnectionPool(
+            MagicMock(return_value=conn), reset=MagicMock(side_effect=Exception)
+        )
+        pool.release(pool.acquire())
+        conn.close.assert_called_once()
+        self.assertEqual(pool.size, 0)
+        self.assertEqual(pool.idle_size, 0)
+
+    def test_idle_timeout(self):
+        """超过空闲时间的连接被清理"""
+        conn1, conn2 = MagicMock(), MagicMock()
+        pool = ConnectionPool(MagicMock(side_effect=[conn1, conn2]), idle_timeout=-1)
+        pool.release(pool.acquire())
+        self.assertEqual(pool.acquire(), conn2)
+        conn1.close.assert_called_once()
+
+    def test_pool_exhausted(self):
+        """连接数已满时等待超时抛出异常"""
+        pool = ConnectionPool(MagicMock(), max_size=1, wait_timeout=0)
+        pool.acquire()
+        with self.assertRaises(PoolExhausted):
+            pool.acquire()
+
+    def test_get_pool_signature_changed(self):
+        """连接信息修改后重建连接池"""
+        pool1 = get_pool((1, "db"), ("host", 3306), MagicMock())
+        self.assertEqual(get_pool((1, "db"), ("host", 3306), MagicMock()), pool1)
+        pool2 = get_pool((1, "db"), ("host", 3307), MagicMock())
+        self.assertNotEqual(pool2, pool1)
+        self.assertTrue(pool1.closed)
+
+
+class TestSSHTunnel(TestCase):
+    def tearDown(self):
+        tunnel_registry.close_all()
+
+    @patch("sql.utils.ssh_tunnel.SSHTunnelForwarder")
+    def test_tunnel_shared(self, _forwarder):
+        """相同隧道和远端地址的连接共享同一个隧道"""
+        _forwarder.return_value.local_bind_port = 12345
+        args = ("db_host", 3306, "tun_host", 22, "tun_user", "tun_pwd", None, None)
+        ssh1 = SSHConnection(*args)
+        ssh2 = SSHConnection(*args)
+        _forwarder.assert_called_once()
+        _forwarder.return_value.start.assert_called_once()
+        self.assertEqual(ssh1.get_ssh(), ("127.0.0.1", 12345))
+        self.assertEqual(ssh1.tunnel, ssh2.tunnel)
+        self.assertEqual(ssh1.tunnel.refs, 2)
+        del ssh1, ssh2
+        self.assertEqual(len(tunnel_registry), 1)
+        _forwarder.return_value.close.assert_not_called()
+
+    @patch("sql.utils.ssh_tunnel.SSHTunnelForwarder")
+    def test_tunnel_reconnect(self, _forwarder):
+        """ssh连接断开后重新建立隧道"""
+        args = ("db_host", 3306, "tun_host", 22, "tun_user", "tun_pwd", None, None)
+        ssh = SSHConnection(*args)
+        _forwarder.return_value.is_active = False
+        SSHConnection(*args)
+        self.assertEqual(_forwarder.call_count, 2)
+        _forwarder.return_value.close.assert_called_once()
+        self.assertEqual(ssh.tunnel.refs, 2)
+
+    @override_settings(SSH_TUNNEL_IDLE_TIMEOUT=-1)
+    @patch("sql.utils.ssh_tunnel.SSHTunnelForwarder")
+    def test_tunnel_idle_expire(self, _forwarder):
+        """无引用的隧道空闲超时后关闭"""
+        ssh = SSHConnection(
+            "db_host", 3306, "tun_host", 22, "tun_user", "tun_pwd", None, None
+        )
+        del ssh
+        SSHConnection(
+            "db_host2", 3306, "tun_host", 22, "tun_user", "tun_pwd", None, None
+        )
+        _forwarder.return_value.close.assert_called_once()
+        self.assertEqual(len(tunnel_registry), 1)
+
+
+class TestInstanceResourceCache(TestCase):
+    """测试实例资源缓存"""
+
+    def setUp(self):
+        self.ins = Instance.objects.create(
+            instance_name="some_ins",
+            type="slave",
+            db_type="mysql",
+            host="some_host",
+            port=3306,
+            user="ins_user",
+            password="some_str",
+        )
+        self.cache = InstanceResourceCache(self.ins)
+        self.cache.invalidate()
+        self.cache.set("database", ["db1", "db2"])
+        self.cache.set("table:db1:", ["t1", "t2"])
+        self.cache.set("column:db1::t1", ["id"])
+        self.cache.set("column:db1::t2", ["id", "name"])
+        self.cache.set("table:db2:", ["t1"])
+        self.cache.set("column:db2::t1", ["id"])
+
+    def tearDown(self):
+        self.cache.invalidate()
+        self.ins.delete()
+
+    def test_get_set(self):
+        self.assertEqual(self.cache.get("column:db1::t2"), ["id", "name"])
+        self.assertIsNone(self.cache.get("column:db1::t3"))
+
+    def test_invalidate_by_sql(self):
+        """仅清理DDL涉及的表和所在库的表列表"""
+        self.cache.invalidate_by_sql("db1", "alter table t1 add column c int;")
+        self.assertIsNone(self.cache.get("column:db1::t1"))
+        self.assertIsNone(self.cache.get("table:db1:"))
+        self.assertEqual(self.cache.get("column:db1::t2"), ["id", "name"])
+        self.assertEqual(self.cache.get("column:db2::t1"), ["id"])
+        self.assertEqual(self.cache.get("database"), ["db1", "db2"])
+
+    def test_invalidate_db(self):
+        """无法解析涉及的表时清理整个库"""
+        self.cache.invalidate_by_sql("db1", "create database db3;")
+        self.assertIsNone(self.cache.get("column:db1::t2"))
+        self.assertIsNone(self.cache.get("database"))
+        self.assertEqual(self.cache.get("table:db2:"), ["t1"])
+
+    def test_invalidate_view(self):
+        """视图DDL清理视图所在的整个库"""
+        self.cache.invalidate_by_sql(
+            "db2", "create or replace view db1.v as select id from db2.t1;"
+        )
+        self.assertIsNone(self.cache.get("column:db1::t2"))
+        self.assertEqual(self.cache.get("column:db2::t1"), ["id"])
+        self.cache.invalidate_by_sql("db2", "DROP VIEW IF EXISTS `v2`;")
+        self.assertIsNone(self.cache.get("column:db2::t1"))
+
+    def test_refresh_table_versions(self):
+        """表变更时间变化后清理该表的字段缓存"""
+        engine = MagicMock()
+        engine.query.return_value = ResultSet(rows=[("t1", "v1"), ("t2", "v1")])
+        self.cache.refresh_table_versions(engine, "db1")
+        engine.query.return_value = ResultSet(rows=[("t1", "v2"), ("t2", "v1")])
+        self.cache.refresh_table_versions(engine, "db1")
+        self.assertIsNone(self.cache.get("column:db1::t1"))
+        self.assertEqual(self.cache.get("column:db1::t2"), ["id", "name"])
+
+
+SLOW_LOG = """/usr/sbin/mysqld, Version: 5.7.40-log (MySQL Community Server (GPL)). started with:
+Tcp port: 3306  Unix socket: /tmp/mysql.sock
+Time                 Id Command    Argument
+# Time: 2026-10-17T01:02:03.000000Z
+# User@Host: root[root] @ localhost [127.0.0.1]  Id:     8
+# Query_time: 1.500000  Lock_time: 0.000100 Rows_sent: 1  Rows_examined: 100
+use db1;
+SET timestamp=1792198923;
+select * from t where id=1;
+# Time: 2026-10-17T01:03:03.000000Z
+# User@Host: root[root] @ localhost [127.0.0.1]  Id:     8
+# Query_time: 2.500000  Lock_time: 0.000100 Rows_sent: 1  Rows_examined: 100
+SET timestamp=1792198983;
+select * from t where id=2;
+# Time: 2026-10-17T01:12:03.000000Z
+# User@Host: app[app] @  [10.0.0.2]  Id:     9
+# Query_time: 2.000000  Lock_time: 0.000000 Rows_sent: 0  Rows_examined: 5
+SET timestamp=1792199523;
+update t set a=2 wh"""
+
+
+class TestSlowLogIngest(TestCase):
+    def setUp(self):
+        self.ins = Instance.objects.create(
+            instance_name="some_ins",
+            type="slave",
+            db_type="mysql",
+            host="some_host",
+            port=3306,
+            user="ins_user",
+            password="some_str",
+        )
+        self.path = os.path.join(settings.BASE_DIR, "downloads/slow_test.log")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        SlowQueryHistory.objects.all().delete()
+        SlowQuery.objects.all().delete()
+        SlowLogCheckpoint.objects.all().delete()
+        self.ins.delete()
+
+    def test_fingerprint(self):
+        self.assertEqual(
+            fingerprint(
+                "SELECT * FROM t1 WHERE id IN (1, 2,3) and x=-1.5 LIMIT 10, 20"
+            ),
+            "select * from t1 where id in(?+) and x=? limit ?",
+        )
+        self.assertEqual(
+            fingerprint("insert into t values (1,'a'),(2,'b');"),
+            "insert into t values(?+)",
+        )
+
+    def test_ingest_file(self):
+        """按周期聚合写入明细，未写完的语句在下次采集时从断点读取"""
+        with open(self.path, "w") as f:
+            f.write(SLOW_LOG)
+        self.assertEqual(ingest_file(self.ins, self.path), 1)
+        history = SlowQueryHistory.objects.get()
+        self.assertEqual(history.hostname_max, "some_host:3306")
+        self.assertEqual(history.db_max, "db1")
+        self.assertEqual(history.ts_cnt, 2)
+        self.assertEqual(history.query_time_sum, 4)
+        self.assertEqual(history.query_time_max, 2.5)
+        self.assertEqual(history.sample, "select * from t where id=2;")
+        self.assertEqual(
+            SlowQuery.objects.get().fingerprint, "select * from t where id=?"
+        )
+        with open(self.path, "a") as f:
+            f.write("ere id=3;\n")
+        self.assertEqual(ingest_file(self.ins, self.path), 1)
+        self.assertEqual(SlowQueryHistory.objects.count(), 2)
+        self.assertEqual(SlowQuery.objects.count(), 2)
+        # 没有新的慢日志时不重复写入
+        self.assertEqual(ingest_file(self.ins, self.path), 0)
+
+    def test_ingest_file_backfill(self):
+        """补采更早的慢日志时最后出现时间不倒退，首次出现时间提前"""
+        with open(self.path, "w") as f:
+            f.write(SLOW_LOG)
+        ingest_file(self.ins, self.path)
+        query = SlowQuery.objects.get(fingerprint="select * from t where id=?")
+        old_path = os.path.join(settings.BASE_DIR, "downloads/slow_test_old.log")
+        self.addCleanup(os.remove, old_path)
+        with open(old_path, "w") as f:
+            f.write(
+                SLOW_LOG.replace("SET timestamp=17921989", "SET timestamp=17920989")
+            )
+        ingest_file(self.ins, old_path)
+        backfilled = SlowQuery.objects.get(checksum=query.checksum)
+        self.assertEqual(backfilled.last_seen, query.last_seen)
+        self.assertLess(backfilled.first_seen, query.first_seen)
+
+    @patch("sql.utils.slowlog_ingest.get_engine")
+    def test_ingest_digest(self, _get_engine):
+        """首次采集仅记录累计值，之后写入平均执行时长超过阈值的语句"""
+        row = ["db1", "d1", "SELECT * FROM `t` WHERE `id` = ?", 10, 10 * 10**12]
+        _get_engine.return_value.query.return_value = ResultSet(
+            rows=[row + [3 * 10**12, 0, 10, 100]]
+        )
+        self.assertEqual(ingest_digest(self.ins), 0)
+        _get_engine.return_value.query.return_value = ResultSet(
+            rows=[["db1", "d1", row[2], 14, 20 * 10**12, 3 * 10**12, 0, 14, 140]]
+        )
+        self.assertEqual(ingest_digest(self.ins), 1)
+        history = SlowQueryHistory.objects.get()
+        self.assertEqual(history.ts_cnt, 4)
+        self.assertEqual(history.query_time_sum, 10)
+        self.assertEqual(history.query_time_pct_95, 2.5)
+        self.assertEqual(history.rows_examined_sum, 40)
+
+
+class FakeBinlogStream(object):
+    """按照(binlog文件, 事件)的顺序返回事件，模拟BinLogStreamReader"""
+
+    def __init__(self, events):
+        self.events = events
+        self.log_file = None
+        self.closed = False
+
+    def __iter__(self):
+        for log_file, event in self.events:
+            self.log_file = log_file
+            yield event
+
+    def close(self):
+        self.closed = True
+
+
+def row_event(event_class, table, rows, log_pos, schema="db1", timestamp=1792198923):
+    event = MagicMock(spec=event_class)
+    event.schema = schema
+    event.table = table
+    event.primary_key = "id"
+    event.rows = rows
+    event.timestamp = timestamp
+    event.packet.log_pos = log_pos
+    return event
+
+
+class TestBinlog2SQL(TestCase):
+    def setUp(self):
+        self.ins = Instance(
+            instance_name="some_ins",
+            type="master",
+            db_type="mysql",
+            host="some_host",
+            port=3306,
+            user="ins_user",
+            password="some_str",
+        )
+        self.events = [
+            (
+                "mysql-bin.000001",
+                row_event(
+                    WriteRowsEvent,
+                    "t1",
+                    [
+                        {"values": {"id": 1, "name": "a'b"}},
+                        {"values": {"id": 2, "name": None}},
+                    ],
+                    200,
+                ),
+            ),
+            (
+                "mysql-bin.000001",
+                row_event(
+                    UpdateRowsEvent,
+                    "t2",
+                    [
+                        {
+                            "before_values": {"id": 1, "name": "a", "age": 1},
+                            "after_values": {"id": 1, "name": "b", "age": 1},
+                        }
+                    ],
+                    300,
+                ),
+            ),
+            (
+                "mysql-bin.000002",
+                row_event(
+                    DeleteRowsEvent, "t1", [{"values": {"id": 1, "name": "c"}}], 400
+                ),
+            ),
+            (
+                "mysql-bin.000003",
+                row_event(
+                    DeleteRowsEvent, "t1", [{"values": {"id": 3, "name": "d"}}], 500
+                ),
+            ),
+        ]
+        self.path = os.path.join(settings.BASE_DIR, "downloads/my2sql/test_binlog")
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_preview(self):
+        """按顺序生成正向SQL，读取足够行数后关闭binlog连接"""
+        stream = FakeBinlogStream(self.events)
+        rows = Binlog2SQL(self.ins).preview(3, stream=stream)
+        self.assertEqual(
+            [row["sql"] for row in rows],
+            [
+                "INSERT INTO `db1`.`t1` (`id`,`name`) VALUES (1,'a\\'b');",
+                "INSERT INTO `db1`.`t1` (`id`,`name`) VALUES (2,NULL);",
+                "UPDATE `db1`.`t2` SET `name`='b' WHERE `id`=1;",
+            ],
+        )
+        self.assertTrue(stream.closed)
+
+    def test_filter_and_end_file(self):
+        """类型、表过滤，读取到结束文件后停止"""
+        parser = Binlog2SQL(
+            self.ins,
+            work_type="rollback",
+            end_file="mysql-bin.000002",
+            only_tables=["t1"],
+            sql_type=["delete"],
+            no_db_prefix=True,
+            full_columns=True,
+        )
+        rows = parser.preview(10, stream=FakeBinlogStream(self.events))
+        self.assertEqual(
+            rows, [{"sql": "INSERT INTO `t1` (`id`,`name`) VALUES (1,'c');"}]
+        )
+
+    def test_save_rollback(self):
+        """回滚SQL按表拆分文件并且倒序"""
+        parser = Binlog2SQL(self.ins, work_type="rollback", file_per_table=True)
+        count = parser.save(self.path, stream=FakeBinlogStream(self.events))
+        self.assertEqual(count, 5)
+        with open(os.path.join(self.path, "db1.t1.rollback.sql")) as f:
+            self.assertEqual(
+                f.read().splitlines(),
+                [
+                    "INSERT INTO `db1`.`t1` (`id`,`name`) VALUES (3,'d');",
+                    "INSERT INTO `db1`.`t1` (`id`,`name`) VALUES (1,'c');",
+                    "DELETE FROM `db1`.`t1` WHERE `id`=2;",
+                    "DELETE FROM `db1`.`t1` WHERE `id`=1;",
+                ],
+            )
+        with open(os.path.join(self.path, "db1.t2.rollback.sql")) as f:
+            self.assertEqual(
+                f.read(), "UPDATE `db1`.`t2` SET `name`='a' WHERE `id`=1;\n"
+            )
+
+
+def binlog_event(event_class, timestamp, log_pos, **kwargs):
+    event = MagicMock(spec=event_class)
+    event.timestamp = timestamp
+    event.packet.log_pos = log_pos
+    for name, value in kwargs.items():
+        setattr(event, name, value)
+    return event
+
+
+class TestBinlogIndex(TestCase):
+    def setUp(self):
+        self.ins = Instance.objects.create(
+            instance_name="some_ins",
+            type="master",
+            db_type="mysql",
+            host="some_host",
+            port=3306,
+            user="ins_user",
+            password="some_str",
+        )
+        self.start = int(datetime.datetime(2026, 10, 17, 10, 0, 0).timestamp())
+        uuid = "3e11fa47-71ca-11e1-9e33-c80aa9429562"
+        events = []
+        # 每30秒提交一个事务，共10分钟
+        for i in range(20):
+            ts = self.start + i * 30
+            events.append(
+                binlog_event(GtidEvent, ts, 1000 * i + 100, gtid=f"{uuid}:{i + 1}")
+            )
+            events.append(binlog_event(QueryEvent, ts, 1000 * i + 200, query="BEGIN"))
+            events.append(binlog_event(XidEvent, ts, 1000 * i + 900))
+        self.stream_events = [("mysql-bin.000001", e) for e in events] + [
+            ("mysql-bin.000002", binlog_event(XidEvent, self.start + 600, 500))
+        ]
+        self.uuid = uuid
+
+    def tearDown(self):
+        BinlogPosition.objects.all().delete()
+        BinlogIndex.objects.all().delete()
+        self.ins.delete()
+
+    @patch("sql.utils.binlog_index.BinLogStreamReader")
+    @patch("sql.utils.binlog_index.get_engine")
+    def test_index_instance(self, _get_engine, _stream):
+        """索引单个文件的时间范围、GTID范围，按间隔记录稀疏位置，已清理的binlog删除索引"""
+        BinlogIndex.objects.create(instance=self.ins, log_file="mysql-bin.000000")
+        _get_engine.return_value.query.return_value = ResultSet(
+            rows=[("mysql-bin.000001", 20000)]
+        )
+        _stream.return_value = FakeBinlogStream(self.stream_events)
+        self.assertEqual(index_instance(self.ins), 10)
+        index = BinlogIndex.objects.get(instance=self.ins)
+        self.assertEqual(index.log_file, "mysql-bin.000001")
+        self.assertEqual(index.indexed_pos, 19900)
+        self.assertEqual(index.first_time, datetime.datetime(2026, 10, 17, 10, 0, 0))
+        self.assertEqual(index.last_time, datetime.datetime(2026, 10, 17, 10, 9, 30))
+        self.assertEqual(index.gtid_set, f"{self.uuid}:1-20")
+        self.assertEqual(
+            list(
+                BinlogPosition.objects.order_by("log_pos").values_list(
+                    "log_pos", flat=True
+                )[:3]
+            ),
+            [900, 2900, 4900],
+        )
+        # 文件大小未变化时不再读取
+        _stream.reset_mock()
+        self.assertEqual(index_instance(self.ins), 0)
+        _stream.assert_not_called()
+
+    @patch("sql.utils.binlog_index.BinLogStreamReader")
+    @patch("sql.utils.binlog_index.get_engine")
+    def test_resolve_range(self, _get_engine, _stream):
+        """按时间定位开始、结束位置，仅在更精确时替换页面指定的位置"""
+        _get_engine.return_value.query.return_value = ResultSet(
+            rows=[("mysql-bin.000001", 20000)]
+        )
+        _stream.return_value = FakeBinlogStream(self.stream_events)
+        index_instance(self.ins)
+        self.assertEqual(
+            resolve_range(
+                self.ins,
+                "mysql-bin.000001",
+                "",
+                "",
+                "",
+                "2026-10-17 10:05:00",
+                "2026-10-17 10:06:00",
+            ),
+            ("mysql-bin.000001", 8900, "mysql-bin.000001", 14900),
+        )
+        # 开始时间早于所有位置索引时从文件开头读取，结束时间超出索引范围时不限制
+        self.assertEqual(
+            resolve_range(
+                self.ins, "", "", "", "", "2026-10-17 09:00:00", "2026-10-17 11:00:00"
+            ),
+            ("mysql-bin.000001", 4, "", ""),
+        )
+        # 页面指定的位置更精确时不替换
+        self.assertEqual(
+            resolve_range(
+                self.ins,
+                "mysql-bin.000001",
+                9000,
+                "mysql-bin.000001",
+                10000,
+                "2026-10-17 10:05:00",
+                "2026-10-17 10:06:00",
+            ),
+            ("mysql-bin.000001", 9000, "mysql-bin.000001", 10000),
+        )
+
+
+class TestKeysetPagination(TestCase):
+    def setUp(self):
+        now = datetime.datetime.now().replace(microsecond=0)
+        QueryLog.objects.bulk_create(
+            [
+                QueryLog(
+                    instance_name="some_ins",
+                    db_name="some_db",
+                    sqllog=f"select {i}",
+                    effect_row=1,
+                    username="some_user",
+                )
+                for i in range(5)
+            ]
+        )
+        # 前三条的创建时间相同，使用id区分顺序
+        for i, log in enumerate(QueryLog.objects.order_by("id")):
+            log.create_time = now if i < 3 else now + datetime.timedelta(seconds=i)
+            log.save(update_fields=["create_time"])
+
+    def tearDown(self):
+        QueryLog.objects.all().delete()
+
+    def test_cursor(self):
+        now = datetime.datetime(2026, 10, 17, 10, 0, 0)
+        self.assertEqual(decode_cursor(encode_cursor([now, 10])), [now, 10])
+        self.assertIsNone(decode_cursor("not a cursor"))
+
+    def test_paginate(self):
+        """游标分页和offset分页的结果一致，最后一页没有游标"""
+        queryset = QueryLog.objects.values("id", "sqllog", "create_time")
+        expected = list(queryset.order_by("-create_time", "-id"))
+        total, rows, cursor, approximate = paginate(queryset, 0, 2)
+        self.assertEqual((total, approximate), (5, False))
+        self.assertEqual(rows, expected[:2])
+        pages = rows
+        while cursor:
+            _, rows, cursor, _ = paginate(queryset, 0, 2, cursor)
+            pages += rows
+        self.assertEqual(pages, expected)
+        _, rows, _, _ = paginate(queryset, 2, 2)
+        self.assertEqual(rows, expected[2:4])
+
+    @patch("sql.utils.keyset_pagination.has_fulltext_index", return_value=False)
+    def test_text_search_like(self, _has_fulltext_index):
+        """不存在全文索引时模糊匹配全部字段"""
+        condition = text_search(QueryLog, "sqllog", "select 1", like_columns=("alias",))
+        self.assertEqual(QueryLog.objects.filter(condition).count(), 1)
+
+    @patch("sql.utils.keyset_pagination.ngram_token_size", return_value=2)
+    @patch("sql.utils.keyset_pagination.has_fulltext_index", return_value=True)
+    def test_text_search_fulltext(self, _has_fulltext_index, _ngram_token_size):
+        """存在全文索引时语句使用全文索引的id子查询，用户和别名仍然模糊匹配"""
+        condition = text_search(
+            QueryLog, "sqllog", "select", like_columns=("user_display", "alias")
+        )
+        where = str(QueryLog.objects.filter(condition).query).split("WHERE", 1)[1]
+        self.assertIn("MATCH(`sqllog`) AGAINST", where)
+        self.assertIn("`query_log`.`user_display` LIKE", where)
+        self.assertIn("`query_log`.`alias` LIKE", where)
+        self.assertNotIn("`query_log`.`sqllog` LIKE", where)
+
+    @patch("sql.utils.keyset_pagination.ngram_token_size", return_value=2)
+    @patch("sql.utils.keyset_pagination.has_fulltext_index", return_value=True)
+    def test_text_search_fulltext_short(self, _has_fulltext_index, _ngram_token_size):
+        """存在全文索引时，短于ngram分词长度的检索词仍然模糊匹配全部字段"""
+        QueryLog.objects.filter(id=QueryLog.objects.order_by("id")[0].id).update(
+            alias="x"
+        )
+        condition = text_search(QueryLog, "sqllog", "x", like_columns=("alias",))
+        queryset = QueryLog.objects.filter(condition)
+        self.assertNotIn("MATCH", str(queryset.query))
+        self.assertEqual(queryset.count(), 1)
+
+    @patch("sql.utils.keyset_pagination._explain_rows", return_value=100)
+    def test_approximate_count(self, _explain_rows):
+        """超过阈值时返回执行计划估算的行数"""
+        self.assertEqual(approximate_count(QueryLog.objects.all()), (5, False))
+        self.assertEqual(
+            approximate_count(QueryLog.objects.all(), threshold=3), (100, True)
+        )
+
+
+class TestQueryLogWriter(TestCase):
+    def setUp(self):
+        self.sys_config = SysConfig()
+        self.fields = {
+            "username": "some_user",
+            "user_display": "some_user",
+            "db_name": "some_db",
+            "instance_name": "some_ins",
+            "sqllog": "select 1",
+            "effect_row": 1,
+            "cost_time": "0.01",
+            "priv_check": True,
+            "hit_rule": 0,
+            "masking": False,
+        }
+        self.redis = get_redis_connection("default")
+        self.redis.delete(
+            query_log_writer.BUFFER_KEY,
+            query_log_writer.PROCESSING_KEY,
+            query_log_writer.DEAD_LETTER_KEY,
+            query_log_writer.FLUSH_THROTTLE_KEY,
+            query_log_writer.FLUSH_LOCK_KEY,
+        )
+
+    def tearDown(self):
+        self.sys_config.purge()
+        QueryLog.objects.all().delete()
+        self.redis.delete(
+            query_log_writer.BUFFER_KEY,
+            query_log_writer.PROCESSING_KEY,
+            query_log_writer.DEAD_LETTER_KEY,
+            query_log_writer.FLUSH_THROTTLE_KEY,
+            query_log_writer.FLUSH_LOCK_KEY,
+        )
+        shutil.rmtree(query_log_writer.archive_path(), ignore_errors=True)
+
+    def test_write_sync(self):
+        """未开启异步写入时直接写入数据库"""
+        query_log_writer.write(self.fields)
+        self.assertEqual(QueryLog.objects.filter(sqllog="select 1").count(), 1)
+        self.assertEqual(self.redis.llen(query_log_writer.BUFFER_KEY), 0)
+
+    @patch("sql.utils.query_log_writer.async_task")
+    def test_write_async(self, _async_task):
+        """开启异步写入时写入缓冲，间隔内只提交一个写入任务，由写入任务批量写入"""
+        self.sys_config.set("query_log_async", "true")
+        for _ in range(3):
+            query_log_writer.write(self.fields)
+        self.assertEqual(QueryLog.objects.count(), 0)
+        self.assertEqual(self.redis.llen(query_log_writer.BUFFER_KEY), 3)
+        _async_task.assert_called_once_with(
+            "sql.utils.query_log_writer.flush", query_log_writer.FLUSH_INTERVAL_MS
+        )
+        self.assertEqual(query_log_writer.flush(), 3)
+        self.assertEqual(QueryLog.objects.filter(sqllog="select 1").count(), 3)
+        self.assertEqual(query_log_writer.pending(), 0)
+
+    def test_flush_keep_create_time(self):
+        """批量写入时保留写入缓冲时的操作时间"""
+        self.sys_config.set("query_log_async", "true")
+        with patch("sql.utils.query_log_writer.async_task"):
+            query_log_writer.write(self.fields)
+        item = json.loads(self.redis.lindex(query_log_writer.BUFFER_KEY, 0))
+        query_log_writer.flush()
+        self.assertEqual(
+            QueryLog.objects.get().create_time.strftime("%Y-%m-%d %H:%M:%S"),
+            item["create_time"],
+        )
+
+    @patch("sql.utils.query_log_writer.QueryLog.objects.bulk_create")
+    def test_flush_dead_letter(self, _bulk_create):
+        """批量写入失败时逐行写入，无法解析或写入的日志移入死信列表"""
+        _bulk_create.side_effect = Exception("Data too long")
+        self.sys_config.set("query_log_async", "true")
+        with patch("sql.utils.query_log_writer.async_task"):
+            for _ in range(2):
+                query_log_writer.write(self.fields)
+        self.redis.lpush(query_log_writer.BUFFER_KEY, "not json")
+        with patch.object(QueryLog, "save") as _save:
+            _save.side_effect = [None, Exception("Data too long")]
+            self.assertEqual(query_log_writer.flush(), 1)
+        self.assertEqual(_save.call_count, 2)
+        self.assertEqual(query_log_writer.pending(), 0)
+        self.assertEqual(self.redis.llen(query_log_writer.DEAD_LETTER_KEY), 2)
+
+    @patch("sql.utils.query_log_writer.QueryLog.objects.bulk_create")
+    def test_flush_retry(self, _bulk_create):
+        """数据库连接异常时日志保留在处理列表中，下次任务优先写入"""
+        self.sys_config.set("query_log_async", "true")
+        with patch("sql.utils.query_log_writer.async_task"):
+            for _ in range(2):
+                query_log_writer.write(self.fields)
+        _bulk_create.side_effect = OperationalError(2013, "Lost connection")
+        with self.assertRaises(OperationalError):
+            query_log_writer.flush()
+        self.assertEqual(self.redis.llen(query_log_writer.PROCESSING_KEY), 2)
+        _bulk_create.side_effect = None
+        self.assertEqual(query_log_writer.flush(), 2)
+        self.assertEqual(query_log_writer.pending(), 0)
+
+    def test_flush_disable_async(self):
+        """关闭异步写入后保留定时任务直到缓冲写完"""
+        self.sys_config.set("query_log_async", "true")
+        with patch("sql.utils.query_log_writer.async_task"):
+            query_log_writer.write(self.fields)
+        sync_config_schedules({})
+        self.assertTrue(Schedule.objects.filter(name="查询日志写入").exists())
+        self.sys_config.set("query_log_async", "false")
+        self.assertEqual(query_log_writer.flush(), 1)
+        self.assertFalse(Schedule.objects.filter(name="查询日志写入").exists())
+
+    @patch("sql.utils.query_log_writer.get_redis_connection")
+    def test_write_async_fallback(self, _get_redis_connection):
+        """写入缓冲失败时直接写入数据库"""
+        self.sys_config.set("query_log_async", "true")
+        _get_redis_connection.return_value.lpush.side_effect = Exception("down")
+        query_log_writer.write(self.fields)
+        self.assertEqual(QueryLog.objects.count(), 1)
+
+    def test_archive(self):
+        """按月归档超过保留天数的日志，收藏的日志保留"""
+        self.sys_config.set("query_log_retention_days", "30")
+        now = datetime.datetime.now()
+        old = now - datetime.timedelta(days=100)
+        for favorite, create_time in [(False, old), (True, old), (False, now)]:
+            log = QueryLog.objects.create(**self.fields, favorite=favorite)
+            log.create_time = create_time
+            log.save(update_fields=["create_time"])
+        result = query_log_writer.archive()
+        self.assertEqual(len(result), 1)
+        file_name, count = result[0]
+        self.assertEqual(count, 1)
+        with gzip.open(file_name, "rt", encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual(len(rows), 1)
+        self.assertFalse(rows[0]["favorite"])
+        self.assertEqual(QueryLog.objects.count(), 2)
+        self.assertTrue(QueryLog.objects.filter(favorite=True).exists())
+        self.assertEqual(query_log_writer.archive(), [])
+
+    def test_archive_months(self):
+        """id和操作时间顺序不一致时，从最早的操作时间所在月份开始归档"""
+        self.sys_config.set("query_log_retention_days", "30")
+        now = datetime.datetime.now()
+        for days in (100, 200):
+            log = QueryLog.objects.create(**self.fields)
+            log.create_time = now - datetime.timedelta(days=days)
+            log.save(update_fields=["create_time"])
+        self.assertEqual(sum(count for _, count in query_log_writer.archive()), 2)
+        self.assertEqual(QueryLog.objects.count(), 0)
+
+    def test_archive_favorite_during_export(self):
+        """写入文件期间被收藏的日志不删除"""
+        self.sys_config.set("query_log_retention_days", "30")
+        log = QueryLog.objects.create(**self.fields)
+        log.create_time = datetime.datetime.now() - datetime.timedelta(days=100)
+        log.save(update_fields=["create_time"])
+        dumps = query_log_writer.json.dumps
+
+        def favorite_dumps(obj, *args, **kwargs):
+            if isinstance(obj, dict) and "sqllog" in obj:
+                QueryLog.objects.filter(id=obj["id"]).update(favorite=True)
+            return dumps(obj, *args, **kwargs)
+
+        with patch("sql.utils.query_log_writer.json.dumps", favorite_dumps):
+            self.assertEqual(len(query_log_writer.archive()), 1)
+        self.assertTrue(QueryLog.objects.filter(id=log.id, favorite=True).exists())
@@ -315,19 +315,17 @@ class Audit(object):
     # 获取用户待办工单数量
     @staticmethod
     def todo(user):
-        # 先获取用户所在资源组列表
-        group_list = user_groups(user)
-        group_ids = [group.group_id for group in group_list]
-        # 再获取用户所在权限组列表
+        """用户待审核的工单数量，资源组和权限组使用子查询，一次查询完成统计"""
         if user.is_superuser:
-            auth_group_ids = [group.id for group in Group.objects.all()]
+            resource_groups = ResourceGroup.objects.filter(is_deleted=0)
+            auth_groups = Group.objects.all()
         else:
-            auth_group_ids = [group.id for group in Group.objects.filter(user=user)]
-
+            resource_groups = ResourceGroup.objects.filter(users=user, is_deleted=0)
+            auth_groups = Group.objects.filter(user=user)
         return WorkflowAudit.objects.filter(
             current_status=WorkflowDict.workflow_status["audit_wait"],
-            group_id__in=group_ids,
-            current_audit__in=auth_group_ids,
+            group_id__in=resource_groups.values("group_id"),
+            current_audit__in=auth_groups.values("id"),
         ).count()
 
     # 通过审核id获取审核信息
@@ -274,21 +274,21 @@ def rollback(request):
 
     # 直接下载回滚语句
     if download:
+        # 获取数据，逐条语句写入目录
+        path = os.path.join(settings.BASE_DIR, "downloads/rollback")
+        os.makedirs(path, exist_ok=True)
+        file_name = f"{path}/rollback_{workflow_id}.sql"
         try:
             query_engine = get_engine(instance=workflow.instance)
-            list_backup_sql = query_engine.get_rollback(workflow=workflow)
+            with open(file_name, "w") as f:
+                for sql, rollback in query_engine.iter_rollback(workflow=workflow):
+                    f.write(f"/*{sql}*/\n")
+                    for statement in rollback:
+                        f.write(f"{statement}\n")
         except Exception as msg:
             logger.error(traceback.format_exc())
             context = {"errMsg": msg}
             return render(request, "error.html", context)
-
-        # 获取数据，存入目录
-        path = os.path.join(settings.BASE_DIR, "downloads/rollback")
-        os.makedirs(path, exist_ok=True)
-        file_name = f"{path}/rollback_{workflow_id}.sql"
-        with open(file_name, "w") as f:
-            for sql in list_backup_sql:
-                f.write(f"/*{sql[0]}*/\n{sql[1]}\n")
         # 返回
         response = FileResponse(open(file_name, "rb"))
         response["Content-Type"] = "application/octet-stream"
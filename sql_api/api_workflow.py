@@ -14,7 +14,7 @@ from .serializers import (
     AuditWorkflowSerializer,
     ExecuteWorkflowSerializer,
 )
-from .pagination import CustomizedPagination
+from .pagination import CustomizedPagination, KeysetPagination
 from .filters import WorkflowFilter, WorkflowAuditFilter
 from sql.models import (
     SqlWorkflow,
@@ -79,7 +79,8 @@ class WorkflowList(generics.ListAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
     filterset_class = WorkflowFilter
-    pagination_class = CustomizedPagination
+    pagination_class = KeysetPagination
+    keyset_fields = ("workflow__create_time", "workflow_id")
     serializer_class = WorkflowContentSerializer
 
     def get_queryset(self):
@@ -141,7 +142,8 @@ class WorkflowAuditList(generics.ListAPIView):
     """
 
     filterset_class = WorkflowAuditFilter
-    pagination_class = CustomizedPagination
+    pagination_class = KeysetPagination
+    keyset_fields = ("create_time", "audit_id")
     serializer_class = WorkflowAuditListSerializer
     queryset = WorkflowAudit.objects.filter(
         current_status=WorkflowDict.workflow_status["audit_wait"]
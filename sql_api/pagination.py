@@ -1,8 +1,11 @@
 from rest_framework.views import Response
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 from collections import OrderedDict
 from django.conf import settings
 
+from sql.utils.keyset_pagination import paginate
+
 
 class CustomizedPagination(PageNumberPagination):
     """
@@ -29,3 +32,59 @@ class CustomizedPagination(PageNumberPagination):
                 ]
             )
         )
+
+
+class KeysetPagination(CustomizedPagination):
+    """
+    游标分页，按照视图的keyset_fields倒序分页，默认(create_time, id)
+    传入cursor参数时读取游标之后的数据，否则按照页码分页，数据量较大时总数为估算值
+    """
+
+    cursor_query_param = "cursor"
+    keyset_fields = ("create_time", "id")
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        fields = getattr(view, "keyset_fields", self.keyset_fields)
+        page_size = self.get_page_size(request)
+        try:
+            page_number = max(
+                int(request.query_params.get(self.page_query_param, 1)), 1
+            )
+        except ValueError:
+            page_number = 1
+        self.page_number = page_number
+        offset = (page_number - 1) * page_size
+        cursor = request.query_params.get(self.cursor_query_param)
+        self.count, rows, self.next_cursor, self.approximate = paginate(
+            queryset, offset, page_size, cursor, fields
+        )
+        self.cursor_mode = bool(cursor)
+        return rows
+
+    def get_next_link(self):
+        if not self.next_cursor:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.page_query_param)
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
+    def get_previous_link(self):
+        # 游标分页只支持向后翻页
+        if self.cursor_mode or self.page_number <= 1:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.page_query_param, self.page_number - 1)
+
+    def get_paginated_response(self, data):
+        return Response(
+            OrderedDict(
+                [
+                    ("count", data.get("count", self.count)),
+                    ("approximate", self.approximate),
+                    ("next", self.get_next_link()),
+                    ("previous", self.get_previous_link()),
+                    ("results", data.get("data", data)),
+                ]
+            )
+        )
@@ -0,0 +1,80 @@
+-- 原生归档断点
+ALTER TABLE `archive_log` ADD COLUMN `checkpoint` longtext NOT NULL COMMENT '归档断点';
+
+-- 归档调度优先级、入队时间
+ALTER TABLE `archive_config` ADD COLUMN `priority` int(11) NOT NULL DEFAULT 0 COMMENT '归档优先级，数值越大越先执行';
+ALTER TABLE `archive_log` ADD COLUMN `queue_time` datetime(6) DEFAULT NULL COMMENT '入队时间';
+
+-- 慢日志预聚合
+CREATE TABLE `mysql_slow_query_review_rollup` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `granularity` varchar(8) NOT NULL COMMENT '聚合粒度',
+  `bucket` datetime(6) NOT NULL COMMENT '统计时间',
+  `hostname` varchar(64) NOT NULL COMMENT '实例地址',
+  `db_name` varchar(64) NOT NULL COMMENT '数据库',
+  `checksum` char(32) NOT NULL,
+  `ts_cnt` double NOT NULL COMMENT '执行次数',
+  `ts_max` datetime(6) DEFAULT NULL COMMENT '最后执行时间',
+  `query_time_sum` double NOT NULL COMMENT '执行总时长',
+  `query_time_pct_95` double NOT NULL COMMENT '95%执行时长',
+  `rows_examined_sum` double NOT NULL COMMENT '扫描总行数',
+  `rows_sent_sum` double NOT NULL COMMENT '返回总行数',
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `uniq_rollup` (`granularity`,`bucket`,`hostname`,`db_name`,`checksum`),
+  KEY `idx_granularity_hostname_bucket` (`granularity`,`hostname`,`bucket`),
+  KEY `idx_checksum` (`checksum`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='慢日志预聚合';
+
+-- 慢日志采集断点
+CREATE TABLE `slow_log_checkpoint` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `source` varchar(255) NOT NULL COMMENT '采集来源，慢日志文件路径或者digest',
+  `position` longtext NOT NULL COMMENT '采集断点',
+  `update_time` datetime(6) NOT NULL COMMENT '更新时间',
+  `instance_id` int(11) NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `uniq_instance_source` (`instance_id`,`source`),
+  CONSTRAINT `fk_slow_log_checkpoint_instance_id` FOREIGN KEY (`instance_id`) REFERENCES `sql_instance` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='慢日志采集断点';
+
+-- binlog索引
+CREATE TABLE `binlog_index` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `log_file` varchar(255) NOT NULL COMMENT 'binlog文件',
+  `file_size` bigint(20) NOT NULL COMMENT '文件大小',
+  `indexed_pos` bigint(20) NOT NULL COMMENT '已索引的位置',
+  `first_time` datetime(6) DEFAULT NULL COMMENT '第一个事件时间',
+  `last_time` datetime(6) DEFAULT NULL COMMENT '最后一个事件时间',
+  `gtid_set` longtext NOT NULL COMMENT 'GTID范围',
+  `update_time` datetime(6) NOT NULL COMMENT '更新时间',
+  `instance_id` int(11) NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `uniq_instance_log_file` (`instance_id`,`log_file`),
+  CONSTRAINT `fk_binlog_index_instance_id` FOREIGN KEY (`instance_id`) REFERENCES `sql_instance` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='binlog索引';
+
+CREATE TABLE `binlog_position` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `log_file` varchar(255) NOT NULL COMMENT 'binlog文件',
+  `log_pos` bigint(20) NOT NULL COMMENT '位置',
+  `event_time` datetime(6) NOT NULL COMMENT '事件时间',
+  `instance_id` int(11) NOT NULL,
+  PRIMARY KEY (`id`),
+  KEY `idx_instance_event_time` (`instance_id`,`event_time`),
+  CONSTRAINT `fk_binlog_position_instance_id` FOREIGN KEY (`instance_id`) REFERENCES `sql_instance` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='binlog位置索引';
+
+-- 工单列表、查询历史按照(create_time, id)倒序分页的组合索引，数据量较大时建议使用在线DDL工具执行
+ALTER TABLE `sql_workflow`
+  ADD INDEX `idx_create_time_id` (`create_time`,`id`),
+  ADD INDEX `idx_engineer_create_time_id` (`engineer`,`create_time`,`id`),
+  ADD INDEX `idx_group_id_create_time_id` (`group_id`,`create_time`,`id`),
+  ADD INDEX `idx_status_create_time_id` (`status`,`create_time`,`id`),
+  ADD INDEX `idx_instance_create_time_id` (`instance_id`,`create_time`,`id`);
+ALTER TABLE `query_log`
+  ADD INDEX `idx_create_time_id` (`create_time`,`id`),
+  ADD INDEX `idx_username_create_time_id` (`username`,`create_time`,`id`),
+  ADD INDEX `idx_instance_name_create_time_id` (`instance_name`,`create_time`,`id`);
+-- 可选：查询历史语句的ngram全文索引(MySQL 5.7.6及以上)，创建后查询历史的搜索使用全文检索语句内容，用户和别名仍然模糊匹配
+-- 也可以执行 python manage.py querylog_fulltext_index 创建
+-- ALTER TABLE `query_log` ADD FULLTEXT INDEX `idx_sqllog_fulltext`(`sqllog`) WITH PARSER ngram;